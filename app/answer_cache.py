@@ -0,0 +1,180 @@
+import hashlib
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from data_models import StreamAnswerResponseData
+
+
+# キャッシュから再生する際に送り直すイベントの種類
+# 0: action_info, 1: source_url_list, 2: part_of_final_answer_text, 4: action_input_generation_completed
+# （5: web_contents_scraping_progress は実際にはスクレイピングしないので再生しない）
+_REPLAYABLE_ANSWER_TYPE_IDS = {0, 1, 2, 4}
+
+
+class _AnswerCacheEntry:
+    __slots__ = ('key', 'bucket', 'embedding', 'events', 'expires_at')
+
+    def __init__(
+        self,
+        key: int,
+        bucket: Tuple[int, str],
+        embedding: np.ndarray,
+        events: List[StreamAnswerResponseData],
+        expires_at: float,
+    ):
+        self.key = key
+        self.bucket = bucket
+        self.embedding = embedding
+        self.events = events
+        self.expires_at = expires_at
+
+
+# 同じカテゴリ・同じ（短い）会話履歴で、ほぼ同じ質問がされた場合に、過去の回答をそのまま返すためのキャッシュ
+# 質問のembeddingのコサイン類似度がしきい値以上のものをヒットとみなす
+class AnswerCache:
+    def __init__(
+        self,
+        similarity_threshold: float = 0.97,
+        ttl_seconds: float = 60 * 60 * 24,
+        web_search_ttl_seconds: float = 60 * 10,
+        max_entries: int = 1000,
+        max_history_messages: int = 2,
+        # カテゴリごとの有効期限（情報が古くなりやすいカテゴリだけ短くする。未指定のカテゴリはttl_seconds）
+        ttl_seconds_by_category: Optional[Dict[int, float]] = None,
+    ):
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.ttl_seconds_by_category = ttl_seconds_by_category or {}
+        # Web検索を使った回答は情報が古くなりやすいので、別の短い有効期限にする
+        self.web_search_ttl_seconds = web_search_ttl_seconds
+        self.max_entries = max_entries
+        # 会話履歴がこれより長いリクエストは文脈依存が強いのでキャッシュの対象外にする
+        self.max_history_messages = max_history_messages
+
+        # 古いものから破棄するために追加順で保持する
+        self._entries: 'OrderedDict[int, _AnswerCacheEntry]' = OrderedDict()
+        # (category_id, 会話履歴のfingerprint)ごとのエントリ
+        self._buckets: Dict[Tuple[int, str], List[_AnswerCacheEntry]] = {}
+        self._next_key = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def is_cacheable(self, previous_messages: List[str]) -> bool:
+        return len(previous_messages) <= self.max_history_messages
+
+    def lookup(
+        self,
+        category_id: int,
+        previous_messages: List[str],
+        question_embedding: List[float],
+    ) -> Optional[List[StreamAnswerResponseData]]:
+        bucket = (category_id, self._make_history_fingerprint(previous_messages))
+        entries = self._buckets.get(bucket)
+        if not entries:
+            self.misses += 1
+            return None
+
+        now = time.time()
+        for entry in [entry for entry in entries if entry.expires_at <= now]:
+            self._remove(entry)
+        if not (entries := self._buckets.get(bucket)):
+            self.misses += 1
+            return None
+
+        # バケット内の全エントリとの類似度をまとめて計算する
+        embedding = self._normalize(question_embedding)
+        similarities = np.stack([entry.embedding for entry in entries]) @ embedding
+        best_index = int(np.argmax(similarities))
+        if similarities[best_index] < self.similarity_threshold:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return entries[best_index].events
+
+    def store(
+        self,
+        category_id: int,
+        previous_messages: List[str],
+        question_embedding: List[float],
+        events: List[StreamAnswerResponseData],
+    ):
+        replay_events = self._make_replay_events(events)
+        # 最終回答が無いもの（途中で終わったものなど）はキャッシュしない
+        if not any(data.answer_type_id == 2 for data in replay_events):
+            return
+
+        # source_url_listが含まれる = Web検索を使った回答
+        used_web_search = any(data.answer_type_id == 1 for data in replay_events)
+        ttl_seconds = self.ttl_seconds_by_category.get(category_id, self.ttl_seconds)
+        if used_web_search:
+            ttl_seconds = min(ttl_seconds, self.web_search_ttl_seconds)
+
+        bucket = (category_id, self._make_history_fingerprint(previous_messages))
+        entry = _AnswerCacheEntry(
+            key=self._next_key,
+            bucket=bucket,
+            embedding=self._normalize(question_embedding),
+            events=replay_events,
+            expires_at=time.time() + ttl_seconds,
+        )
+        self._next_key += 1
+        self._entries[entry.key] = entry
+        self._buckets.setdefault(bucket, []).append(entry)
+        self.stores += 1
+
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries.values())))
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+    def _remove(self, entry: _AnswerCacheEntry):
+        self._entries.pop(entry.key, None)
+        entries = self._buckets.get(entry.bucket, [])
+        if entry in entries:
+            entries.remove(entry)
+        if not entries:
+            self._buckets.pop(entry.bucket, None)
+
+    def _make_replay_events(self, events: List[StreamAnswerResponseData]) -> List[StreamAnswerResponseData]:
+        # 再生に必要なイベントだけを残し、連続する回答の断片は1つにまとめて送信回数を減らす
+        replay_events: List[StreamAnswerResponseData] = []
+        for data in events:
+            if data.answer_type_id not in _REPLAYABLE_ANSWER_TYPE_IDS:
+                continue
+            if data.answer_type_id == 2 and replay_events and replay_events[-1].answer_type_id == 2:
+                replay_events[-1] = StreamAnswerResponseData(
+                    answer_type_id=2,
+                    part_of_final_answer_text=replay_events[-1].part_of_final_answer_text + data.part_of_final_answer_text,
+                )
+                continue
+            replay_events.append(data)
+        return replay_events
+
+    @staticmethod
+    def _make_history_fingerprint(previous_messages: List[str]) -> str:
+        normalized = '\n'.join(' '.join(unicodedata.normalize('NFKC', message).split()) for message in previous_messages)
+        return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
@@ -0,0 +1,131 @@
+import asyncio
+import json
+from typing import Optional, Union
+
+from data_models import AnswerResponseQueue, StreamAnswerResponseData
+
+
+# 最終回答の断片だけのイベントは件数が最も多いので、固定部分を組み立て済みの文字列にしておく
+ANSWER_TEXT_FRAME_PREFIX = '{"answer_type_id":2,"part_of_final_answer_text":'
+
+
+# コンパクト形式のSSEで、送ったフレーム数と、まとめた最終回答の断片の数を集計するクラス
+class AnswerStreamFramingStats:
+    def __init__(self):
+        self.streams = 0
+        self.frames = 0
+        self.frame_bytes = 0
+        self.answer_text_chunks = 0
+        self.answer_text_frames = 0
+
+    def on_stream_started(self):
+        self.streams += 1
+
+    def on_frame_encoded(self, frame: str):
+        self.frames += 1
+        self.frame_bytes += len(frame.encode('utf-8'))
+
+    def on_answer_text_coalesced(self, chunk_count: int):
+        self.answer_text_chunks += chunk_count
+        self.answer_text_frames += 1
+
+    def stats(self) -> dict:
+        return {
+            'streams': self.streams,
+            'frames': self.frames,
+            'avg_frame_bytes': self.frame_bytes / self.frames if self.frames else 0.0,
+            'answer_text_chunks': self.answer_text_chunks,
+            'answer_text_frames': self.answer_text_frames,
+            'avg_chunks_per_frame': self.answer_text_chunks / self.answer_text_frames if self.answer_text_frames else 0.0,
+        }
+
+
+# プロセス全体で共有する集計値
+answer_stream_framing_stats = AnswerStreamFramingStats()
+
+
+def encode_compact(data: StreamAnswerResponseData) -> str:
+    # Noneのフィールドを省き、区切りの空白も入れず、日本語も\uエスケープせずにUTF-8のまま送る
+    # （pydanticの.dict()を通さずに、必要なフィールドだけを読む）
+    if _is_answer_text(data):
+        frame = ANSWER_TEXT_FRAME_PREFIX + json.dumps(data.part_of_final_answer_text, ensure_ascii=False) + '}'
+    else:
+        frame = json.dumps(_drop_none(data.dict()), ensure_ascii=False, separators=(',', ':'))
+    answer_stream_framing_stats.on_frame_encoded(frame)
+    return frame
+
+
+# AnswerResponseQueueから受け取る際に、続けて届いた最終回答の断片を1つのイベントにまとめるクラス
+# 最初の断片から max_wait_seconds 秒経つか、まとめた文字列が max_bytes バイトに達した時点で1つにして返す
+# （AnswerResponseQueueと同じget()で受け取れるので、SSEを送る側のループはそのまま使える）
+class CoalescingAnswerReader:
+    def __init__(
+        self,
+        channel: AnswerResponseQueue,
+        max_wait_seconds: float = 0.03,
+        max_bytes: int = 1024,
+    ):
+        self.channel = channel
+        self.max_wait_seconds = max_wait_seconds
+        self.max_bytes = max_bytes
+        # まとめている途中で届いた、最終回答の断片以外のデータ（次のget()で返す）
+        self._pending = None
+        answer_stream_framing_stats.on_stream_started()
+
+    async def get(self) -> Union[StreamAnswerResponseData, Exception, KeyboardInterrupt, StopIteration]:
+        if self._pending is not None:
+            data, self._pending = self._pending, None
+        else:
+            data = await self.channel.get()
+        if not _is_answer_text(data):
+            return data
+
+        texts = [data.part_of_final_answer_text]
+        byte_count = len(data.part_of_final_answer_text.encode('utf-8'))
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait_seconds
+        while byte_count < self.max_bytes:
+            next_data = await self._get_before(deadline)
+            if next_data is None:
+                break
+            if not _is_answer_text(next_data):
+                self._pending = next_data
+                break
+            texts.append(next_data.part_of_final_answer_text)
+            byte_count += len(next_data.part_of_final_answer_text.encode('utf-8'))
+
+        answer_stream_framing_stats.on_answer_text_coalesced(chunk_count=len(texts))
+        if len(texts) == 1:
+            return data
+        return StreamAnswerResponseData(answer_type_id=2, part_of_final_answer_text=''.join(texts))
+
+    async def _get_before(self, deadline: float) -> Optional[object]:
+        # 既に届いている分は待たずに取り出し、無い場合だけ期限まで待つ（期限を過ぎた場合はNone）
+        try:
+            return self.channel.queue.get_nowait()
+        except asyncio.QueueEmpty:
+            pass
+        timeout = deadline - asyncio.get_running_loop().time()
+        if timeout <= 0:
+            return None
+        try:
+            return await asyncio.wait_for(self.channel.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+def _is_answer_text(data) -> bool:
+    # エラー時のステータスコード付きのものはまとめない
+    return isinstance(data, StreamAnswerResponseData) \
+        and data.answer_type_id == 2 \
+        and data.part_of_final_answer_text is not None \
+        and data.action_info is None \
+        and data.source_url_list is None \
+        and data.status_code is None \
+        and data.web_contents_scraping_progress is None
+
+
+def _drop_none(value):
+    if isinstance(value, dict):
+        return {key: _drop_none(item) for key, item in value.items() if item is not None}
+    return value
@@ -1,9 +1,27 @@
+import copy
 from enum import Enum
-from typing import List, Optional, Union
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Any, List, Tuple
 from langchain.vectorstores import VectorStore
 from callback_handler import CallbackHandler
-from google_serper import CustomGoogleSerper
-from web_contents_scraper import WebContentsScraper
+from env import Env
+from cancellation import CancellationToken
+from google_serper import SerperSearchCache
+from http_fetcher import HttpFetcher
+from index_retriever import RetrievalSettings, aretrieve_documents
+from retrieval_fan_out import RetrievalFanOut
+from web_contents_cache import WebContentsCache
+from web_contents_scraper import DeepSearchPolicy, WebContentsScraper
+from passage_extractor import LocalPassageExtractor
+from structured_logging import get_logger
+import vector_stores
+
+logger = get_logger(__name__)
+
+# 組織内外データ統合検索で、それぞれの検索を待つ上限の秒数（過ぎた場合は取得できた方の結果だけで回答する）
+INDEX_SEARCH_DEADLINE_SECONDS = 5
+WEB_SEARCH_DEADLINE_SECONDS = 30
 
 class Dnum(Enum):
     """
@@ -98,33 +116,90 @@ class AssistantFunctionType(Dnum):
             return ''
 
 
+# 書き換えられないdict（dictのサブクラスなので、json.dumpsやChatCompletionのリクエストではそのままdictとして扱われる）
+class _FrozenDict(dict):
+    def _raise_read_only(self, *args, **kwargs):
+        raise TypeError('全リクエストで共有しているfunctionの情報は書き換えられません（copy.deepcopy()したものを使ってください）')
+
+    __setitem__ = __delitem__ = __ior__ = _raise_read_only
+    clear = pop = popitem = setdefault = update = _raise_read_only
+
+    def __copy__(self) -> dict:
+        return dict(self)
+
+    def __deepcopy__(self, memo: dict) -> dict:
+        # コピーしたものは書き換えられる様に、普通のdictとlistに戻す
+        return {key: _thaw(value, memo) for key, value in self.items()}
+
+
+def _freeze(value: Any) -> Any:
+    if isinstance(value, dict):
+        return _FrozenDict({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _thaw(value: Any, memo: dict) -> Any:
+    if isinstance(value, tuple):
+        return [_thaw(item, memo) for item in value]
+    return copy.deepcopy(value, memo)
+
+
+# functionの情報はリクエスト毎に変わらないので、起動時に一度だけ生成して使い回す
+# get_function_infos()の結果はキャッシュされて全リクエストで共有されるので、中のスキーマまで書き換えられない様にしておく
+FUNCTION_INFO_TABLE = MappingProxyType({
+    function_type: _freeze(function_type.get_function_info()) for function_type in AssistantFunctionType
+})
+
+
+# 受け取ったパラメータに合わせて、ChatCompletionに渡すfunctionの情報の組み合わせを返す（組み合わせごとに1度だけ生成される）
+@lru_cache(maxsize=None)
+def get_function_infos(
+    use_latest_information: bool,
+    is_enabled_web_and_index_data_integrated_mode: bool,
+) -> Tuple[dict, ...]:
+    # 統合検索モードの場合は他のfunctionは使わずに統合検索だけにする
+    if is_enabled_web_and_index_data_integrated_mode:
+        return (FUNCTION_INFO_TABLE[AssistantFunctionType.Search_On_Web_And_Index_Data],)
+
+    # 内部情報検索用のfunction情報は常に含める
+    function_infos = [FUNCTION_INFO_TABLE[AssistantFunctionType.Search_On_Index_Data]]
+    if use_latest_information:
+        function_infos.append(FUNCTION_INFO_TABLE[AssistantFunctionType.Search_On_Web])
+    return tuple(function_infos)
+
+
 @register(AssistantFunctionType.Search_On_Web)
 async def _Search_On_Web(
     query: str,
     callback_handler: CallbackHandler,
+    cancellation_token: CancellationToken,
 ) -> (List[str], str): # 戻り値のタプル　1つ目: リンクの配列、2つ目： 参考情報の文字列
-    print(f'_Search_On_Web query: {query}')
+    logger.info('_Search_On_Web', query=query)
     result = await search_on_google_serper(
         query=query,
         callback_handler=callback_handler,
+        cancellation_token=cancellation_token,
     )
-    print(f'result: {result}')
+    logger.debug('_Search_On_Web result', result=result)
     return result
 
 @register(AssistantFunctionType.Search_On_Index_Data)
-def _Search_On_Index_Data(
+async def _Search_On_Index_Data(
     query: str,
     vector_store: VectorStore,
+    retrieval_settings: RetrievalSettings,
 ) -> str:
-    print(f'Search_On_Index_Data query: {query}')
-    documents = vector_store.similarity_search(
+    logger.info('Search_On_Index_Data', query=query)
+    # 多めに取り出した候補から、関連度と多様性を踏まえて上位を選び直す（関係ない情報はしきい値で除く）
+    documents = await aretrieve_documents(
         query=query,
-        # 取り出すドキュメントの上位⚪︎件の値。関係ない情報が回答に紛れ込まない様に上位1件だけに設定。
-        k=1
+        vector_store=vector_store,
+        settings=retrieval_settings,
     )
-    # 今はk=1にしていて結果は1つなので連結する必要はないが今後kの値を複数にする可能性もありえるのでループで連結させている
-    documents_text = ''.join([doc.page_content for doc in documents])
-    print(f'documents_text: {documents_text}')
+    documents_text = '\n\n'.join([doc.page_content for doc in documents])
+    logger.debug('Search_On_Index_Data result', documents_text=documents_text)
     return documents_text
 
 # 組織内外データ統合検索でも基本的には外部データ検索と同じ型の戻り値、流れで処理を行う。
@@ -133,35 +208,76 @@ async def _Search_On_Web_And_Index_Data(
     index_data_search_query: str,
     web_search_query: str,
     vector_store: VectorStore,
+    retrieval_settings: RetrievalSettings,
     callback_handler: CallbackHandler,
+    cancellation_token: CancellationToken,
 ) -> (List[str], str): # 戻り値のタプル　1つ目: リンクの配列、2つ目： 参考情報の文字列
-    print(f'Search_On_Web_And_Index_Data index_data_search_query: {index_data_search_query}, web_search_query: {web_search_query}')
+    logger.info('Search_On_Web_And_Index_Data', index_data_search_query=index_data_search_query, web_search_query=web_search_query)
 
-    # 組織内データ検索を行う（現状ベクトル検索は時間のかかる処理では無いので一旦同期処理でOK）
-    index_data_search_result = vector_store.similarity_search(
-        query=index_data_search_query,
-        # 取り出すドキュメントの上位⚪︎件の値。関係ない情報が回答に紛れ込まない様に上位1件だけに設定。
-        k=1
+    # 組織内データ検索と外部データ検索を同時に行い、それぞれの期限までに返ってきた結果だけを使う
+    fan_out = RetrievalFanOut()
+    fan_out.add_branch(
+        name='index',
+        # クエリのembedding取得とベクトル検索でイベントループを止めない様に非同期版（executorで実行される）を使用する
+        run=lambda: aretrieve_documents(
+            query=index_data_search_query,
+            vector_store=vector_store,
+            settings=retrieval_settings,
+        ),
+        deadline_seconds=INDEX_SEARCH_DEADLINE_SECONDS,
     )
-    # 外部データ検索を行う
-    web_search_result = await search_on_google_serper(
-        query=web_search_query,
-        callback_handler=callback_handler,
+    fan_out.add_branch(
+        name='web',
+        run=lambda: search_on_google_serper(
+            query=web_search_query,
+            callback_handler=callback_handler,
+            cancellation_token=cancellation_token,
+        ),
+        deadline_seconds=WEB_SEARCH_DEADLINE_SECONDS,
     )
+    branch_results = await fan_out.run()
+    cancellation_token.raise_if_cancelled()
+    index_data_search_result = branch_results['index'].value or []
+    web_search_result = branch_results['web'].value or ([], '')
 
-    # 組織内データ検索結果のドキュメント配列を結合して文字列にする（今はk=1にしていて結果は1つなので連結する必要はないが今後kの値を複数にする可能性もありえるのでループで連結させている）
-    documents_text = ''.join([doc.page_content for doc in index_data_search_result])
+    # 組織内データ検索結果のドキュメント配列を結合して文字列にする
+    documents_text = '\n\n'.join([doc.page_content for doc in index_data_search_result])
+    # 期限内に取得できなかった情報源があれば、その旨を回答指示に含めて、取得できた情報だけで答えさせる
+    missing_sources = [
+        source_name for branch_name, source_name in [('index', '組織内データ'), ('web', '外部データ')]
+        if not branch_results[branch_name].is_ok
+    ]
+    missing_sources_text = ''
+    if missing_sources:
+        missing_sources_text = f"\n    #注意:{'と'.join(missing_sources)}は時間内に取得できなかったため、取得できた情報だけで答え、その旨もユーザーに伝えて下さい。"
     # インデックスデータ検索結果の文字列を、外部データ検索結果の文字列と結合する。
     # また、両者を言い感じに比較してる風の回答をさせるために、ここで回答指示を追加して挙動をコントロールしている。
     web_and_index_data_integrated_result_text = f'''
-    #命令:「組織内データから取得した情報」と、「外部データから取得した情報」の両方を相互に比較し、その比較結果をまず出力するとともにそれを踏まえた上でユーザーの元の質問に答えて下さい。
+    #命令:「組織内データから取得した情報」と、「外部データから取得した情報」の両方を相互に比較し、その比較結果をまず出力するとともにそれを踏まえた上でユーザーの元の質問に答えて下さい。{missing_sources_text}
     #組織内データから取得した情報:{documents_text}
     #外部データから取得した情報:{web_search_result[1]}
     '''
-    print(f'web_and_index_data_integrated_result_text: {web_and_index_data_integrated_result_text}')
+    logger.debug('Search_On_Web_And_Index_Data result', web_and_index_data_integrated_result_text=web_and_index_data_integrated_result_text)
     # 両者の文字列を結合した上で、（リンク配列, 結果の文字列）の形式のタプルにして返却
     return (web_search_result[0], web_and_index_data_integrated_result_text)
 
+# 同じ検索が繰り返し・同時に行われた場合にSerperのAPI呼び出しを減らすためのキャッシュ
+serper_search_cache = SerperSearchCache()
+# 人気のページを何度も取得・要約しない様にするためのキャッシュ
+web_contents_cache = WebContentsCache(
+    embeddings=vector_stores.embeddings,
+    db_path='./cache/web_contents.sqlite3',
+)
+# スクレイピング用にコネクションを使い回すHTTPクライアント
+http_fetcher = HttpFetcher()
+# 16kモデルでの要約の代わりに、ページの中から質問に関連するパッセージをローカルで抽出するクラス
+passage_extractor = LocalPassageExtractor()
+# ディープサーチで、全ページの要約を待たずに回答を始めるための条件
+deep_search_policy = DeepSearchPolicy(
+    min_summaries=int(Env.DEEP_SEARCH_MIN_SUMMARIES) if Env.DEEP_SEARCH_MIN_SUMMARIES else None,
+    max_wait_seconds=float(Env.DEEP_SEARCH_MAX_WAIT_SECONDS) if Env.DEEP_SEARCH_MAX_WAIT_SECONDS else None,
+)
+
 def parse_function_type_from_string(function_name: str) -> AssistantFunctionType:
     if function_name == AssistantFunctionType.Search_On_Web.value:
         return AssistantFunctionType.Search_On_Web
@@ -170,30 +286,39 @@ def parse_function_type_from_string(function_name: str) -> AssistantFunctionType
     elif function_name == AssistantFunctionType.Search_On_Web_And_Index_Data.value:
         return AssistantFunctionType.Search_On_Web_And_Index_Data
     else:
-        print(f'想定外のfunction_name: {function_name}')
+        logger.warning('想定外のfunction_name', function_name=function_name)
 
 async def search_on_google_serper(
     query: str,
     callback_handler: CallbackHandler,
+    cancellation_token: CancellationToken,
 ) -> (List[str], str):
-    result = CustomGoogleSerper().run(query=query)
+    cancellation_token.enter_stage('web_search')
+    result = await serper_search_cache.run(query=query)
+    # 検索中にクライアントが切断していた場合は、この後のスクレイピング＆要約は行わない
+    cancellation_token.raise_if_cancelled()
 
     # AnswerBoxかKnowledgeGraphの値が取れている場合はそれだけで十分な情報なのでそのまま参考情報として返す。Linkのスクレイピング＆要約はしない。
     if result.answer_box or result.knowledge_graph:
-        print(f"🟨AnswerBoxかKnowledgeGraphの値が取れている場合 それだけで十分な情報なのでそのまま参考情報として返す。")
+        logger.info('AnswerBoxかKnowledgeGraphの値が取れている場合 それだけで十分な情報なのでそのまま参考情報として返す。')
         result_text = '\n\n'.join([result.answer_box, result.knowledge_graph])
         # この場合はリンク先の情報は参考にしていないが、UI上で表示した方がリッチな見た目になる為リンクも返却する
         return (result.links, result_text)
 
     # ディープサーチを行う
     else:
-        print("🟥ディープサーチの場合 検索結果上位3件のリンクが渡されるのでスクレイピング&要約して返す。")
+        logger.info('ディープサーチの場合 検索結果上位3件のリンクが渡されるのでスクレイピング&要約して返す。', link_count=len(result.links))
         # AnswerBoxもKnowledgeGraphも取れなかった場合は通常の検索結果上位3件のリンクが渡されるのでスクレイピング＆要約して返す。
         if result.links:
             scraper = WebContentsScraper(
                 links=result.links,
                 query=query,
                 callback_handler=callback_handler,
+                cancellation_token=cancellation_token,
+                cache=web_contents_cache,
+                fetcher=http_fetcher,
+                extractor=passage_extractor if Env.WEB_CONTENTS_EXTRACTION_MODE == 'local' else None,
+                policy=deep_search_policy,
             )
             summary = await scraper.create_summary_from_links()
             # この場合は各リンクの表示とともに、スクレイピングした回答も参考情報として渡す
@@ -0,0 +1,110 @@
+# FAISSのインデックスの種類ごとに、Flat（全件検索）と比べた再現率、検索時間、メモリ使用量を比較するスクリプト
+# 使い方: python benchmark_faiss_index_types.py [インデックスのディレクトリ] [--count 20000] [--dim 1536] [--queries 200] [--k 10]
+# （インデックスのディレクトリを指定した場合はそのベクトルを使い、省略した場合はクラスタ状に分布した疑似的なベクトルを生成する）
+import argparse
+import os
+import tempfile
+import time
+
+import faiss
+import numpy as np
+
+from faiss_index_config import FaissIndexConfig
+from vector_stores import _get_rss_bytes
+
+
+# 比較するインデックスの種類と検索時のパラメータ
+INDEX_CONFIGS = [
+    FaissIndexConfig(factory='Flat'),
+    FaissIndexConfig(factory='HNSW32', search_params={'efSearch': 32}),
+    FaissIndexConfig(factory='HNSW32', search_params={'efSearch': 128}),
+    FaissIndexConfig(factory='IVF256,Flat', search_params={'nprobe': 8}),
+    FaissIndexConfig(factory='IVF256,Flat', search_params={'nprobe': 32}),
+    FaissIndexConfig(factory='IVF256,PQ64', search_params={'nprobe': 16}),
+    FaissIndexConfig(factory='HNSW32,SQ8', search_params={'efSearch': 64}),
+]
+
+
+def load_vectors(index_dir: str) -> np.ndarray:
+    vectors_path = os.path.join(index_dir, 'vectors.npy')
+    if os.path.exists(vectors_path):
+        return np.load(vectors_path)
+    index = faiss.read_index(os.path.join(index_dir, 'index.faiss'))
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def make_synthetic_vectors(count: int, dim: int, cluster_count: int = 100, seed: int = 0) -> np.ndarray:
+    # 実際の文章のembeddingに近づける様に、いくつかのクラスタの周りに分布させて正規化する
+    random_state = np.random.RandomState(seed)
+    centers = random_state.randn(cluster_count, dim).astype(np.float32)
+    vectors = centers[random_state.randint(cluster_count, size=count)] + 0.5 * random_state.randn(count, dim).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def measure(config: FaissIndexConfig, vectors: np.ndarray, queries: np.ndarray, k: int, ground_truth: np.ndarray) -> dict:
+    started_at = time.perf_counter()
+    index = config.build(vectors)
+    build_seconds = time.perf_counter() - started_at
+
+    # サーバーと同じ読み込み方（mmap＆読み取り専用）で読み込んだ時のメモリ増加量を計る
+    with tempfile.TemporaryDirectory() as temp_dir:
+        index_file_path = os.path.join(temp_dir, 'index.faiss')
+        faiss.write_index(index, index_file_path)
+        del index
+        rss_before = _get_rss_bytes()
+        index = faiss.read_index(index_file_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        config.apply_search_params(index)
+        rss_delta = _get_rss_bytes() - rss_before if rss_before is not None else None
+        file_bytes = os.path.getsize(index_file_path)
+
+        latencies_ms = []
+        hits = 0
+        for query, expected in zip(queries, ground_truth):
+            started_at = time.perf_counter()
+            _, ids = index.search(query.reshape(1, -1), k)
+            latencies_ms.append((time.perf_counter() - started_at) * 1000)
+            hits += len(set(ids[0]) & set(expected))
+
+    return {
+        'recall': hits / ground_truth.size,
+        'p50_ms': float(np.percentile(latencies_ms, 50)),
+        'p99_ms': float(np.percentile(latencies_ms, 99)),
+        'build_s': build_seconds,
+        'file_mb': file_bytes / 1024 / 1024,
+        'rss_delta_mb': rss_delta / 1024 / 1024 if rss_delta is not None else None,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('index_dir', nargs='?')
+    parser.add_argument('--count', type=int, default=20000)
+    parser.add_argument('--dim', type=int, default=1536)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    args = parser.parse_args()
+
+    vectors = load_vectors(args.index_dir) if args.index_dir else make_synthetic_vectors(args.count, args.dim)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    random_state = np.random.RandomState(1)
+    queries = vectors[random_state.randint(len(vectors), size=args.queries)]
+    queries = queries + 0.05 * random_state.randn(*queries.shape).astype(np.float32)
+    k = min(args.k, len(vectors))
+
+    # Flatの検索結果を正解として再現率を計算する
+    flat_index = faiss.IndexFlatL2(vectors.shape[1])
+    flat_index.add(vectors)
+    _, ground_truth = flat_index.search(queries, k)
+    del flat_index
+
+    print(f'vectors={vectors.shape}, queries={len(queries)}, k={k}')
+    for config in INDEX_CONFIGS:
+        try:
+            result = measure(config, vectors, queries, k, ground_truth)
+        except RuntimeError as e:
+            # ベクトル数がクラスタ数より少ないなど、その種類のインデックスを作れない場合
+            print(f'{config.factory} {config.search_params}: skipped ({e})')
+            continue
+        print(f'{config.factory} {config.search_params}: recall@{k}={result["recall"]:.3f}, '
+              f'p50={result["p50_ms"]:.2f}ms, p99={result["p99_ms"]:.2f}ms, build={result["build_s"]:.1f}s, '
+              f'file={result["file_mb"]:.1f}MB, rss_delta={result["rss_delta_mb"]:.1f}MB')
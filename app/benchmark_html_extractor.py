@@ -0,0 +1,69 @@
+# 旧来のクリーン処理（BeautifulSoupTransformer + RecursiveCharacterTextSplitter）と、
+# トークン上限で打ち切る extract_text_within_token_budget() の処理時間を比較するスクリプト
+# 使い方: python benchmark_html_extractor.py [HTMLファイルのパス or URL ...]
+# （引数が無い場合は、数MBの擬似的なページを生成して比較する）
+import sys
+import time
+
+import requests
+from langchain.document_transformers import BeautifulSoupTransformer
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain.docstore.document import Document
+
+from context_packer import get_encoding
+from html_text_extractor import extract_text_within_token_budget, iter_html_chunks
+
+
+def legacy_clean_content(content: str) -> str:
+    bs_transformer = BeautifulSoupTransformer()
+    transformed_docs = bs_transformer.transform_documents(
+        documents=[Document(page_content=content)],
+        unwanted_tags=["nav", "header", "footer", "script", "style"],
+        tags_to_extract=["div", "span"]
+    )
+    splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(chunk_size=10000,
+                                                                    chunk_overlap=0)
+    splits = splitter.split_documents(documents=transformed_docs)
+    return splits[0].page_content
+
+
+def make_synthetic_page(paragraph_count: int = 20000) -> str:
+    paragraphs = ''.join(
+        f'<div class="entry"><span>{i}番目の段落です。ウルトラ深瀬はiOSエンジニアとして東京で働いています。</span>'
+        f'<script>var x{i} = {i};</script></div>\n'
+        for i in range(paragraph_count)
+    )
+    return f'<html><head><style>body {{}}</style></head><body><nav>menu</nav><header>header</header>{paragraphs}<footer>footer</footer></body></html>'
+
+
+def load_page(source: str) -> str:
+    if source.startswith('http://') or source.startswith('https://'):
+        return requests.get(source, timeout=30).text
+    with open(source, encoding='utf-8', errors='replace') as f:
+        return f.read()
+
+
+def measure(func, content: str, repeat: int = 3):
+    best = float('inf')
+    result = ''
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        result = func(content)
+        best = min(best, time.perf_counter() - started_at)
+    return best, result
+
+
+if __name__ == '__main__':
+    sources = sys.argv[1:] or ['synthetic']
+    encoding = get_encoding('gpt-3.5-turbo-16k')
+    for source in sources:
+        content = make_synthetic_page() if source == 'synthetic' else load_page(source)
+        legacy_seconds, legacy_result = measure(legacy_clean_content, content)
+        budget_seconds, budget_result = measure(
+            lambda html: extract_text_within_token_budget(iter_html_chunks(html), max_tokens=10000),
+            content,
+        )
+        print(f'{source} ({len(content.encode("utf-8")) / 1024 / 1024:.1f}MB)')
+        print(f' - legacy: {legacy_seconds * 1000:.0f}ms, {len(encoding.encode(legacy_result))} tokens')
+        print(f' - budget: {budget_seconds * 1000:.0f}ms, {len(encoding.encode(budget_result))} tokens')
+        print(f' - speedup: x{legacy_seconds / budget_seconds:.1f}')
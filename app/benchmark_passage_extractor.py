@@ -0,0 +1,169 @@
+# ディープサーチの各ページに対する「16kモデルでの要約」と「ローカルでの関連パッセージの抽出」を、処理時間と回答に必要な情報が残るかで比較するスクリプト
+# 使い方: python benchmark_passage_extractor.py [評価データのJSONLファイル] [--llm]
+# 評価データは1行ごとに {"source": "URLかHTMLファイルのパス", "query": "...", "expected_text": "..."} の形式で、
+# 抽出・要約した結果にexpected_textが含まれていれば必要な情報が残っているとみなす
+# expected_textがnullの行は、ページに関係のない質問として、ローカルでの抽出がLLMでの要約に任せる（Noneを返す）ことを確認する
+# （引数が無い場合は、関連する1文を埋め込んだ疑似的なページで評価する。--llmを付けた場合だけ16kモデルも呼び出す）
+# --sweep を付けた場合は、min_match_ratioを変えながら必要な情報が残る割合と、関係のない質問をLLMに任せられた割合を表示する
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+from typing import List, Optional
+
+from benchmark_html_extractor import load_page
+from cancellation import CancellationToken
+from context_packer import count_tokens
+from html_text_extractor import extract_text_within_token_budget, iter_html_chunks
+from lexical_index import make_ngrams, normalize_text
+from passage_extractor import LocalPassageExtractor
+from web_contents_scraper import WebContentsScraper
+
+
+def make_synthetic_eval_cases(count: int = 20, seed: int = 0) -> List[dict]:
+    # 無関係な段落の中の1か所に、質問の答えになる1文を埋め込んだページを作る
+    # 半分のページには、ページの内容と関係のない質問（expected_textがNone）も付ける
+    random_state = random.Random(seed)
+    facts = [
+        ('深瀬の出身地', '深瀬の出身地は北海道の札幌市です。'),
+        ('深瀬の趣味', '深瀬の趣味はサウナとキャンプです。'),
+        ('深瀬が使っている言語', '深瀬が業務で使っている言語はSwiftとPythonです。'),
+        ('深瀬の前職', '深瀬の前職は飲食店の店長でした。'),
+    ]
+    fillers = [
+        'このサイトではiOSアプリ開発に関する記事を掲載しています。',
+        '最新の記事は毎週月曜日に更新されます。',
+        'お問い合わせはフォームからお願いいたします。',
+        'SwiftUIのレイアウトについて解説します。',
+        'Xcodeのビルド設定を見直すとビルド時間が短くなることがあります。',
+        '深瀬のブログへようこそ。',
+        '本日の東京は晴れの予報です。',
+    ]
+    unrelated_queries = [
+        '確定申告の期限はいつですか',
+        'ラーメンのおすすめの店',
+        '京都の観光スポット',
+        '住宅ローンの金利の比較',
+        '明日の大阪の天気',
+    ]
+    eval_cases = []
+    for i in range(count):
+        query, fact = facts[i % len(facts)]
+        # キーワードだけの質問と、文章での質問を交互に使う
+        query = query if i % 2 == 0 else f'{query}について教えてください'
+        # 同じ文章の段落はクリーン時に1つにまとめられるので、番号を付けて別の段落にする
+        paragraphs = [f'{random_state.choice(fillers)}（No.{j}）' for j in range(250)]
+        paragraphs.insert(random_state.randrange(len(paragraphs)), fact)
+        html = '<html><body><nav>menu</nav>' + ''.join(f'<div><span>{p}</span></div>' for p in paragraphs) + '</body></html>'
+        eval_cases.append({'source': html, 'query': query, 'expected_text': fact})
+        if i % 2 == 0:
+            eval_cases.append({'source': html, 'query': random_state.choice(unrelated_queries), 'expected_text': None})
+    return eval_cases
+
+
+def load_eval_cases(path: str) -> List[dict]:
+    with open(path, encoding='utf-8') as f:
+        eval_cases = [json.loads(line) for line in f if line.strip()]
+    for eval_case in eval_cases:
+        eval_case['source'] = load_page(eval_case['source'])
+    return eval_cases
+
+
+def clean_page(html: str) -> str:
+    # WebContentsScraper._clean_content()と同じ条件でクリーンする
+    return extract_text_within_token_budget(
+        html_chunks=iter_html_chunks(html),
+        max_tokens=10000,
+        unwanted_tags=["nav", "header", "footer", "script", "style"],
+        tags_to_extract=["div", "span"],
+    )
+
+
+def bigram_recall(reference: str, candidate: str) -> float:
+    # 16kモデルの要約に含まれる文字bi-gramのうち、ローカルの抽出結果にも含まれる割合（両者がどれだけ同じ情報を拾えているかの目安）
+    reference_ngrams = set(make_ngrams(normalize_text(reference), (2,)))
+    if not reference_ngrams:
+        return 1.0
+    return len(reference_ngrams & set(make_ngrams(normalize_text(candidate), (2,)))) / len(reference_ngrams)
+
+
+async def summarize_with_llm(content: str, query: str) -> str:
+    scraper = WebContentsScraper(
+        links=['benchmark'],
+        query=query,
+        callback_handler=None,
+        cancellation_token=CancellationToken(),
+        cache=None,
+        fetcher=None,
+    )
+    return await scraper._summarize_content(content, query)
+
+
+def print_result(name: str, latencies_ms: List[float], output_tokens: List[int], hits: int, total: int):
+    print(f' - {name}: p50={statistics.median(latencies_ms):.1f}ms, max={max(latencies_ms):.1f}ms, '
+          f'avg_output_tokens={statistics.mean(output_tokens):.0f}, expected_text_hit={hits}/{total}')
+
+
+def sweep_min_match_ratio(eval_cases: List[dict], min_match_ratios: List[float]):
+    # min_match_ratioごとに、関連する質問で必要な情報が残った割合と、関係のない質問でLLMに任せた（Noneを返した）割合を表示する
+    contents = [clean_page(eval_case['source']) for eval_case in eval_cases]
+    related = [(content, eval_case) for content, eval_case in zip(contents, eval_cases) if eval_case['expected_text'] is not None]
+    unrelated = [(content, eval_case) for content, eval_case in zip(contents, eval_cases) if eval_case['expected_text'] is None]
+    print(f'related={len(related)}, unrelated={len(unrelated)}')
+    for min_match_ratio in min_match_ratios:
+        extractor = LocalPassageExtractor(min_match_ratio=min_match_ratio)
+        hits = sum(eval_case['expected_text'] in (extractor.extract(content, eval_case['query']) or '') for content, eval_case in related)
+        fallbacks = sum(extractor.extract(content, eval_case['query']) is None for content, eval_case in unrelated)
+        print(f' - min_match_ratio={min_match_ratio:.1f}: expected_text_hit={hits}/{len(related)}, unrelated_fallback={fallbacks}/{len(unrelated)}')
+
+
+async def main(eval_cases: List[dict], use_llm: bool, min_match_ratio: Optional[float] = None):
+    extractor = LocalPassageExtractor() if min_match_ratio is None else LocalPassageExtractor(min_match_ratio=min_match_ratio)
+    # 関係のない質問はLLMでの要約と比べられないので、ローカルで抽出せずにLLMに任せたかどうかだけを数える
+    unrelated_fallbacks = 0
+    unrelated_eval_cases = [eval_case for eval_case in eval_cases if eval_case['expected_text'] is None]
+    for eval_case in unrelated_eval_cases:
+        unrelated_fallbacks += extractor.extract(clean_page(eval_case['source']), eval_case['query']) is None
+    eval_cases = [eval_case for eval_case in eval_cases if eval_case['expected_text'] is not None]
+
+    local_latencies_ms, local_tokens, local_hits = [], [], 0
+    llm_latencies_ms, llm_tokens, llm_hits, recalls = [], [], 0, []
+    for eval_case in eval_cases:
+        content = clean_page(eval_case['source'])
+
+        started_at = time.perf_counter()
+        extracted = extractor.extract(content, eval_case['query']) or ''
+        local_latencies_ms.append((time.perf_counter() - started_at) * 1000)
+        local_tokens.append(count_tokens(extracted, extractor.model_name))
+        local_hits += eval_case['expected_text'] in extracted
+
+        if use_llm:
+            started_at = time.perf_counter()
+            summary = await summarize_with_llm(content, eval_case['query'])
+            llm_latencies_ms.append((time.perf_counter() - started_at) * 1000)
+            llm_tokens.append(count_tokens(summary, extractor.model_name))
+            llm_hits += eval_case['expected_text'] in summary
+            recalls.append(bigram_recall(summary, extracted))
+
+    print(f'eval_cases={len(eval_cases)}')
+    print_result('local', local_latencies_ms, local_tokens, local_hits, len(eval_cases))
+    print(f'   fallbacks={extractor.fallbacks}, unrelated_fallback={unrelated_fallbacks}/{len(unrelated_eval_cases)}')
+    if use_llm:
+        print_result('llm', llm_latencies_ms, llm_tokens, llm_hits, len(eval_cases))
+        print(f' - llm summary bigram recall by local: {statistics.mean(recalls):.3f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('eval_path', nargs='?')
+    parser.add_argument('--llm', action='store_true', help='16kモデルでの要約も実行して比較する（APIの料金がかかる）')
+    parser.add_argument('--min-match-ratio', type=float, help='LocalPassageExtractorのmin_match_ratio（省略した場合は既定値）')
+    parser.add_argument('--sweep', action='store_true', help='min_match_ratioを変えながら抽出結果を比較する')
+    args = parser.parse_args()
+    eval_cases = load_eval_cases(args.eval_path) if args.eval_path else make_synthetic_eval_cases()
+    if args.sweep:
+        sweep_min_match_ratio(eval_cases, min_match_ratios=[0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8])
+    else:
+        asyncio.run(main(eval_cases, args.llm, args.min_match_ratio))
@@ -0,0 +1,70 @@
+# 旧来の同期的なSerper呼び出し（イベントループ上でrequests.postを行う）と、AsyncSerperClientとで、
+# 同時に複数の検索が来た場合の所要時間と、その間のイベントループの停止時間を比較するスクリプト
+# 使い方: python benchmark_serper_client.py [同時検索数] [1回の検索の遅延ミリ秒] [エラー率]
+# （Serperの代わりにローカルの偽サーバーを起動して計測するので、APIキーや通信は不要）
+import asyncio
+import sys
+import time
+
+import requests
+
+from fake_serper_server import start_fake_serper_server
+from google_serper import AsyncSerperClient, CustomGoogleSerper
+
+
+async def measure_event_loop_lag(stop: asyncio.Event, interval_seconds: float = 0.01) -> float:
+    # 一定間隔でsleepし、予定より遅れて起きた時間の最大値をイベントループの停止時間とみなす
+    max_lag = 0.0
+    while not stop.is_set():
+        started_at = time.perf_counter()
+        await asyncio.sleep(interval_seconds)
+        max_lag = max(max_lag, time.perf_counter() - started_at - interval_seconds)
+    return max_lag
+
+
+async def legacy_search(base_url: str, query: str):
+    # 以前のCustomGoogleSerper.runと同じく、async関数の中で同期的にHTTPリクエストを行う
+    response = requests.post(
+        f'{base_url}/search',
+        headers={'X-API-KEY': 'fake', 'Content-Type': 'application/json'},
+        params={'q': query, 'gl': 'jp', 'hl': 'ja', 'num': 3},
+    )
+    response.raise_for_status()
+    return CustomGoogleSerper(serper_api_key='fake')._parse_results(results=response.json())
+
+
+async def measure(search, concurrency: int) -> (float, float):
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(measure_event_loop_lag(stop))
+    await asyncio.sleep(0.05)
+    started_at = time.perf_counter()
+    await asyncio.gather(*[search(f'query {i}') for i in range(concurrency)], return_exceptions=True)
+    elapsed = time.perf_counter() - started_at
+    stop.set()
+    return elapsed, await lag_task
+
+
+async def main(concurrency: int, latency_ms: float, error_rate: float):
+    runner, base_url = await start_fake_serper_server(latency_ms=latency_ms, error_rate=error_rate)
+    client = AsyncSerperClient(api_key='fake', base_url=base_url, backoff_base_seconds=0.05)
+    try:
+        if error_rate == 0:
+            legacy_seconds, legacy_lag = await asyncio.get_running_loop().run_in_executor(
+                None, lambda: asyncio.run(measure(lambda query: legacy_search(base_url, query), concurrency))
+            )
+            print(f' - legacy: {legacy_seconds * 1000:.0f}ms, max event loop lag {legacy_lag * 1000:.0f}ms')
+        async_seconds, async_lag = await measure(lambda query: client.search(query=query), concurrency)
+        print(f' - async : {async_seconds * 1000:.0f}ms, max event loop lag {async_lag * 1000:.0f}ms')
+        print(f' - client: {client.stats()}')
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    concurrency = int(args[0]) if len(args) > 0 else 10
+    latency_ms = float(args[1]) if len(args) > 1 else 300
+    error_rate = float(args[2]) if len(args) > 2 else 0.0
+    print(f'concurrency={concurrency}, latency_ms={latency_ms}, error_rate={error_rate}')
+    asyncio.run(main(concurrency, latency_ms, error_rate))
@@ -0,0 +1,96 @@
+import asyncio
+import time
+from typing import Dict, Optional, Set
+
+
+# クライアント切断などで中断された回答処理によって、どれだけ無駄な処理を省けたかを集計するクラス
+class CancellationStats:
+    def __init__(self):
+        # 中断されたリクエストの数
+        self.cancelled_requests = 0
+        # 中断された時点で実行中だった工程ごとの件数（その工程以降の処理が省かれている）
+        self.interrupted_stages: Dict[str, int] = {}
+        # 途中で打ち切られたWebページのスクレイピング＆要約の数
+        self.skipped_page_summaries = 0
+        # cancel()されてから回答処理のタスクが実際に終了するまでの時間（ミリ秒）
+        self.total_teardown_ms = 0.0
+        self.max_teardown_ms = 0.0
+        self.teardown_count = 0
+
+    def on_cancelled(self, stage: Optional[str]):
+        self.cancelled_requests += 1
+        stage = stage or 'not_started'
+        self.interrupted_stages[stage] = self.interrupted_stages.get(stage, 0) + 1
+
+    def on_page_summary_skipped(self):
+        self.skipped_page_summaries += 1
+
+    def on_teardown(self, elapsed_ms: float):
+        self.teardown_count += 1
+        self.total_teardown_ms += elapsed_ms
+        self.max_teardown_ms = max(self.max_teardown_ms, elapsed_ms)
+
+    def to_dict(self) -> dict:
+        return {
+            'cancelled_requests': self.cancelled_requests,
+            'interrupted_stages': dict(self.interrupted_stages),
+            'skipped_page_summaries': self.skipped_page_summaries,
+            'avg_teardown_ms': self.total_teardown_ms / self.teardown_count if self.teardown_count else 0.0,
+            'max_teardown_ms': self.max_teardown_ms,
+        }
+
+
+# プロセス全体で共有する集計値
+cancellation_stats = CancellationStats()
+
+
+# 1リクエスト分の回答処理を協調的に中断させるためのトークン
+# ChatAssistant → Function → Serper検索 → スクレイピングへと受け渡していき、各工程の開始前に中断されていないかを確認する
+class CancellationToken:
+    def __init__(self):
+        self._is_cancelled = False
+        self._cancelled_at: Optional[float] = None
+        # 現在実行中の工程名（集計用）
+        self._stage: Optional[str] = None
+        # cancel()時にまとめて中断させるタスク
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self._is_cancelled
+
+    def bind(self, task: asyncio.Task):
+        # cancel()された時に一緒に中断させたいタスクを登録する
+        self._tasks.add(task)
+        task.add_done_callback(self._on_task_done)
+
+    def track(self, task: asyncio.Task):
+        # cancel()時に一緒に中断させたい補助的なタスクを登録する（終了までの時間は集計しない）
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def enter_stage(self, stage: str):
+        # 新しい工程に入る前に中断されていないかを確認し、どこまで進んだかを記録しておく
+        self.raise_if_cancelled()
+        self._stage = stage
+
+    def raise_if_cancelled(self):
+        if self._is_cancelled:
+            raise asyncio.CancelledError()
+
+    def cancel(self):
+        if self._is_cancelled:
+            return
+        self._is_cancelled = True
+        self._cancelled_at = time.perf_counter()
+        cancellation_stats.on_cancelled(stage=self._stage)
+        # 実行中のタスクを中断させる（await中のOpenAIやaiohttpの通信もここで打ち切られる）
+        for task in self._tasks:
+            if not task.done():
+                task.cancel()
+
+    def _on_task_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if self._cancelled_at is not None:
+            elapsed_ms = (time.perf_counter() - self._cancelled_at) * 1000
+            cancellation_stats.on_teardown(elapsed_ms=elapsed_ms)
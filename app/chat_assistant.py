@@ -1,33 +1,45 @@
 import openai
 import json
 import re
-import asyncio
 
 from typing import List, Optional
 
 from langchain.vectorstores import VectorStore
 
 from env import Env
-from assistant_function import AssistantFunctionType, parse_function_type_from_string
+from assistant_function import FUNCTION_INFO_TABLE, AssistantFunctionType, get_function_infos, parse_function_type_from_string
 from callback_handler import CallbackHandler
+from cancellation import CancellationToken
+from context_packer import ContextPacker, PackedContext, count_tokens, token_usage_stats
+from conversation_state import ConversationState
+from speculative_index_search import SpeculativeIndexSearch
 from data_models import SendQuestionRequest
+from index_retriever import RetrievalSettings
+from structured_logging import get_logger
 
 
 # pythonのOpenAIラッパーライブラリに環境変数からAPIキーをセットする
 openai.api_key = Env.OPENAI_API_KEY
 
+logger = get_logger(__name__)
+
 class ChatAssistant():
     callback_handler: CallbackHandler
+    cancellation_token: CancellationToken
     sendQuestionRequest: SendQuestionRequest
     vector_store: VectorStore
+    retrieval_settings: RetrievalSettings
     model_name: str
     temperature: int
-    functions = []
-    messages = []
+    history_messages: Optional[List[dict]]
+    speculative_index_search: Optional[SpeculativeIndexSearch]
+    state: ConversationState
+    context_packer: ContextPacker
 
     def __init__(
             self,
             callback_handler: CallbackHandler,
+            cancellation_token: CancellationToken,
             sendQuestionRequest: SendQuestionRequest,
             vector_store: VectorStore,
             model_name: str,
@@ -35,146 +47,181 @@ class ChatAssistant():
             use_latest_information: bool,
             is_enabled_web_and_index_data_integrated_mode: bool,
             system_role_prompt_text: Optional[str] = None,
+            history_messages: Optional[List[dict]] = None,
+            is_enabled_speculative_index_search: bool = False,
+            retrieval_settings: Optional[RetrievalSettings] = None,
         ):
         self.callback_handler = callback_handler
+        self.cancellation_token = cancellation_token
         self.sendQuestionRequest = sendQuestionRequest
         self.vector_store = vector_store
+        # 組織内データ検索のパラメータ（カテゴリごとの設定。指定が無い場合は既定値）
+        self.retrieval_settings = retrieval_settings or RetrievalSettings()
         self.model_name = model_name
         self.temperature = temperature
-        self.functions.clear()
-        self.messages.clear()
-
-        # 内部情報検索用のfunction情報を配列に追加する
-        self.functions.append(AssistantFunctionType.Search_On_Index_Data.get_function_info())
+        # サーバー側で保持している会話履歴がある場合はそれを使い、無い場合はリクエストのprevious_messagesから作る
+        self.history_messages = history_messages
+
+        # 会話の文脈はリクエスト毎に別のインスタンスで持つ（functionの情報は共有の不変なものを参照する）
+        self.state = ConversationState(
+            functions=get_function_infos(
+                use_latest_information=use_latest_information,
+                is_enabled_web_and_index_data_integrated_mode=is_enabled_web_and_index_data_integrated_mode,
+            ),
+            system_role_prompt_text=system_role_prompt_text,
+        )
+        
+        # 組織内データ検索が使える場合は、1回目のChatCompletionと同時に元の質問で検索を始めておける様にする
+        self.speculative_index_search = None
+        if is_enabled_speculative_index_search \
+                and FUNCTION_INFO_TABLE[AssistantFunctionType.Search_On_Index_Data] in self.state.functions:
+            self.speculative_index_search = SpeculativeIndexSearch(
+                vector_store=vector_store,
+                retrieval_settings=self.retrieval_settings,
+                question=sendQuestionRequest.text,
+                category_id=sendQuestionRequest.category_id,
+            )
 
-        # 受け取ったパラメータに合わせてfunctionの情報を配列に追加する
-        if use_latest_information:
-            self.functions.append(AssistantFunctionType.Search_On_Web.get_function_info())
+        # モデルのコンテキスト長に収まる様に、送信する文脈情報を詰めるためのクラス
+        self.context_packer = ContextPacker(model_name=model_name)
 
-        if is_enabled_web_and_index_data_integrated_mode:
-            self.functions.clear() # 他のfunctionを消して統合検索だけにする
-            self.functions.append(AssistantFunctionType.Search_On_Web_And_Index_Data.get_function_info())
+        logger.debug('functions', functions=self.state.functions)
         
-        # もしsystem_role_prompt_textがあった場合は1番目のmessageとして挿入しておく
-        if system_role_prompt_text:
-            print(f'system_role_prompt_textがある:\n{system_role_prompt_text}')
-            self.messages.append({
-                "role": "system",
-                "content": system_role_prompt_text
-            })
         
-        print(f'functions: {self.functions}')
-        
-        
-    def get_answer(self):
+    async def get_answer(self):
         # 会話履歴を文脈に追加する
-        previous_messages = self._make_history(previous_messages=self.sendQuestionRequest.previous_messages)
-        self.messages.extend(previous_messages)
-        print(f'get_answer previous_messagesを追加した後: {self.messages}')
+        if self.history_messages is not None:
+            previous_messages = self.history_messages
+        else:
+            previous_messages = self._make_history(previous_messages=self.sendQuestionRequest.previous_messages)
+        self.state.extend_history(previous_messages)
+        # 会話履歴の中身は大きいのでDEBUGの場合だけ出力する
+        logger.info('get_answer previous_messagesを追加した後', message_count=len(self.state.messages))
+        logger.debug('get_answer previous_messagesを追加した後', messages=self.state.messages)
 
         # ユーザーからの入力を文脈に格納する
-        self.messages.append({
+        self.state.append({
             "role": "user",
             "content": self.sendQuestionRequest.text
         })
 
-        # 暫定対応 もっと良いやり方があれば直したい
-        # （リクエスト箇所でfunctionsを使わない場合、空配列もNoneもNGで、キー自体を落とさないといけないのでやむなく分岐している）
-        if self.functions:
-            # 1回目のリクエストを送信（functionsあり）
-            streamed_response = openai.ChatCompletion.create(
-                model=self.model_name,
-                # 回答のランダム性（0から1の範囲で設定可能）
-                temperature=self.temperature,
-                # 文脈情報を渡す（[system_roleでのプロンプト指示（任意）, これまでの会話, 今回のユーザー入力]）
-                messages=self.messages,
-                # 呼び出し可能なfunctionsとして受け渡す
-                functions=self.functions,
-                # autoの場合、「functionが必要かどうか、どのfunctionが必要か」をGPTが自動で判断する設定を適用
-                function_call='auto',
-                stream=True,
-            )
-        else:
-            # 1回目のリクエストを送信（functionsなし）
-            streamed_response = openai.ChatCompletion.create(
-                model=self.model_name,
-                # 回答のランダム性（0から1の範囲で設定可能）
-                temperature=self.temperature,
-                # 文脈情報を渡す（[system_roleでのプロンプト指示（任意）, これまでの会話, 今回のユーザー入力]）
-                messages=self.messages,
-                stream=True,
-            )
-
-        collected_messages = []
-        is_function_call = False
-        function_type: AssistantFunctionType = None
-
-        # Streamのレスポンスを順番に処理する
-        for chunk in streamed_response:
-            # 断片として受け取ったオブジェクトを取り出して配列に格納（最終回答もしくは呼びたいfunctionの情報などが断片で送られてくる）
-            chunk_message = chunk['choices'][0]['delta']
-            collected_messages.append(chunk_message)
-
-            # functionの呼び出しを要求しているレスポンスの場合
-            if (function_call_object := chunk_message.get('function_call')) is not None:
-                # function自体の実行は引数の入力値を全て受け取った後なので、後でfunction_callかどうか判定できる様にフラグをTrueにしておく
-                is_function_call = True
-                if not function_type:
-                    # GPTから実行を要求されたfunctionがどれかわかる様に保持しておく
-                    function_type = parse_function_type_from_string(function_name=function_call_object.get('name'))
-                    # function_callが選ばれた時点でアプリに処理工程を表示するためにcallbackを呼ぶ。「外部データを検索」「自社データから検索」など
-                    self.callback_handler.on_function_selected(action_prefix=function_type.action_prefix)
-
-                # 「〜を検索」の後に続いて「検索する内容」をstreamでアプリに表示するためにcallbackを呼ぶ
-                self.callback_handler.on_part_of_function_input_generated(text=function_call_object.get('arguments'))
-
-            # 通常の返答レスポンスの場合
+        self.cancellation_token.enter_stage('first_completion')
+        # トークン数の上限を超えない様に、古い会話履歴などを削った文脈情報を作る
+        packed_context = self.context_packer.pack(self.state, use_functions=bool(self.state.functions))
+
+        # GPTがfunctionを選ぶのを待たずに、元の質問で組織内データ検索を始めておく
+        if self.speculative_index_search is not None:
+            self.speculative_index_search.start(cancellation_token=self.cancellation_token)
+
+        try:
+            # 暫定対応 もっと良いやり方があれば直したい
+            # （リクエスト箇所でfunctionsを使わない場合、空配列もNoneもNGで、キー自体を落とさないといけないのでやむなく分岐している）
+            if self.state.functions:
+                # 1回目のリクエストを送信（functionsあり）
+                # イベントループを止めない様にacreate()（async createのこと）の方のメソッドを使用している
+                streamed_response = await openai.ChatCompletion.acreate(
+                    model=self.model_name,
+                    # 回答のランダム性（0から1の範囲で設定可能）
+                    temperature=self.temperature,
+                    # 文脈情報を渡す（[system_roleでのプロンプト指示（任意）, これまでの会話, 今回のユーザー入力]）
+                    messages=packed_context.messages,
+                    # 呼び出し可能なfunctionsとして受け渡す
+                    functions=self.state.functions,
+                    # autoの場合、「functionが必要かどうか、どのfunctionが必要か」をGPTが自動で判断する設定を適用
+                    function_call='auto',
+                    stream=True,
+                )
             else:
-                # function_callじゃない場合はそれが最終回答になるので、streamでアプリに表示するためにcallbackを呼ぶ
-                if (content := chunk_message.get('content')) is not None:
-                    self.callback_handler.on_part_of_answer_generated(text=content)
-
-        # function_callが呼ばれている場合
-        if is_function_call:
-            # アプリにアクション情報の出力が完了したことを通知
-            self.callback_handler.on_function_input_generation_completed()
-
-            # function_callの情報のjsonが断片で送られてくるため、arguments部分を配列から取り出してjson形式の文字列に戻す
-            full_reply_arguments_text = ''.join([chunk_message.get('function_call', {}).get('arguments', '') for chunk_message in collected_messages])
-            print(f"get_answer function_callの場合 すべてのレスポンスを受け取った:\n - full_reply_arguments_text: {full_reply_arguments_text}")
-
-            completion_message = {
-                "role": "assistant",
-                "content": None,
-                "function_call": {
-                    "arguments": full_reply_arguments_text,
-                    "name": function_type.value
+                # 1回目のリクエストを送信（functionsなし）
+                streamed_response = await openai.ChatCompletion.acreate(
+                    model=self.model_name,
+                    # 回答のランダム性（0から1の範囲で設定可能）
+                    temperature=self.temperature,
+                    # 文脈情報を渡す（[system_roleでのプロンプト指示（任意）, これまでの会話, 今回のユーザー入力]）
+                    messages=packed_context.messages,
+                    stream=True,
+                )
+
+            collected_messages = []
+            is_function_call = False
+            function_type: AssistantFunctionType = None
+
+            # Streamのレスポンスを順番に処理する
+            async for chunk in streamed_response:
+                # 断片として受け取ったオブジェクトを取り出して配列に格納（最終回答もしくは呼びたいfunctionの情報などが断片で送られてくる）
+                chunk_message = chunk['choices'][0]['delta']
+                collected_messages.append(chunk_message)
+
+                # functionの呼び出しを要求しているレスポンスの場合
+                if (function_call_object := chunk_message.get('function_call')) is not None:
+                    # function自体の実行は引数の入力値を全て受け取った後なので、後でfunction_callかどうか判定できる様にフラグをTrueにしておく
+                    is_function_call = True
+                    if not function_type:
+                        # GPTから実行を要求されたfunctionがどれかわかる様に保持しておく
+                        function_type = parse_function_type_from_string(function_name=function_call_object.get('name'))
+                        # function_callが選ばれた時点でアプリに処理工程を表示するためにcallbackを呼ぶ。「外部データを検索」「自社データから検索」など
+                        self.callback_handler.on_function_selected(action_prefix=function_type.action_prefix)
+
+                    # 「〜を検索」の後に続いて「検索する内容」をstreamでアプリに表示するためにcallbackを呼ぶ
+                    self.callback_handler.on_part_of_function_input_generated(text=function_call_object.get('arguments'))
+
+                # 通常の返答レスポンスの場合
+                else:
+                    # function_callじゃない場合はそれが最終回答になるので、streamでアプリに表示するためにcallbackを呼ぶ
+                    if (content := chunk_message.get('content')) is not None:
+                        self.callback_handler.on_part_of_answer_generated(text=content)
+
+            # 組織内データ検索が選ばれなかった場合は、投機的に始めておいた検索は不要なので止める
+            if self.speculative_index_search is not None and function_type != AssistantFunctionType.Search_On_Index_Data:
+                self.speculative_index_search.discard()
+
+            # function_callが呼ばれている場合
+            if is_function_call:
+                # アプリにアクション情報の出力が完了したことを通知
+                self.callback_handler.on_function_input_generation_completed()
+
+                # function_callの情報のjsonが断片で送られてくるため、arguments部分を配列から取り出してjson形式の文字列に戻す
+                full_reply_arguments_text = ''.join([chunk_message.get('function_call', {}).get('arguments', '') for chunk_message in collected_messages])
+                logger.info('get_answer function_callの場合 すべてのレスポンスを受け取った', function_name=function_type.value, arguments_chars=len(full_reply_arguments_text))
+                logger.debug('get_answer function_callの場合 すべてのレスポンスを受け取った', full_reply_arguments_text=full_reply_arguments_text)
+                self._record_token_usage(packed_context=packed_context, completion_text=full_reply_arguments_text)
+
+                completion_message = {
+                    "role": "assistant",
+                    "content": None,
+                    "function_call": {
+                        "arguments": full_reply_arguments_text,
+                        "name": function_type.value
+                    }
                 }
-            }
 
-            # assistantからの返答を文脈に追加
-            self.messages.append(completion_message)
+                # assistantからの返答を文脈に追加
+                self.state.append(completion_message)
 
-            # 選択されたfunctionの処理の実行を委託し、得られた参考情報を含んだ文脈情報を元に当初のユーザーからの入力に対して再度応答させる
-            asyncio.run(
-                self._get_second_answer(
+                # 選択されたfunctionの処理の実行を委託し、得られた参考情報を含んだ文脈情報を元に当初のユーザーからの入力に対して再度応答させる
+                await self._get_second_answer(
                     selected_function_type=function_type,
                     full_reply_arguments_text=full_reply_arguments_text
                 )
-            )
             
-        else:
-            # 返答が断片で送られてくるため、配列から取り出して連結した文字列に戻す
-            full_reply_content = ''.join([chunk_message.get('content', '') for chunk_message in collected_messages])
-            print(f"get_answer function_callじゃない場合 すべてのレスポンスを受け取った:\n - full_reply_content: {full_reply_content}")
+            else:
+                # 返答が断片で送られてくるため、配列から取り出して連結した文字列に戻す
+                full_reply_content = ''.join([chunk_message.get('content', '') for chunk_message in collected_messages])
+                logger.info('get_answer function_callじゃない場合 すべてのレスポンスを受け取った', content_chars=len(full_reply_content))
+                logger.debug('get_answer function_callじゃない場合 すべてのレスポンスを受け取った', full_reply_content=full_reply_content)
+                self._record_token_usage(packed_context=packed_context, completion_text=full_reply_content)
 
-            completion_message = {
-                "role": "assistant",
-                "content": full_reply_content,
-            }
+                completion_message = {
+                    "role": "assistant",
+                    "content": full_reply_content,
+                }
 
-            # assistantからの返答を文脈に追加
-            self.messages.append(completion_message)
+                # assistantからの返答を文脈に追加
+                self.state.append(completion_message)
+        finally:
+            # 1回目の応答や選ばれたfunctionの処理が失敗・中断した場合も、使われなかった投機的な検索を残さない（使った場合は何もしない）
+            if self.speculative_index_search is not None:
+                self.speculative_index_search.discard()
 
 
     # function_callが要求された場合に最終回答を生成させるために使う
@@ -184,28 +231,32 @@ class ChatAssistant():
             full_reply_arguments_text: str
         ):
         # 選択されたFunctionの処理を実行し、結果の文字列を取得
+        self.cancellation_token.enter_stage(selected_function_type.value)
         function_response_text = await self._execute_selected_function(
             function_type=selected_function_type,
             full_reply_arguments_text=full_reply_arguments_text
         )
 
         # functionの結果として得られた参考情報を文脈に追加
-        self.messages.append({
+        self.state.append({
             "role": "function",
             "name": selected_function_type.value,
             "content": function_response_text,
         })
 
-        streamed_second_response = openai.ChatCompletion.create(
+        self.cancellation_token.enter_stage('second_completion')
+        # functionの結果が長すぎる場合は、ここで切り詰められる
+        packed_context = self.context_packer.pack(self.state, use_functions=False)
+        streamed_second_response = await openai.ChatCompletion.acreate(
             model=self.model_name,
             temperature=self.temperature,
             # 文脈情報を渡す（[system_roleでのプロンプト指示（任意）, これまでの会話, 今回のユーザー入力, function_call情報, functionによって取得された参考情報]）
-            messages=self.messages,
+            messages=packed_context.messages,
             stream=True,
         )
 
         collected_messages = []
-        for chunk in streamed_second_response:
+        async for chunk in streamed_second_response:
             chunk_message = chunk['choices'][0]['delta']
             collected_messages.append(chunk_message)
             # streamでアプリに表示するためにcallbackを呼ぶ
@@ -214,14 +265,16 @@ class ChatAssistant():
 
         # 返答が断片で送られてくるため、配列から取り出して連結した文字列に戻す
         full_reply_content = ''.join([chunk_message.get('content', '') for chunk_message in collected_messages])
-        print(f"_get_second_answer すべてのレスポンスを受け取った:\n - full_reply_content: {full_reply_content}")
+        logger.info('_get_second_answer すべてのレスポンスを受け取った', content_chars=len(full_reply_content))
+        logger.debug('_get_second_answer すべてのレスポンスを受け取った', full_reply_content=full_reply_content)
+        self._record_token_usage(packed_context=packed_context, completion_text=full_reply_content)
 
         completion_message = {
             "role": "assistant",
             "content": full_reply_content,
         }
         # assistantからの返答を文脈に追加
-        self.messages.append(completion_message)
+        self.state.append(completion_message)
     
 
     async def _execute_selected_function(
@@ -237,8 +290,9 @@ class ChatAssistant():
             function_response = await AssistantFunctionType.Search_On_Web(
                 query=arguments.get('query'),
                 callback_handler=self.callback_handler,
+                cancellation_token=self.cancellation_token,
             )
-            print(f'function_response: {function_response}')
+            logger.debug('function_response', function_response=function_response)
             source_url_list = function_response[0]
             # 検索結果のURLリストを参考文献としてアプリに表示するためにcallbackを呼ぶ
             self.callback_handler.on_source_url_list_extracted(source_url_list)
@@ -247,10 +301,16 @@ class ChatAssistant():
         # 組織内データ検索の場合
         elif function_type == AssistantFunctionType.Search_On_Index_Data:
             # GPTから文脈を踏まえた上で引数として渡された検索クエリを元に組織内データ検索結果を取得する
-            function_response_text = AssistantFunctionType.Search_On_Index_Data(
-                query=arguments.get('query'),
-                vector_store=self.vector_store,
-            )
+            # （クエリが元の質問と近ければ、投機的に始めておいた検索結果をそのまま使う）
+            function_response_text = None
+            if self.speculative_index_search is not None:
+                function_response_text = await self.speculative_index_search.take(query=arguments.get('query'))
+            if function_response_text is None:
+                function_response_text = await AssistantFunctionType.Search_On_Index_Data(
+                    query=arguments.get('query'),
+                    vector_store=self.vector_store,
+                    retrieval_settings=self.retrieval_settings,
+                )
         
         # 組織内外データ統合検索の場合
         elif function_type == AssistantFunctionType.Search_On_Web_And_Index_Data:
@@ -259,9 +319,11 @@ class ChatAssistant():
                 index_data_search_query=arguments.get('index_data_search_query', ''),
                 web_search_query=arguments.get('web_search_query', ''),
                 vector_store=self.vector_store,
+                retrieval_settings=self.retrieval_settings,
                 callback_handler=self.callback_handler,
+                cancellation_token=self.cancellation_token,
             )
-            print(f'function_response: {function_response}')
+            logger.debug('function_response', function_response=function_response)
             source_url_list = function_response[0]
             # 検索結果のURLリストを参考文献としてアプリに表示するためにcallbackを呼ぶ
             self.callback_handler.on_source_url_list_extracted(source_url_list)
@@ -271,6 +333,20 @@ class ChatAssistant():
         return function_response_text
 
 
+    def _record_token_usage(
+            self,
+            packed_context: PackedContext,
+            completion_text: str,
+        ):
+        token_usage_stats.record(
+            model_name=self.model_name,
+            prompt_tokens=packed_context.prompt_tokens,
+            completion_tokens=count_tokens(completion_text, self.model_name),
+            dropped_history_messages=packed_context.dropped_history_messages,
+            truncated_messages=packed_context.truncated_messages,
+        )
+
+
     def _make_history(self, previous_messages: List[str]):
         histories = []
         for message in previous_messages:
@@ -0,0 +1,218 @@
+import json
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence
+
+import tiktoken
+
+from conversation_state import ConversationState
+from structured_logging import get_logger
+
+
+logger = get_logger(__name__)
+
+
+# モデルごとのコンテキスト長（トークン数）
+MODEL_CONTEXT_TOKENS: Dict[str, int] = {
+    'gpt-4o-mini': 128000,
+    'gpt-4o': 128000,
+    'gpt-4': 8192,
+    'gpt-3.5-turbo': 4096,
+    'gpt-3.5-turbo-16k': 16384,
+}
+# 一覧に無いモデルの場合のコンテキスト長
+DEFAULT_CONTEXT_TOKENS = 4096
+
+
+# tokenizerの生成は重いので、モデルごとにプロセス全体で1つだけ生成して使い回す
+@lru_cache(maxsize=None)
+def get_encoding(model_name: str) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        # tiktokenが知らない新しいモデルの場合は、chat系モデル共通のエンコーディングで数える
+        return tiktoken.get_encoding('cl100k_base')
+
+
+def count_tokens(text: str, model_name: str) -> int:
+    return len(get_encoding(model_name).encode(text))
+
+
+def count_message_tokens(messages: Sequence[dict], model_name: str) -> int:
+    # OpenAIのドキュメントにある数え方に合わせて、1messageごとの区切りのトークンも加算する
+    encoding = get_encoding(model_name)
+    token_count = 3  # 返答の先頭に付与される分
+    for message in messages:
+        token_count += 3
+        for key, value in message.items():
+            if value is None:
+                continue
+            if isinstance(value, dict):
+                value = json.dumps(value, ensure_ascii=False)
+            token_count += len(encoding.encode(value))
+            if key == 'name':
+                token_count += 1
+    return token_count
+
+
+@lru_cache(maxsize=None)
+def _count_serialized_function_tokens(serialized_functions: str, model_name: str) -> int:
+    return count_tokens(serialized_functions, model_name)
+
+
+def count_function_tokens(functions: Sequence[dict], model_name: str) -> int:
+    # functionsの情報は毎回同じなので、シリアライズした文字列ごとに結果をキャッシュしておく
+    if not functions:
+        return 0
+    return _count_serialized_function_tokens(json.dumps(list(functions), ensure_ascii=False), model_name)
+
+
+# ChatCompletionに送る文脈情報
+class PackedContext:
+    messages: List[dict]
+    prompt_tokens: int
+    budget_tokens: int
+    # トークン数の上限に収めるために削除した会話履歴の数
+    dropped_history_messages: int
+    # トークン数の上限に収めるために途中で切り詰めたmessageの数
+    truncated_messages: int
+
+    def __init__(
+        self,
+        messages: List[dict],
+        prompt_tokens: int,
+        budget_tokens: int,
+        dropped_history_messages: int,
+        truncated_messages: int,
+    ):
+        self.messages = messages
+        self.prompt_tokens = prompt_tokens
+        self.budget_tokens = budget_tokens
+        self.dropped_history_messages = dropped_history_messages
+        self.truncated_messages = truncated_messages
+
+
+# systemのプロンプト指示、会話履歴、functionsの情報、検索・スクレイピング結果を、モデルのコンテキスト長に収まる様に詰めるクラス
+# 優先度: systemのプロンプト指示・今回の質問（削らない） > functionの結果（長すぎる場合は末尾を切り詰める） > 会話履歴（古いものから削る）
+class ContextPacker:
+    def __init__(
+        self,
+        model_name: str,
+        # 回答の生成用に空けておくトークン数
+        reserved_completion_tokens: int = 1000,
+        max_context_tokens: Optional[int] = None,
+    ):
+        self.model_name = model_name
+        self.reserved_completion_tokens = reserved_completion_tokens
+        self.max_context_tokens = max_context_tokens or MODEL_CONTEXT_TOKENS.get(model_name, DEFAULT_CONTEXT_TOKENS)
+
+    def pack(
+        self,
+        state: ConversationState,
+        use_functions: bool = True,
+    ) -> PackedContext:
+        function_tokens = count_function_tokens(state.functions, self.model_name) if use_functions else 0
+        budget_tokens = self.max_context_tokens - self.reserved_completion_tokens - function_tokens
+
+        leading_messages = state.leading_messages
+        current_turn_messages = state.current_turn_messages
+        truncated_messages = 0
+
+        # まずは削れないmessageだけで上限に収まるかを確認し、超える場合はfunctionの結果を切り詰める
+        fixed_tokens = count_message_tokens(leading_messages + current_turn_messages, self.model_name)
+        if fixed_tokens > budget_tokens:
+            current_turn_messages, truncated_messages = self._truncate_function_results(
+                current_turn_messages, overflow_tokens=fixed_tokens - budget_tokens
+            )
+            fixed_tokens = count_message_tokens(leading_messages + current_turn_messages, self.model_name)
+
+        # 残りのトークン数で、新しい会話履歴から順に入るだけ入れる
+        history_messages = state.history_messages
+        remaining_tokens = budget_tokens - fixed_tokens
+        kept_history: List[dict] = []
+        for message in reversed(history_messages):
+            message_tokens = count_message_tokens([message], self.model_name) - 3
+            if message_tokens > remaining_tokens:
+                break
+            kept_history.append(message)
+            remaining_tokens -= message_tokens
+        kept_history.reverse()
+
+        messages = leading_messages + kept_history + current_turn_messages
+        return PackedContext(
+            messages=messages,
+            prompt_tokens=count_message_tokens(messages, self.model_name) + function_tokens,
+            budget_tokens=budget_tokens,
+            dropped_history_messages=len(history_messages) - len(kept_history),
+            truncated_messages=truncated_messages,
+        )
+
+    def _truncate_function_results(
+        self,
+        messages: List[dict],
+        overflow_tokens: int,
+    ) -> (List[dict], int):
+        encoding = get_encoding(self.model_name)
+        truncated_messages = 0
+        packed_messages = list(messages)
+        # 長いものから順に切り詰める
+        function_result_indices = sorted(
+            [index for index, message in enumerate(messages) if message.get('role') == 'function' and message.get('content')],
+            key=lambda index: len(messages[index]['content']),
+            reverse=True,
+        )
+        for index in function_result_indices:
+            if overflow_tokens <= 0:
+                break
+            tokens = encoding.encode(messages[index]['content'])
+            keep_tokens = max(len(tokens) - overflow_tokens, 0)
+            packed_messages[index] = {
+                **messages[index],
+                'content': encoding.decode(tokens[:keep_tokens]),
+            }
+            overflow_tokens -= len(tokens) - keep_tokens
+            truncated_messages += 1
+        return packed_messages, truncated_messages
+
+
+# 全ChatCompletionのトークン数を集計するクラス
+class TokenUsageStats:
+    def __init__(self):
+        self.models: Dict[str, dict] = {}
+
+    def record(
+        self,
+        model_name: str,
+        prompt_tokens: int,
+        completion_tokens: int,
+        dropped_history_messages: int = 0,
+        truncated_messages: int = 0,
+    ):
+        usage = self.models.setdefault(model_name, {
+            'completions': 0,
+            'prompt_tokens': 0,
+            'completion_tokens': 0,
+            'max_prompt_tokens': 0,
+            'dropped_history_messages': 0,
+            'truncated_messages': 0,
+        })
+        usage['completions'] += 1
+        usage['prompt_tokens'] += prompt_tokens
+        usage['completion_tokens'] += completion_tokens
+        usage['max_prompt_tokens'] = max(usage['max_prompt_tokens'], prompt_tokens)
+        usage['dropped_history_messages'] += dropped_history_messages
+        usage['truncated_messages'] += truncated_messages
+        logger.info(
+            'token usage',
+            model=model_name,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            dropped_history_messages=dropped_history_messages,
+            truncated_messages=truncated_messages,
+        )
+
+    def stats(self) -> dict:
+        return {model_name: dict(usage) for model_name, usage in self.models.items()}
+
+
+# プロセス全体で共有する集計値
+token_usage_stats = TokenUsageStats()
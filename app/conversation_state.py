@@ -0,0 +1,62 @@
+from typing import Iterable, List, Optional, Tuple
+
+
+# 1リクエスト分の会話の文脈（ChatCompletionに渡すmessagesとfunctions）を保持するクラス
+# 以前はChatAssistantのクラス変数を全リクエストで共有していたため、並列に処理すると文脈が混ざってしまっていた
+class ConversationState:
+    # リクエスト毎に生成されるので、インスタンス辞書を持たせずに軽量にしている
+    __slots__ = ('functions', '_messages', '_history_start', '_history_end')
+
+    # 使用可能なfunctionの情報（共有の不変なタプルをそのまま参照する）
+    functions: Tuple[dict, ...]
+    _messages: List[dict]
+    # 会話履歴（過去のやり取り）が_messagesのどこからどこまでかを覚えておく（トークン数の上限に合わせて古い履歴から削るため）
+    _history_start: int
+    _history_end: int
+
+    def __init__(
+        self,
+        functions: Tuple[dict, ...],
+        system_role_prompt_text: Optional[str] = None,
+    ):
+        self.functions = functions
+        self._messages = []
+
+        # もしsystem_role_prompt_textがあった場合は1番目のmessageとして挿入しておく
+        if system_role_prompt_text:
+            self._messages.append({
+                "role": "system",
+                "content": system_role_prompt_text
+            })
+        self._history_start = self._history_end = len(self._messages)
+
+    @property
+    def messages(self) -> List[dict]:
+        # ChatCompletionにそのまま渡す用。追加はappend()/extend()からのみ行い、既存のmessageは書き換えない
+        return self._messages
+
+    def append(self, message: dict):
+        self._messages.append(message)
+
+    def extend(self, messages: Iterable[dict]):
+        self._messages.extend(messages)
+
+    def extend_history(self, messages: Iterable[dict]):
+        # 会話履歴はsystemのmessageの直後、今回の質問より前に1度だけ追加する
+        self._history_start = len(self._messages)
+        self._messages.extend(messages)
+        self._history_end = len(self._messages)
+
+    @property
+    def leading_messages(self) -> List[dict]:
+        # 会話履歴より前のmessage（systemでのプロンプト指示）
+        return self._messages[:self._history_start]
+
+    @property
+    def history_messages(self) -> List[dict]:
+        return self._messages[self._history_start:self._history_end]
+
+    @property
+    def current_turn_messages(self) -> List[dict]:
+        # 今回のユーザー入力以降のmessage（function_callの情報、functionの結果など）
+        return self._messages[self._history_end:]
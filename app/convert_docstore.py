@@ -0,0 +1,104 @@
+# 既存のインデックスのindex.pkl（pickleしたInMemoryDocstore）を、mmapで読み込める形式（docstore.bin + docstore_offsets.npy）に変換するスクリプト
+# 変換後に、両方の形式で読み込んだ時の時間とメモリの増加量を、それぞれ別プロセスで計って比較する
+# 使い方: python convert_docstore.py [インデックスのディレクトリ ...] [--remove-pickle]
+# （ディレクトリを省略した場合は ./faiss_index 以下の全インデックスを変換する）
+# 大きなコーパスでの差を見たい場合: python convert_docstore.py --synthetic 50000
+import argparse
+import glob
+import multiprocessing
+import os
+import pickle
+import tempfile
+import time
+import uuid
+
+from langchain.docstore.document import Document
+from langchain.docstore.in_memory import InMemoryDocstore
+
+from mmap_docstore import MmapDocstore, PositionalIdMap
+
+
+def convert(directory: str):
+    with open(os.path.join(directory, 'index.pkl'), 'rb') as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    # FAISSのインデックス上の位置の順に並べ直して書き出す（変換後は位置がそのままdocstoreのIDになる）
+    documents = []
+    for position in range(len(index_to_docstore_id)):
+        document = docstore.search(index_to_docstore_id[position])
+        if not isinstance(document, Document):
+            raise ValueError(f'{directory}: position={position} のドキュメントが見つかりません')
+        documents.append(document)
+    MmapDocstore.write(directory, documents)
+    # 変換前と同じ内容が読み出せることを確認する
+    converted = MmapDocstore(directory)
+    for position, document in enumerate(documents):
+        converted_document = converted.search(position)
+        if converted_document.page_content != document.page_content or converted_document.metadata != document.metadata:
+            raise ValueError(f'{directory}: position={position} の内容が一致しません')
+
+
+def _get_rss_bytes() -> int:
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def _measure_load(directory: str, docstore_format: str) -> (float, int):
+    # 別プロセスで呼ばれる。読み込みと、検索1回分（先頭のドキュメントの取り出し）にかかった時間とメモリの増加量を返す
+    rss_before = _get_rss_bytes()
+    started_at = time.perf_counter()
+    if docstore_format == 'pickle':
+        with open(os.path.join(directory, 'index.pkl'), 'rb') as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+    else:
+        docstore = MmapDocstore(directory)
+        index_to_docstore_id = PositionalIdMap(len(docstore))
+    docstore.search(index_to_docstore_id[0])
+    return (time.perf_counter() - started_at) * 1000, _get_rss_bytes() - rss_before
+
+
+def compare(directory: str):
+    # 同じプロセスで続けて読み込むとメモリの増加量が正しく計れないので、毎回新しいプロセスで計る
+    context = multiprocessing.get_context('spawn')
+    for docstore_format in ('pickle', 'mmap'):
+        with context.Pool(1) as pool:
+            load_ms, rss_delta = pool.apply(_measure_load, (directory, docstore_format))
+        print(f' - {docstore_format}: load={load_ms:.1f}ms, rss_delta={rss_delta / 1024:.0f}KB')
+
+
+def write_synthetic_pickle(directory: str, count: int):
+    # 職務経歴書のチャンクと同じくらいの長さの疑似的なドキュメントで、index.pklを作る
+    index_to_docstore_id = {position: str(uuid.uuid4()) for position in range(count)}
+    docstore = InMemoryDocstore({
+        docstore_id: Document(
+            page_content=f'{position}番目のチャンクです。' + 'ウルトラ深瀬はiOSエンジニアとして東京で働いています。' * 40,
+            metadata={'source': f'txt/synthetic/{position // 100}.txt'},
+        )
+        for position, docstore_id in index_to_docstore_id.items()
+    })
+    with open(os.path.join(directory, 'index.pkl'), 'wb') as f:
+        pickle.dump((docstore, index_to_docstore_id), f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directories', nargs='*')
+    parser.add_argument('--remove-pickle', action='store_true', help='変換後にindex.pklを削除する')
+    parser.add_argument('--synthetic', type=int, help='指定した件数の疑似的なドキュメントで変換と比較だけを行う（既存のインデックスは変更しない）')
+    args = parser.parse_args()
+    if args.synthetic:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            write_synthetic_pickle(temp_dir, args.synthetic)
+            convert(temp_dir)
+            print(f'synthetic ({args.synthetic} documents): converted')
+            compare(temp_dir)
+        raise SystemExit
+    directories = args.directories or sorted(os.path.dirname(path) for path in glob.glob('./faiss_index/*/index.pkl'))
+    for directory in directories:
+        if not os.path.exists(os.path.join(directory, 'index.pkl')):
+            print(f'{directory}: index.pklが無いのでスキップします')
+            continue
+        convert(directory)
+        print(f'{directory}: converted')
+        compare(directory)
+        if args.remove_pickle:
+            os.remove(os.path.join(directory, 'index.pkl'))
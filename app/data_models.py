@@ -1,13 +1,21 @@
-import queue
+import asyncio
 from fastapi import HTTPException
 from typing import List, Optional, Union
 from pydantic import BaseModel
+from structured_logging import get_logger
+
+
+logger = get_logger(__name__)
 
 
 class SendQuestionRequest(BaseModel):
     category_id: int
     text: str
-    previous_messages: List[str]
+    # conversation_idを送る場合は、会話履歴をサーバー側で保持するので空で良い
+    previous_messages: List[str] = []
+    conversation_id: Optional[str]
+    # Trueの場合は、最終回答の断片を短い時間ごとにまとめ、Noneのフィールドを省いたコンパクトな形式でSSEを送る（未対応のアプリのために既定は従来の形式）
+    is_enabled_compact_stream: bool = False
 
 
 class ActionInfo(BaseModel):
@@ -41,13 +49,17 @@ class StreamErrorResponseData:
         self.status_code = status_code
 
 
+# 1つのイベントループの中で回答を受け渡すためのチャンネル（スレッドを跨がないのでasyncio.Queueを使用）
 class AnswerResponseQueue:
     def __init__(self):
-        self.queue = queue.Queue()
+        self.queue = asyncio.Queue()
+        # 回答キャッシュに保存するために、送信したデータを順番に記録しておく
+        self.sent_data: List[StreamAnswerResponseData] = []
 
     def send(self, data: StreamAnswerResponseData):
         # answerを受取側に送信
-        self.queue.put(data)
+        self.sent_data.append(data)
+        self.queue.put_nowait(data)
 
     def send_error(
         self,
@@ -68,13 +80,13 @@ class AnswerResponseQueue:
         if status_code is not None:
             kwargs['status_code'] = status_code
         
-        self.queue.put(StreamErrorResponseData(**kwargs))
-        print("error sent")
+        self.queue.put_nowait(StreamErrorResponseData(**kwargs))
+        logger.warning('error sent', message=message, status_code=status_code, error=repr(e))
 
-    def get(self) -> Union[StreamAnswerResponseData, Exception, KeyboardInterrupt, StopIteration]:
-        return self.queue.get()
+    async def get(self) -> Union[StreamAnswerResponseData, Exception, KeyboardInterrupt, StopIteration]:
+        return await self.queue.get()
 
     def close(self):
         # Streamの終了を知らせる
-        self.queue.put(StopIteration())
-        print("answer stream closed")
\ No newline at end of file
+        self.queue.put_nowait(StopIteration())
+        logger.debug('answer stream closed')
\ No newline at end of file
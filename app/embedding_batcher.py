@@ -0,0 +1,128 @@
+import asyncio
+import time
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+from langchain.embeddings.base import Embeddings
+
+
+# 値の分布を、上限値ごとの件数で集計するヒストグラム
+class Histogram:
+    def __init__(self, bounds: Sequence[float]):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def to_dict(self) -> Dict[str, int]:
+        labels = [f'<={bound:g}' for bound in self.bounds] + [f'>{self.bounds[-1]:g}']
+        return dict(zip(labels, self.counts))
+
+
+# 同時に処理中の複数の回答から来る検索クエリのembedding取得を、短い時間だけ待ってまとめ、1回のAPI呼び出しで取得するクラス
+# 一定時間が経つか、件数が上限に達した時点でまとめて送り、結果をそれぞれの呼び出し元に返す
+class EmbeddingBatcher(Embeddings):
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        max_batch_size: int = 16,
+        # 最初のクエリが来てから、他のクエリを待つ最大の時間
+        max_wait_seconds: float = 0.01,
+    ):
+        self.embeddings = embeddings
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+
+        # まとめて送るのを待っている (クエリ, 結果を受け取るFuture, 追加された時刻)
+        self._pending: List[Tuple[str, asyncio.Future, float]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        # executorのスレッドから呼ばれた場合に、まとめる処理を行わせるイベントループ
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # 実行中のAPI呼び出し（途中でGCされない様に参照を持っておく）
+        self._tasks: Set[asyncio.Task] = set()
+
+        self.batches = 0
+        self.queries = 0
+        self.batch_size_histogram = Histogram(bounds=(1, 2, 4, 8, 16, 32))
+        self.wait_ms_histogram = Histogram(bounds=(1, 5, 10, 20, 50, 100))
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self.embeddings.aembed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        # asimilarity_search()などでexecutorのスレッドから呼ばれた場合は、イベントループ側でまとめてもらって結果を待つ
+        # （イベントループのスレッド自体から呼ばれた場合や、サーバーの外で使う場合はそのまま1件で取得する）
+        loop = self._loop
+        if loop is not None and loop.is_running() and not _is_event_loop_thread():
+            return asyncio.run_coroutine_threadsafe(self.aembed_query(text), loop).result()
+        return self.embeddings.embed_query(text)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        loop = asyncio.get_running_loop()
+        self._loop = loop
+        future = loop.create_future()
+        self._pending.append((text, future, time.perf_counter()))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_wait_seconds, self._flush)
+        return await future
+
+    def stats(self) -> dict:
+        return {
+            'batches': self.batches,
+            'queries': self.queries,
+            'avg_batch_size': self.queries / self.batches if self.batches else 0.0,
+            'batch_size_histogram': self.batch_size_histogram.to_dict(),
+            'wait_ms_histogram': self.wait_ms_histogram.to_dict(),
+        }
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        task = asyncio.ensure_future(self._embed_batch(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _embed_batch(self, batch: List[Tuple[str, asyncio.Future, float]]):
+        flushed_at = time.perf_counter()
+        # 同じクエリが同時に来ている場合は1つにまとめて送る
+        texts = list(dict.fromkeys(text for text, _, _ in batch))
+        self.batches += 1
+        self.queries += len(batch)
+        self.batch_size_histogram.observe(len(texts))
+        for _, _, enqueued_at in batch:
+            self.wait_ms_histogram.observe((flushed_at - enqueued_at) * 1000)
+
+        try:
+            vectors = await self.embeddings.aembed_documents(texts)
+        except Exception as e:
+            # 失敗した場合は、まとめた全員に同じ例外を返す
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        vectors_by_text = dict(zip(texts, vectors))
+        for text, future, _ in batch:
+            # 待っている間に呼び出し元が中断された場合は、結果を捨てる
+            if not future.done():
+                future.set_result(vectors_by_text[text])
+
+
+def _is_event_loop_thread() -> bool:
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
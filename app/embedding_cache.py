@@ -0,0 +1,188 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+from structured_logging import get_logger
+
+
+logger = get_logger(__name__)
+
+
+# 検索クエリのembeddingをキャッシュするラッパー
+# 1段目: プロセス内のLRU（件数上限で古いものから破棄）
+# 2段目: SQLiteファイル（再起動後も残り、同じファイルを見る全workerで共有される）
+# ドキュメント側のembedding（インデックス作成時）はキャッシュせずにそのまま委譲する
+class CachedQueryEmbeddings(Embeddings):
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        model_name: str,
+        max_memory_entries: int = 4096,
+        db_path: Optional[str] = None,
+        max_disk_entries: int = 100000,
+    ):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+
+        # float32で保持する（FAISS側でもfloat32に変換されるので精度は変わらず、メモリはlist[float]の1/8程度で済む）
+        self._memory: 'OrderedDict[str, np.ndarray]' = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._disk_writes = 0
+
+        self._db: Optional[sqlite3.Connection] = None
+        # SQLiteの読み書きは、イベントループを止めない様に専用の1スレッドで順番に行う
+        # （書き込みは結果を待たずに積むだけにして、embeddingを返すのをディスクへの書き込みで待たせない）
+        self._db_executor: Optional[ThreadPoolExecutor] = None
+        if db_path:
+            os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+            # 作成したスレッドと読み書きするスレッドが異なるので、スレッドの確認は無効にしている（作成後のアクセスは専用のスレッドからのみ）
+            self._db = sqlite3.connect(db_path, timeout=5, check_same_thread=False)
+            # 複数workerから同時に読み書きしてもブロックし合わない様にWALモードにする
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS query_embeddings ('
+                'key TEXT PRIMARY KEY, vector BLOB NOT NULL, created_at REAL NOT NULL)'
+            )
+            # 上限を超えた古いものを削除する際に、全件を並べ替えない様にする
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS query_embeddings_created_at ON query_embeddings (created_at)'
+            )
+            self._db.commit()
+            self._db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='embedding-cache-db')
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self.embeddings.aembed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        # executorのスレッドから呼ばれるので、ディスクからの読み込みはそのまま待つ
+        key = self._make_key(text)
+        cached = self._get_from_memory(key)
+        if cached is None and self._db_executor is not None:
+            cached = self._on_disk_lookup_done(key, self._db_executor.submit(self._load_from_disk, key).result())
+        if cached is not None:
+            return cached.tolist()
+        self._on_miss()
+        embedding = self.embeddings.embed_query(text)
+        self._put(key, embedding)
+        return embedding
+
+    async def aembed_query(self, text: str) -> List[float]:
+        key = self._make_key(text)
+        cached = self._get_from_memory(key)
+        if cached is None and self._db_executor is not None:
+            row = await asyncio.wrap_future(self._db_executor.submit(self._load_from_disk, key))
+            cached = self._on_disk_lookup_done(key, row)
+        if cached is not None:
+            return cached.tolist()
+        self._on_miss()
+        embedding = await self.embeddings.aembed_query(text)
+        self._put(key, embedding)
+        return embedding
+
+    def close(self):
+        # 書き込み待ちの分を書き終えてから閉じる
+        if self._db_executor is not None:
+            self._db_executor.shutdown(wait=True)
+            self._db_executor = None
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def stats(self) -> dict:
+        hits = self.memory_hits + self.disk_hits
+        total = hits + self.misses
+        return {
+            'memory_entries': len(self._memory),
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': hits / total if total else 0.0,
+        }
+
+    def _make_key(self, text: str) -> str:
+        # 全角/半角や前後・連続する空白の違いだけのクエリは同じものとして扱う
+        normalized = ' '.join(unicodedata.normalize('NFKC', text).split())
+        return hashlib.sha256(f'{self.model_name}\n{normalized}'.encode('utf-8')).hexdigest()
+
+    def _get_from_memory(self, key: str) -> Optional[np.ndarray]:
+        # メモリ上のLRUは複数のスレッドから使われるので、ロックを取って読み書きする
+        with self._lock:
+            if (vector := self._memory.get(key)) is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+            return vector
+
+    def _on_disk_lookup_done(self, key: str, blob: Optional[bytes]) -> Optional[np.ndarray]:
+        if blob is None:
+            return None
+        vector = np.frombuffer(blob, dtype=np.float32)
+        with self._lock:
+            self._remember(key, vector)
+            self.disk_hits += 1
+        return vector
+
+    def _on_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def _put(self, key: str, embedding: List[float]):
+        vector = np.asarray(embedding, dtype=np.float32)
+        with self._lock:
+            self._remember(key, vector)
+        if self._db_executor is not None:
+            self._db_executor.submit(self._write_to_disk, key, vector.tobytes(), time.time()) \
+                .add_done_callback(self._on_write_done)
+
+    @staticmethod
+    def _on_write_done(future: Future):
+        # 書き込みに失敗してもメモリ上のキャッシュは使えるので、ログに残すだけにする
+        if (error := future.exception()) is not None:
+            logger.warning('embeddingのキャッシュの保存に失敗', error=repr(error))
+
+    def _load_from_disk(self, key: str) -> Optional[bytes]:
+        # 専用のスレッドで実行される
+        row = self._db.execute('SELECT vector FROM query_embeddings WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _write_to_disk(self, key: str, blob: bytes, created_at: float):
+        # 専用のスレッドで実行される
+        self._db.execute(
+            'INSERT OR REPLACE INTO query_embeddings (key, vector, created_at) VALUES (?, ?, ?)',
+            (key, blob, created_at)
+        )
+        self._db.commit()
+        # 書き込みの度に件数を数えると重いので、一定回数ごとに上限を超えた古いものを削除する
+        self._disk_writes += 1
+        if self._disk_writes % 100 == 0:
+            self._db.execute(
+                'DELETE FROM query_embeddings WHERE key IN ('
+                'SELECT key FROM query_embeddings ORDER BY created_at DESC LIMIT -1 OFFSET ?)',
+                (self.max_disk_entries,)
+            )
+            self._db.commit()
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
@@ -17,4 +17,20 @@ def _getenv(key: str):
 
 class Env:
     OPENAI_API_KEY = _getenv("OPENAI_API_KEY")
-    SERPER_API_KEY = _getenv("SERPER_API_KEY")
\ No newline at end of file
+    SERPER_API_KEY = _getenv("SERPER_API_KEY")
+    # Serper APIの接続先（ローカルの偽Serperサーバーで試験・計測する場合に指定する）
+    SERPER_BASE_URL = _getenv("SERPER_BASE_URL")
+    # 起動時に読み込んでおくインデックスのカテゴリID（カンマ区切り。未指定の場合は初めて使われた時に読み込む）
+    WARMUP_CATEGORY_IDS = _getenv("WARMUP_CATEGORY_IDS")
+    # 1回目のChatCompletionと同時に組織内データ検索を投機的に始めるカテゴリID（カンマ区切り。未指定の場合は無効）
+    SPECULATIVE_INDEX_SEARCH_CATEGORY_IDS = _getenv("SPECULATIVE_INDEX_SEARCH_CATEGORY_IDS")
+    # ディープサーチで各ページから質問に関連する部分を取り出す方法（"local": ローカルでの抽出（抽出できなければ16kモデルで要約）、未指定: 16kモデルで要約）
+    WEB_CONTENTS_EXTRACTION_MODE = _getenv("WEB_CONTENTS_EXTRACTION_MODE")
+    # ディープサーチで、この件数のページの要約が揃った時点で回答を始める（未指定の場合は全ページを待つ）
+    DEEP_SEARCH_MIN_SUMMARIES = _getenv("DEEP_SEARCH_MIN_SUMMARIES")
+    # ディープサーチで、ページの要約を待つ上限の秒数（過ぎた場合はそれまでに揃った要約だけで回答を始める。未指定の場合は上限なし）
+    DEEP_SEARCH_MAX_WAIT_SECONDS = _getenv("DEEP_SEARCH_MAX_WAIT_SECONDS")
+    # 回答キャッシュの有効期限の秒数をカテゴリごとに指定する（"カテゴリID:秒数"のカンマ区切り。未指定のカテゴリは24時間。Web検索を使った回答は別に10分）
+    ANSWER_CACHE_TTL_SECONDS_BY_CATEGORY = _getenv("ANSWER_CACHE_TTL_SECONDS_BY_CATEGORY")
+    # アプリのログの出力レベル（DEBUG / INFO / WARNING / ERROR。未指定の場合はINFO。DEBUGにすると会話履歴やトークンごとのログも出力する）
+    LOG_LEVEL = _getenv("LOG_LEVEL")
\ No newline at end of file
@@ -0,0 +1,77 @@
+# 組織内データ検索のパラメータ（k, fetch_k, lambda_mult, max_distance）ごとに、再現率と検索時間を比較するスクリプト
+# 使い方: python evaluate_index_retrieval.py [評価データのJSONLファイル]
+# 評価データは1行ごとに {"category_id": 0, "query": "...", "expected_text": "..."} の形式で、
+# 返ってきたドキュメントのどれかにexpected_textが含まれていれば正解とみなす
+# （引数が無い場合は、各チャンクの冒頭の文をクエリ、そのチャンク自身を正解として評価データを作る）
+import json
+import statistics
+import sys
+import time
+from typing import List
+
+from index_retriever import RetrievalSettings, retrieve_documents
+import vector_stores
+
+
+# 比較するパラメータの組み合わせ
+SETTINGS_GRID = [
+    RetrievalSettings(k=1, fetch_k=1, lambda_mult=1.0),
+    RetrievalSettings(k=3, fetch_k=20, lambda_mult=1.0),
+    RetrievalSettings(k=3, fetch_k=20, lambda_mult=0.5),
+    RetrievalSettings(k=3, fetch_k=20, lambda_mult=0.5, max_distance=0.6),
+    RetrievalSettings(k=5, fetch_k=40, lambda_mult=0.5),
+]
+
+
+def load_eval_cases(path: str) -> List[dict]:
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def make_eval_cases_from_chunks() -> List[dict]:
+    eval_cases = []
+    for category_id in vector_stores.registry.index_paths:
+        vector_store = vector_stores.registry.get(category_id)
+        for docstore_id in vector_store.index_to_docstore_id.values():
+            text = vector_store.docstore.search(docstore_id).page_content
+            lines = [line for line in text.splitlines() if line.strip()]
+            if not lines:
+                continue
+            eval_cases.append({
+                'category_id': category_id,
+                'query': lines[0][:50],
+                'expected_text': text[-50:],
+            })
+    return eval_cases
+
+
+def evaluate(eval_cases: List[dict], settings: RetrievalSettings) -> dict:
+    hits = 0
+    document_counts = []
+    latencies_ms = []
+    for eval_case in eval_cases:
+        vector_store = vector_stores.registry.get(eval_case['category_id'])
+        started_at = time.perf_counter()
+        documents = retrieve_documents(eval_case['query'], vector_store, settings)
+        latencies_ms.append((time.perf_counter() - started_at) * 1000)
+        document_counts.append(len(documents))
+        if any(eval_case['expected_text'] in document.page_content for document in documents):
+            hits += 1
+    return {
+        'recall': hits / len(eval_cases) if eval_cases else 0.0,
+        'avg_documents': statistics.mean(document_counts) if document_counts else 0.0,
+        'avg_ms': statistics.mean(latencies_ms) if latencies_ms else 0.0,
+        'p95_ms': sorted(latencies_ms)[int(len(latencies_ms) * 0.95)] if latencies_ms else 0.0,
+    }
+
+
+if __name__ == '__main__':
+    eval_cases = load_eval_cases(sys.argv[1]) if len(sys.argv) > 1 else make_eval_cases_from_chunks()
+    print(f'eval cases: {len(eval_cases)}')
+    # 1回目の検索でembeddingをキャッシュさせてから計測し、embeddingのAPIの時間ではなく検索自体の時間を比べる
+    evaluate(eval_cases, SETTINGS_GRID[0])
+    for settings in SETTINGS_GRID:
+        result = evaluate(eval_cases, settings)
+        print(f'k={settings.k}, fetch_k={settings.fetch_k}, lambda_mult={settings.lambda_mult}, max_distance={settings.max_distance}: '
+              f'recall={result["recall"]:.2f}, avg_documents={result["avg_documents"]:.1f}, '
+              f'avg_ms={result["avg_ms"]:.2f}, p95_ms={result["p95_ms"]:.2f}')
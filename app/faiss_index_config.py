@@ -0,0 +1,76 @@
+import os
+import tempfile
+from typing import Dict, Optional
+
+import faiss
+import numpy as np
+from pydantic import BaseModel
+
+
+# ingest_documents.pyで作成したインデックスは、作成のたびに versions/<バージョン名>/ 以下の新しいディレクトリに書き出し、
+# 使用中のバージョン名を CURRENT に書く（CURRENTの置き換えは1回のrenameなので、読み込む側が新旧のファイルを混ぜて読むことは無い）
+CURRENT_VERSION_FILE_NAME = 'CURRENT'
+VERSIONS_DIR_NAME = 'versions'
+
+
+# FAISSのインデックスの種類と検索時のパラメータ（インデックスと一緒にmanifest.jsonに保存し、読み込み時に適用する）
+class FaissIndexConfig(BaseModel):
+    # faiss.index_factoryの文字列
+    # 例: "Flat"（全件を正確に検索）, "HNSW32"（グラフ検索）, "IVF1024,Flat"（クラスタ単位で検索）,
+    #     "IVF1024,PQ64"（直積量子化で圧縮）, "HNSW32,SQ8"（8bitのスカラー量子化で圧縮）
+    factory: str = 'Flat'
+    # 検索時のパラメータ（例: {"efSearch": 64}, {"nprobe": 16}）
+    search_params: Dict[str, float] = {}
+
+    def build(self, vectors: np.ndarray) -> faiss.Index:
+        index = faiss.index_factory(vectors.shape[1], self.factory)
+        # IVFやPQは、クラスタの中心や量子化のコードブックを学習させてから追加する
+        if not index.is_trained:
+            index.train(vectors)
+        index.add(vectors)
+        self.apply_search_params(index)
+        return index
+
+    def apply_search_params(self, index: faiss.Index):
+        parameter_space = faiss.ParameterSpace()
+        for name, value in self.search_params.items():
+            parameter_space.set_index_parameter(index, name, value)
+        # IVFの場合は、MMRの再ランキングでベクトルを取り出せる様に、IDから格納位置への対応表を作っておく
+        if (ivf_index := _extract_ivf(index)) is not None:
+            ivf_index.make_direct_map()
+
+    @classmethod
+    def from_manifest(cls, manifest: Optional[dict]) -> 'FaissIndexConfig':
+        # manifest.jsonが無い、もしくは設定が無い古いインデックスはFlatとして扱う
+        return cls(**((manifest or {}).get('index') or {}))
+
+
+def _extract_ivf(index: faiss.Index) -> Optional[faiss.IndexIVF]:
+    try:
+        return faiss.extract_index_ivf(index)
+    except RuntimeError:
+        return None
+
+
+def resolve_index_dir(index_dir: str) -> str:
+    # CURRENTが指すバージョンのディレクトリを返す（CURRENTが無い古い形式のインデックスは、index_dir直下のファイルをそのまま使う）
+    try:
+        with open(os.path.join(index_dir, CURRENT_VERSION_FILE_NAME), encoding='utf-8') as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        return index_dir
+    return os.path.join(index_dir, VERSIONS_DIR_NAME, version)
+
+
+def switch_index_version(index_dir: str, version: str):
+    # 一時ファイルに書いてから置き換えることで、CURRENTを1回の操作で新しいバージョンに切り替える
+    fd, temp_file_path = tempfile.mkstemp(dir=index_dir, prefix=f'.{CURRENT_VERSION_FILE_NAME}.')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(version)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file_path, os.path.join(index_dir, CURRENT_VERSION_FILE_NAME))
+    except BaseException:
+        os.remove(temp_file_path)
+        raise
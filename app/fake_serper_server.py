@@ -0,0 +1,66 @@
+# Serper APIの代わりに使うローカルの偽サーバー（試験・計測用）
+# 使い方: python fake_serper_server.py [--port 8765] [--latency-ms 300] [--error-rate 0.2]
+# 起動後、環境変数 SERPER_BASE_URL=http://127.0.0.1:8765 を指定してサーバーを起動すると、こちらに検索が向く
+import argparse
+import asyncio
+import random
+
+from aiohttp import web
+
+
+def make_search_results(query: str, num: int) -> dict:
+    # Serperの/searchのレスポンスと同じ形式で、organicの結果だけを返す
+    return {
+        'searchParameters': {'q': query, 'num': num},
+        'organic': [
+            {
+                'title': f'{query} - 検索結果{i + 1}',
+                'link': f'https://example.com/{i + 1}?q={query}',
+                'snippet': f'{query}に関する{i + 1}件目の検索結果です。',
+                'position': i + 1,
+            }
+            for i in range(num)
+        ],
+    }
+
+
+def create_app(
+    latency_ms: float = 300,
+    # 指定した割合で429か503を返す（リトライの確認用）
+    error_rate: float = 0.0,
+) -> web.Application:
+    async def search(request: web.Request) -> web.Response:
+        await asyncio.sleep(latency_ms / 1000)
+        if random.random() < error_rate:
+            return web.json_response({'message': 'fake error'}, status=random.choice([429, 503]))
+        return web.json_response(make_search_results(
+            query=request.query.get('q', ''),
+            num=int(request.query.get('num', 10)),
+        ))
+
+    app = web.Application()
+    app.router.add_post('/search', search)
+    return app
+
+
+async def start_fake_serper_server(
+    port: int = 0,
+    latency_ms: float = 300,
+    error_rate: float = 0.0,
+) -> (web.AppRunner, str):
+    # 同じプロセス内で起動して、(runner, base_url)を返す（port=0の場合は空いているポートを使う）
+    runner = web.AppRunner(create_app(latency_ms=latency_ms, error_rate=error_rate))
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://127.0.0.1:{port}'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', type=float, default=300)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    web.run_app(create_app(latency_ms=args.latency_ms, error_rate=args.error_rate), host='127.0.0.1', port=args.port)
@@ -0,0 +1,85 @@
+# スクレイピング対象のWebページの代わりに使うローカルの偽サーバー（HttpFetcherの試験・計測用）
+# 使い方: python fake_web_server.py [--port 8766]
+# /page: ETagとLast-Modified付きのHTML（If-None-Matchが一致すれば304）
+# /slow?seconds=N: N秒待ってから返すHTML（タイムアウトの確認用）
+# /large?bytes=N: Nバイトの本文を少しずつ返すHTML（本文サイズの上限の確認用）
+# /redirect: /pageへのリダイレクト
+# /shift_jis: Content-Typeにcharsetが無く、metaタグでShift_JISを宣言したHTML
+# /image: 取得対象外のContent-Type
+# /error: 500エラー
+import argparse
+import asyncio
+
+from aiohttp import web
+
+
+PAGE_HTML = '<html><body><div>深瀬のプロフィールページです。</div></body></html>'
+PAGE_ETAG = '"fake-page-v1"'
+PAGE_LAST_MODIFIED = 'Mon, 01 Jan 2024 00:00:00 GMT'
+
+
+def create_app() -> web.Application:
+    async def page(request: web.Request) -> web.Response:
+        headers = {'ETag': PAGE_ETAG, 'Last-Modified': PAGE_LAST_MODIFIED}
+        if request.headers.get('If-None-Match') == PAGE_ETAG:
+            return web.Response(status=304, headers=headers)
+        return web.Response(text=PAGE_HTML, content_type='text/html', headers=headers)
+
+    async def slow(request: web.Request) -> web.Response:
+        await asyncio.sleep(float(request.query.get('seconds', 10)))
+        return web.Response(text=PAGE_HTML, content_type='text/html')
+
+    async def large(request: web.Request) -> web.StreamResponse:
+        response = web.StreamResponse(headers={'Content-Type': 'text/html; charset=utf-8'})
+        await response.prepare(request)
+        remaining = int(request.query.get('bytes', 10 * 1024 * 1024))
+        while remaining > 0:
+            chunk_size = min(remaining, 16 * 1024)
+            try:
+                await response.write(b'a' * chunk_size)
+            except ConnectionResetError:
+                # 上限に達したクライアントが途中で接続を閉じた場合
+                return response
+            remaining -= chunk_size
+        await response.write_eof()
+        return response
+
+    async def redirect(request: web.Request) -> web.Response:
+        raise web.HTTPFound('/page')
+
+    async def shift_jis(request: web.Request) -> web.Response:
+        html = '<html><head><meta charset="Shift_JIS"></head><body><div>日本語のページです。</div></body></html>'
+        return web.Response(body=html.encode('shift_jis'), headers={'Content-Type': 'text/html'})
+
+    async def image(request: web.Request) -> web.Response:
+        return web.Response(body=b'\x89PNG', content_type='image/png')
+
+    async def error(request: web.Request) -> web.Response:
+        return web.Response(status=500, text='fake error')
+
+    app = web.Application()
+    app.router.add_get('/page', page)
+    app.router.add_get('/slow', slow)
+    app.router.add_get('/large', large)
+    app.router.add_get('/redirect', redirect)
+    app.router.add_get('/shift_jis', shift_jis)
+    app.router.add_get('/image', image)
+    app.router.add_get('/error', error)
+    return app
+
+
+async def start_fake_web_server(port: int = 0) -> (web.AppRunner, str):
+    # 同じプロセス内で起動して、(runner, base_url)を返す（port=0の場合は空いているポートを使う）
+    runner = web.AppRunner(create_app())
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://127.0.0.1:{port}'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8766)
+    args = parser.parse_args()
+    web.run_app(create_app(), host='127.0.0.1', port=args.port)
@@ -1,7 +1,18 @@
-from typing import Any, List
+import asyncio
+import random
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import aiohttp
 from pydantic import BaseModel
 from langchain.utilities import GoogleSerperAPIWrapper
 
+from env import Env
+from structured_logging import get_logger
+
+
+logger = get_logger(__name__)
+
 
 class SerperResult(BaseModel):
     answer_box: str
@@ -32,56 +43,241 @@ class CustomGoogleSerper(GoogleSerperAPIWrapper):
         self, 
         results: dict,
     ) -> SerperResult:
-        print(f'⭐️_parse_snippets: {results}\n\n')
-        answer_box_result: str = ""
-        knowledge_graph_result: str = ""
-        links: List[str] = []
-        organic_results_text: str = ""
-
-        # AnswerBoxの値が取れていたら整形して変数に格納する
-        if (answer_box := results.get("answerBox")) is not None:
-            print(f'answerBoxがある: {answer_box}')
-            if (answer := answer_box.get("answer")) is not None:
-                print(f'answer: {answer}')
-                answer_box_result = answer
-            elif (snippet := answer_box.get("snippet")) is not None:
-                print(f'snippet: {snippet}')
-                answer_box_result = snippet.replace("\n", " ")
-            elif (highlighted_snippets := answer_box.get("snippetHighlighted")) is not None:
-                print(f'snippet: {highlighted_snippets}')
-                answer_box_result = '\n'.join(highlighted_snippets)
-
-        # KnowledgeGraphの値が取れていたら整形して変数に格納する
-        if (knowledge_graph := results.get("knowledgeGraph")) is not None:
-            print(f'knowledgeGraphがある: {knowledge_graph}')
-            title = knowledge_graph.get("title")
-            entity_type = knowledge_graph.get("type")
-            description = knowledge_graph.get("description")
-            print(f'title: {title}, entity_type: {entity_type}, description: {description}')
-            if entity_type:
-                knowledge_graph_result += f"{title}: {entity_type}.\n"
-            if description:
-                print(f'description: {description}')
-                knowledge_graph_result += f"{description}\n"
-            for attribute, value in knowledge_graph.get("attributes", {}).items():
-                print(f'attribute: {attribute}, value: {value}')
-                knowledge_graph_result += f"{title} {attribute}: {value}.\n"
-
-        for result in results[self.result_key_for_type[self.type]][: self.k]:
-            # リンクを取り出してリストに格納
-            if (link := result.get('link')) is not None:
-                links.append(link)
-
-            # 浅い情報だがsnippet部分も取り出してorganic_resultとして取得しておく（ディープサーチがOFFの場合はこれを使う）
-            link = result.get("link", "")
-            snippet = result.get("snippet", "")
-            attributes = {f"{attribute}": value for attribute, value in result.get("attributes", {}).items()}
-            organic_result = {"snippet": f"{snippet}. {attributes}", "link": link}
-            organic_results_text += f"{organic_result}"
-
-        return SerperResult(
-            answer_box=answer_box_result,
-            knowledge_graph=knowledge_graph_result,
-            organic_results_text=organic_results_text,
-            links=links,
-        )
\ No newline at end of file
+        return parse_serper_results(results=results, k=self.k, result_key=self.result_key_for_type[self.type])
+
+
+# Serperのレスポンスを、回答に使う形に整形する（同期版のCustomGoogleSerperと非同期版のAsyncSerperClientで共通）
+def parse_serper_results(
+    results: dict,
+    k: int,
+    # 検索の種類ごとの結果のキー（/searchの場合は"organic"）
+    result_key: str = 'organic',
+) -> SerperResult:
+    # Serperの結果全体は大きいのでDEBUGの場合だけ出力する
+    logger.debug('parse_serper_results', results=results)
+    answer_box_result: str = ""
+    knowledge_graph_result: str = ""
+    links: List[str] = []
+    organic_results_text: str = ""
+
+    # AnswerBoxの値が取れていたら整形して変数に格納する
+    if (answer_box := results.get("answerBox")) is not None:
+        logger.debug('answerBoxがある', answer_box=answer_box)
+        if (answer := answer_box.get("answer")) is not None:
+            answer_box_result = answer
+        elif (snippet := answer_box.get("snippet")) is not None:
+            answer_box_result = snippet.replace("\n", " ")
+        elif (highlighted_snippets := answer_box.get("snippetHighlighted")) is not None:
+            answer_box_result = '\n'.join(highlighted_snippets)
+
+    # KnowledgeGraphの値が取れていたら整形して変数に格納する
+    if (knowledge_graph := results.get("knowledgeGraph")) is not None:
+        logger.debug('knowledgeGraphがある', knowledge_graph=knowledge_graph)
+        title = knowledge_graph.get("title")
+        entity_type = knowledge_graph.get("type")
+        description = knowledge_graph.get("description")
+        if entity_type:
+            knowledge_graph_result += f"{title}: {entity_type}.\n"
+        if description:
+            knowledge_graph_result += f"{description}\n"
+        for attribute, value in knowledge_graph.get("attributes", {}).items():
+            knowledge_graph_result += f"{title} {attribute}: {value}.\n"
+
+    for result in results[result_key][:k]:
+        # リンクを取り出してリストに格納
+        if (link := result.get('link')) is not None:
+            links.append(link)
+
+        # 浅い情報だがsnippet部分も取り出してorganic_resultとして取得しておく（ディープサーチがOFFの場合はこれを使う）
+        link = result.get("link", "")
+        snippet = result.get("snippet", "")
+        attributes = {f"{attribute}": value for attribute, value in result.get("attributes", {}).items()}
+        organic_result = {"snippet": f"{snippet}. {attributes}", "link": link}
+        organic_results_text += f"{organic_result}"
+
+    logger.info(
+        'parse_serper_results',
+        has_answer_box=bool(answer_box_result),
+        has_knowledge_graph=bool(knowledge_graph_result),
+        link_count=len(links),
+    )
+    return SerperResult(
+        answer_box=answer_box_result,
+        knowledge_graph=knowledge_graph_result,
+        organic_results_text=organic_results_text,
+        links=links,
+    )
+
+
+# Serperの検索APIを、イベントループを止めずに呼び出すクライアント
+# コネクションを使い回し、429や5xxが返ってきた場合はジッター付きの指数バックオフで一定回数までリトライする
+# （結果の整形は同期版と同じparse_serper_resultsを使うので、同期版と同じ結果になる）
+class AsyncSerperClient:
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        # ローカルの偽Serperサーバー（fake_serper_server.py）に向ける場合は、環境変数SERPER_BASE_URLで差し替える
+        base_url: Optional[str] = None,
+        timeout_seconds: float = 10,
+        max_retries: int = 2,
+        backoff_base_seconds: float = 0.5,
+        backoff_max_seconds: float = 4,
+        limit: int = 20,
+    ):
+        self.api_key = api_key or Env.SERPER_API_KEY or ''
+        self.base_url = (base_url or Env.SERPER_BASE_URL or 'https://google.serper.dev').rstrip('/')
+        self.timeout = aiohttp.ClientTimeout(total=timeout_seconds)
+        self.max_retries = max_retries
+        self.backoff_base_seconds = backoff_base_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.limit = limit
+        self._session: Optional[aiohttp.ClientSession] = None
+
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        # リトライせずに失敗させた4xx（APIキーやリクエストの誤り）
+        self.client_errors = 0
+
+    async def search(
+        self,
+        query: str,
+        gl: str = CustomGoogleSerper.__fields__['gl'].default,
+        hl: str = CustomGoogleSerper.__fields__['hl'].default,
+        k: int = CustomGoogleSerper.__fields__['k'].default,
+    ) -> SerperResult:
+        results = await self._post(
+            search_type='search',
+            params={'q': query, 'gl': gl, 'hl': hl, 'num': k},
+        )
+        return parse_serper_results(results=results, k=k)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def stats(self) -> dict:
+        return {
+            'requests': self.requests,
+            'retries': self.retries,
+            'failures': self.failures,
+            'client_errors': self.client_errors,
+        }
+
+    async def _post(
+        self,
+        search_type: str,
+        params: dict,
+    ) -> dict:
+        headers = {
+            'X-API-KEY': self.api_key,
+            'Content-Type': 'application/json',
+        }
+        for attempt in range(self.max_retries + 1):
+            self.requests += 1
+            try:
+                async with self._get_session().post(f'{self.base_url}/{search_type}', params=params, headers=headers) as response:
+                    # レート制限とサーバー側の一時的なエラーだけリトライする（4xxはリクエストが悪いのでリトライしない）
+                    if response.status != 429 and response.status < 500:
+                        if response.status >= 400:
+                            self.client_errors += 1
+                            response.raise_for_status()
+                        return await response.json()
+                    error: Exception = aiohttp.ClientResponseError(
+                        response.request_info, response.history, status=response.status, message=response.reason or '',
+                    )
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                error = e
+            if attempt == self.max_retries:
+                self.failures += 1
+                raise error
+            self.retries += 1
+            # 同時にリトライが集中しない様に、待ち時間はランダムにばらつかせる（Full Jitter）
+            backoff_seconds = random.uniform(0, min(self.backoff_max_seconds, self.backoff_base_seconds * 2 ** attempt))
+            logger.warning('Serperの呼び出しをリトライ', attempt=attempt + 1, error=repr(error), backoff_seconds=round(backoff_seconds, 2))
+            await asyncio.sleep(backoff_seconds)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # ClientSessionはイベントループの中で生成する必要があるので、初回のリクエスト時に生成する
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=self.timeout,
+                connector=aiohttp.TCPConnector(limit=self.limit),
+            )
+        return self._session
+
+
+# Serperの検索結果を(query, gl, hl, k)ごとに一定時間キャッシュするクラス
+# 同じ検索が同時に複数来た場合は、実際のAPI呼び出しは1回だけにして、結果を全員で共有する
+class SerperSearchCache:
+    def __init__(
+        self,
+        ttl_seconds: float = 60 * 5,
+        max_entries: int = 1000,
+        client: Optional[AsyncSerperClient] = None,
+    ):
+        self.client = client or AsyncSerperClient()
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # key: (query, gl, hl, k), value: (有効期限, 検索結果)
+        self._results: Dict[Tuple[str, str, str, int], Tuple[float, SerperResult]] = {}
+        # 現在API呼び出し中の検索
+        self._in_flight: Dict[Tuple[str, str, str, int], asyncio.Task] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def run(
+        self,
+        query: str,
+        gl: str = CustomGoogleSerper.__fields__['gl'].default,
+        hl: str = CustomGoogleSerper.__fields__['hl'].default,
+        k: int = CustomGoogleSerper.__fields__['k'].default,
+    ) -> SerperResult:
+        key = (query.strip(), gl, hl, k)
+
+        if (cached := self._results.get(key)) is not None:
+            expires_at, result = cached
+            if expires_at > time.time():
+                self.hits += 1
+                return result
+            self._results.pop(key, None)
+
+        # 同じ検索がすでにAPI呼び出し中なら、その結果を待つ
+        if (task := self._in_flight.get(key)) is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(self._search(key))
+            self._in_flight[key] = task
+        # 待っている1人がキャンセルされても、他の待機者のために検索自体は止めない
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses + self.coalesced
+        return {
+            'entries': len(self._results),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'hit_rate': (self.hits + self.coalesced) / total if total else 0.0,
+            'client': self.client.stats(),
+        }
+
+    async def _search(self, key: Tuple[str, str, str, int]) -> SerperResult:
+        query, gl, hl, k = key
+        try:
+            result = await self.client.search(query=query, gl=gl, hl=hl, k=k)
+            # 失敗した場合はキャッシュしない（例外はそのまま待機者全員に伝わる）
+            self._store(key, result)
+            return result
+        finally:
+            self._in_flight.pop(key, None)
+
+    def _store(self, key: Tuple[str, str, str, int], result: SerperResult):
+        self._results[key] = (time.time() + self.ttl_seconds, result)
+        # 上限を超えた場合は古いものから削除する（dictは追加順を保持している）
+        while len(self._results) > self.max_entries:
+            self._results.pop(next(iter(self._results)))
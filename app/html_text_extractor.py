@@ -0,0 +1,94 @@
+from html.parser import HTMLParser
+from typing import Iterable, List, Set
+
+import tiktoken
+
+from context_packer import get_encoding
+
+
+# HTMLを先頭から順に読み進め、抽出したいタグの中のテキストだけをトークン数の上限に達するまで集める
+class _BudgetedTextParser(HTMLParser):
+    def __init__(
+        self,
+        unwanted_tags: Set[str],
+        tags_to_extract: Set[str],
+        encoding: tiktoken.Encoding,
+        max_tokens: int,
+    ):
+        super().__init__(convert_charrefs=True)
+        self.unwanted_tags = unwanted_tags
+        self.tags_to_extract = tags_to_extract
+        self.encoding = encoding
+        self.max_tokens = max_tokens
+
+        self.lines: List[str] = []
+        self.token_count = 0
+        self.is_full = False
+        self._seen_lines: Set[str] = set()
+        # 現在いる位置が除外したいタグ / 抽出したいタグの中に何重に入っているか
+        self._unwanted_depth = 0
+        self._extract_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.unwanted_tags:
+            self._unwanted_depth += 1
+        elif tag in self.tags_to_extract:
+            self._extract_depth += 1
+
+    def handle_endtag(self, tag):
+        if tag in self.unwanted_tags and self._unwanted_depth > 0:
+            self._unwanted_depth -= 1
+        elif tag in self.tags_to_extract and self._extract_depth > 0:
+            self._extract_depth -= 1
+
+    def handle_data(self, data):
+        if self.is_full or self._unwanted_depth > 0 or self._extract_depth == 0:
+            return
+        for line in data.split('\n'):
+            line = line.strip()
+            # 空行と、既に出てきた行（メニューなどの繰り返し）は除外する
+            if not line or line in self._seen_lines:
+                continue
+            self._seen_lines.add(line)
+
+            # 最終的に空白区切りで連結されるので、区切りの空白も含めて数える
+            tokens = self.encoding.encode(f' {line}' if self.lines else line)
+            remaining = self.max_tokens - self.token_count
+            if len(tokens) >= remaining:
+                # 上限に達したので、収まる分だけを残してそれ以降は読まない
+                self.lines.append(self.encoding.decode(tokens[:remaining]).strip())
+                self.token_count = self.max_tokens
+                self.is_full = True
+                return
+            self.lines.append(line)
+            self.token_count += len(tokens)
+
+
+# 抽出したHTMLコンテンツの中から欲しい情報だけを、指定したトークン数分だけ取り出す
+# ドキュメント全体を解析・分割してから先頭だけを使うのではなく、上限に達した時点で解析を打ち切る
+def extract_text_within_token_budget(
+    html_chunks: Iterable[str],
+    max_tokens: int = 10000,
+    unwanted_tags: Iterable[str] = ("nav", "header", "footer", "script", "style"),
+    tags_to_extract: Iterable[str] = ("div", "span"),
+    model_name: str = 'gpt-3.5-turbo-16k',
+) -> str:
+    parser = _BudgetedTextParser(
+        unwanted_tags=set(unwanted_tags),
+        tags_to_extract=set(tags_to_extract),
+        encoding=get_encoding(model_name),
+        max_tokens=max_tokens,
+    )
+    for chunk in html_chunks:
+        parser.feed(chunk)
+        if parser.is_full:
+            break
+    else:
+        parser.close()
+    return ' '.join(parser.lines)
+
+
+# 文字列を一定サイズごとに区切って順に渡す（上限に達した時点で残りを解析しなくて済む様に）
+def iter_html_chunks(html: str, chunk_size: int = 64 * 1024) -> Iterable[str]:
+    for start in range(0, len(html), chunk_size):
+        yield html[start:start + chunk_size]
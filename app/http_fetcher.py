@@ -0,0 +1,117 @@
+import codecs
+import re
+from typing import Mapping, Optional, Tuple
+
+import aiohttp
+
+
+# 取得対象外のContent-Typeだった場合の例外
+class UnsupportedContentTypeError(Exception):
+    pass
+
+
+class FetchedResponse:
+    status_code: int
+    # ヘッダー名の大文字・小文字はサーバーによって異なるので、区別しないMappingで保持する
+    headers: Mapping[str, str]
+    text: str
+    # 本文がmax_body_bytesを超えたため途中で打ち切ったかどうか
+    is_truncated: bool
+
+    def __init__(
+        self,
+        status_code: int,
+        headers: Mapping[str, str],
+        text: str,
+        is_truncated: bool,
+    ):
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
+        self.is_truncated = is_truncated
+
+
+# HTML内のmetaタグで宣言された文字コードを探す（Content-Typeにcharsetが無いサイト向け）
+_META_CHARSET_PATTERN = re.compile(rb'<meta[^>]+charset=["\']?([\w-]+)', re.IGNORECASE)
+
+
+# スクレイピング用に全リクエストで共有するHTTPクライアント
+# コネクションを使い回し、接続・読み込みのタイムアウト、本文サイズの上限、ホストごとの同時接続数の上限を設けている
+class HttpFetcher:
+    def __init__(
+        self,
+        connect_timeout: float = 3,
+        read_timeout: float = 5,
+        total_timeout: float = 15,
+        max_body_bytes: int = 2 * 1024 * 1024,
+        limit_per_host: int = 4,
+        limit: int = 100,
+        allowed_content_types: Tuple[str, ...] = ('text/html', 'application/xhtml+xml', 'text/plain'),
+    ):
+        self.timeout = aiohttp.ClientTimeout(
+            total=total_timeout,
+            sock_connect=connect_timeout,
+            sock_read=read_timeout,
+        )
+        self.max_body_bytes = max_body_bytes
+        self.limit_per_host = limit_per_host
+        self.limit = limit
+        self.allowed_content_types = allowed_content_types
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def fetch(
+        self,
+        url: str,
+        headers: Optional[dict] = None,
+    ) -> FetchedResponse:
+        async with self._get_session().get(url, headers=headers) as response:
+            response_headers = response.headers.copy()
+            if response.status == 304:
+                return FetchedResponse(status_code=304, headers=response_headers, text='', is_truncated=False)
+            # エラーレスポンスの場合は例外を発生させる
+            response.raise_for_status()
+
+            if response.content_type not in self.allowed_content_types:
+                raise UnsupportedContentTypeError(f'{url}: {response.content_type}')
+
+            # 本文は少しずつ読み込み、上限に達した時点で打ち切る（巨大なページで待たされない様に）
+            body = bytearray()
+            is_truncated = False
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                body.extend(chunk)
+                if len(body) >= self.max_body_bytes:
+                    del body[self.max_body_bytes:]
+                    is_truncated = True
+                    break
+
+            return FetchedResponse(
+                status_code=response.status,
+                headers=response_headers,
+                text=bytes(body).decode(self._detect_encoding(response, body), errors='replace'),
+                is_truncated=is_truncated,
+            )
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # ClientSessionはイベントループの中で生成する必要があるので、初回のリクエスト時に生成する
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=self.timeout,
+                connector=aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host),
+            )
+        return self._session
+
+    @staticmethod
+    def _detect_encoding(response: aiohttp.ClientResponse, body: bytearray) -> str:
+        encoding = response.charset
+        if not encoding and (match := _META_CHARSET_PATTERN.search(body[:4096])) is not None:
+            encoding = match.group(1).decode('ascii')
+        # 宣言が無い、もしくはPythonが知らない文字コード名の場合はUTF-8として扱う
+        try:
+            return codecs.lookup(encoding).name if encoding else 'utf-8'
+        except LookupError:
+            return 'utf-8'
@@ -0,0 +1,204 @@
+import asyncio
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.vectorstores import FAISS
+from pydantic import BaseModel
+
+from context_packer import count_tokens
+from lexical_index import normalize_text
+
+
+# 組織内データ検索のパラメータ（カテゴリごとに設定できる）
+class RetrievalSettings(BaseModel):
+    # 最終的に返すドキュメントの最大数
+    k: int = 3
+    # FAISSから1回の検索で取り出す候補の数（この中からMMRで選び直す）
+    fetch_k: int = 20
+    # MMRの関連度と多様性の重み（1に近いほど関連度のみ、0に近いほど多様性を重視する）
+    lambda_mult: float = 0.5
+    # これより距離（L2距離の2乗）が大きい候補は、関係ない情報として捨てる（Noneの場合は捨てない）
+    max_distance: Optional[float] = None
+    # 返すドキュメントの合計トークン数の上限（1件目は上限を超えていても返す）
+    max_tokens: int = 2000
+    # トークン数を数える際のモデル名
+    model_name: str = 'gpt-4o-mini'
+    # 転置インデックスがある場合に、文字n-gramのBM25とベクトル検索の結果を統合するかどうか
+    use_lexical_index: bool = True
+    # この文字数以下のクエリがそのまま含まれるドキュメントがあれば、embeddingを取得せずに転置インデックスだけで答える
+    lexical_fast_path_max_chars: int = 20
+    # Reciprocal Rank Fusionの定数（大きいほど下位の順位の影響が大きくなる）
+    rrf_k: int = 60
+
+
+# 検索方法ごとの件数を集計するクラス（転置インデックスだけで答えた分はembeddingのAPI呼び出しを省けている）
+class IndexRetrievalStats:
+    def __init__(self):
+        self.searches: Dict[str, int] = {}
+
+    def on_search(self, mode: str):
+        # mode: lexical_fast_path / hybrid / vector
+        self.searches[mode] = self.searches.get(mode, 0) + 1
+
+    def stats(self) -> dict:
+        return dict(self.searches)
+
+
+# プロセス全体で共有する集計値
+index_retrieval_stats = IndexRetrievalStats()
+
+
+def fuse_by_rrf(
+    rankings: Sequence[Sequence[int]],
+    rrf_k: int,
+) -> Dict[int, float]:
+    # 複数の検索結果の順位を、スコアの尺度に依らずに1つのスコアに統合する
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, position in enumerate(ranking):
+            scores[position] = scores.get(position, 0.0) + 1 / (rrf_k + rank + 1)
+    return dict(sorted(scores.items(), key=lambda item: item[1], reverse=True))
+
+
+def select_by_mmr(
+    query_vector: np.ndarray,
+    candidate_vectors: np.ndarray,
+    k: int,
+    lambda_mult: float,
+    # 関連度として、クエリとのcos類似度の代わりに使うスコア（ハイブリッド検索の統合スコアなど）
+    relevance_scores: Optional[np.ndarray] = None,
+) -> List[int]:
+    # 候補同士の類似度は最初に行列で一度だけ計算し、選んだ候補との最大類似度をベクトルのまま更新していく
+    norms = np.linalg.norm(candidate_vectors, axis=1, keepdims=True)
+    candidate_vectors = candidate_vectors / np.where(norms == 0, 1.0, norms)
+    if relevance_scores is not None:
+        # RRFのスコアは順位の差が小さく最大値で割るだけでは1付近に集まるので、候補の中で0〜1に広げて類似度と尺度を揃える
+        score_range = relevance_scores.max() - relevance_scores.min()
+        if score_range > 0:
+            query_similarities = (relevance_scores - relevance_scores.min()) / score_range
+        else:
+            query_similarities = np.ones_like(relevance_scores)
+    else:
+        query_vector = query_vector / (np.linalg.norm(query_vector) or 1.0)
+        query_similarities = candidate_vectors @ query_vector
+    pairwise_similarities = candidate_vectors @ candidate_vectors.T
+
+    selected = [int(np.argmax(query_similarities))]
+    max_similarities_to_selected = pairwise_similarities[selected[0]].copy()
+    while len(selected) < min(k, len(candidate_vectors)):
+        scores = lambda_mult * query_similarities - (1 - lambda_mult) * max_similarities_to_selected
+        scores[selected] = -np.inf
+        index = int(np.argmax(scores))
+        selected.append(index)
+        np.maximum(max_similarities_to_selected, pairwise_similarities[index], out=max_similarities_to_selected)
+    return selected
+
+
+def retrieve_documents(
+    query: str,
+    vector_store: FAISS,
+    settings: RetrievalSettings,
+) -> List[Document]:
+    lexical_index = getattr(vector_store, 'lexical_index', None) if settings.use_lexical_index else None
+
+    # 短いキーワードがそのまま含まれるドキュメントがあれば、embeddingを取得せずに返す
+    if lexical_index is not None and len(normalize_text(query)) <= settings.lexical_fast_path_max_chars:
+        if positions := lexical_index.find_exact(query, k=settings.k):
+            index_retrieval_stats.on_search('lexical_fast_path')
+            return _load_documents(vector_store, positions, settings)
+
+    query_vector = np.asarray(vector_store.embedding_function(query), dtype=np.float32)
+    distances, ids = vector_store.index.search(query_vector.reshape(1, -1), settings.fetch_k)
+    # 件数不足で埋められた-1を除き、候補ごとのクエリとの距離を覚えておく（順位の順のまま）
+    vector_distances = {int(i): float(distance) for i, distance in zip(ids[0], distances[0]) if i != -1}
+    # 距離のしきい値を超える候補を除く
+    vector_ranking = [
+        position for position, distance in vector_distances.items()
+        if settings.max_distance is None or distance <= settings.max_distance
+    ]
+
+    # 転置インデックスがある場合は、BM25の順位とベクトル検索の順位をRRFで統合した順を候補にする
+    relevance_scores: Optional[np.ndarray] = None
+    if lexical_index is not None:
+        lexical_ranking = [position for position, _ in lexical_index.search(query, k=settings.fetch_k)]
+        # BM25は1文字のbi-gramが一致するだけでも候補になるので、ベクトル検索と同じ距離のしきい値で関係ないものを除く
+        if settings.max_distance is not None:
+            lexical_ranking = _filter_by_distance(
+                vector_store, query_vector, lexical_ranking, vector_distances, settings.max_distance
+            )
+        fused_scores = fuse_by_rrf([vector_ranking, lexical_ranking], rrf_k=settings.rrf_k)
+        candidates = list(fused_scores.keys())[:settings.fetch_k]
+        relevance_scores = np.array([fused_scores[position] for position in candidates], dtype=np.float32)
+        index_retrieval_stats.on_search('hybrid')
+    else:
+        candidates = vector_ranking
+        index_retrieval_stats.on_search('vector')
+    if not candidates:
+        return []
+
+    # 候補のベクトルを取り出してMMRで選び直す（ベクトルを取り出せない形式のインデックスの場合は候補の順のまま使う）
+    try:
+        candidate_vectors = np.vstack([vector_store.index.reconstruct(position) for position in candidates])
+        order = select_by_mmr(
+            query_vector,
+            candidate_vectors,
+            k=settings.k,
+            lambda_mult=settings.lambda_mult,
+            relevance_scores=relevance_scores,
+        )
+    except RuntimeError:
+        order = list(range(min(settings.k, len(candidates))))
+    return _load_documents(vector_store, [candidates[i] for i in order], settings)
+
+
+def _filter_by_distance(
+    vector_store: FAISS,
+    query_vector: np.ndarray,
+    positions: Sequence[int],
+    known_distances: Dict[int, float],
+    max_distance: float,
+) -> List[int]:
+    # ベクトル検索の候補に入っていない位置は、ベクトルを取り出してクエリとの距離（L2距離の2乗）を計算する
+    # （ベクトルを取り出せない形式のインデックスの場合は、距離を確認できないので除く）
+    filtered = []
+    for position in positions:
+        distance = known_distances.get(position)
+        if distance is None:
+            try:
+                vector = vector_store.index.reconstruct(position)
+            except RuntimeError:
+                continue
+            distance = float(np.sum((vector - query_vector) ** 2))
+        if distance <= max_distance:
+            filtered.append(position)
+    return filtered
+
+
+def _load_documents(
+    vector_store: FAISS,
+    positions: Sequence[int],
+    settings: RetrievalSettings,
+) -> List[Document]:
+    # トークン数の上限に収まるだけ返す
+    documents: List[Document] = []
+    total_tokens = 0
+    for position in positions:
+        document = vector_store.docstore.search(vector_store.index_to_docstore_id[position])
+        if not isinstance(document, Document):
+            continue
+        tokens = count_tokens(document.page_content, settings.model_name)
+        if documents and total_tokens + tokens > settings.max_tokens:
+            break
+        documents.append(document)
+        total_tokens += tokens
+    return documents
+
+
+async def aretrieve_documents(
+    query: str,
+    vector_store: FAISS,
+    settings: RetrievalSettings,
+) -> List[Document]:
+    # クエリのembedding取得（通信あり）とFAISSの検索でイベントループを止めない様にexecutorで実行する
+    return await asyncio.get_running_loop().run_in_executor(None, retrieve_documents, query, vector_store, settings)
@@ -0,0 +1,280 @@
+# テキストのディレクトリからFAISSのインデックスを作成・更新するスクリプト（save_from_doc_using_faiss.pyの置き換え）
+# 使い方: python ingest_documents.py ./txt/2025 [./faiss_index/2025_2] [--batch-size 50] [--concurrency 4] [--max-retries 5]
+#                                  [--index-factory HNSW32] [--search-param efSearch=64]
+# （出力先を省略した場合は ./faiss_index/<テキストのディレクトリ名> に出力する）
+# （インデックスの種類を省略した場合は、既存のインデックスと同じ種類、無ければFlatで作成する）
+#
+# - チャンクごとの内容のハッシュをmanifest.jsonに保存しておき、追加・変更されたチャンクだけembeddingを取得する
+# - 削除されたチャンクのベクトルはインデックスから取り除く
+# - embeddingはバッチにまとめて並列に取得し、失敗した場合はリトライする
+# - 取得できたembeddingは都度チェックポイントに書き出すので、途中で落ちても再実行すれば続きから再開できる
+# - 圧縮する種類のインデックスからは元のベクトルを取り出せないので、元のベクトルはvectors.npyに保存して再構築に使う
+# - 作成のたびに versions/ 以下の新しいディレクトリに書き出し、最後にCURRENTを置き換えて切り替える（直前のバージョンは残しておく）
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+import dotenv
+import faiss
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.document_loaders import DirectoryLoader, TextLoader
+from langchain.embeddings.openai import OpenAIEmbeddings
+
+from faiss_index_config import VERSIONS_DIR_NAME, FaissIndexConfig, resolve_index_dir, switch_index_version
+from mmap_docstore import DOCSTORE_BLOB_FILE_NAME, DOCSTORE_OFFSETS_FILE_NAME, MmapDocstore, load_docstore
+from recursive_text_splitter import recursive_text_splitter
+
+# .envを読み込む
+dotenv.load_dotenv(dotenv.find_dotenv())
+
+MANIFEST_FILE_NAME = 'manifest.json'
+CHECKPOINT_FILE_NAME = '.ingest_checkpoint.jsonl'
+VECTORS_FILE_NAME = 'vectors.npy'
+# 切り替え後も残しておくバージョンの数（使用中のものを含む。戻したい場合はCURRENTを書き換える）
+KEPT_INDEX_VERSIONS = 2
+# CURRENTを使う前の形式で、index_dir直下に置かれていたファイル
+LEGACY_INDEX_FILE_NAMES = (
+    'index.faiss', 'index.pkl', DOCSTORE_BLOB_FILE_NAME, DOCSTORE_OFFSETS_FILE_NAME, VECTORS_FILE_NAME, MANIFEST_FILE_NAME,
+)
+
+
+def make_chunk_hash(document: Document) -> str:
+    # 同じ文章が別のファイルにあっても区別できる様に、ファイルのパスも含めてハッシュを取る
+    source = os.path.basename(document.metadata.get('source', ''))
+    return hashlib.sha256(f'{source}\0{document.page_content}'.encode('utf-8')).hexdigest()
+
+
+def load_chunks(source_dir: str) -> List[Tuple[str, Document]]:
+    loader = DirectoryLoader(source_dir, glob='**/*.txt', loader_cls=TextLoader, loader_kwargs={'encoding': 'utf-8'})
+    # 実行のたびにチャンクの順番が変わらない様に、ファイルのパス順に並べる
+    documents = sorted(loader.load(), key=lambda document: document.metadata.get('source', ''))
+    chunks = recursive_text_splitter.split_documents(documents)
+    return [(make_chunk_hash(chunk), chunk) for chunk in chunks]
+
+
+def load_manifest(index_dir: str) -> Optional[dict]:
+    manifest_file_path = os.path.join(index_dir, MANIFEST_FILE_NAME)
+    if not os.path.exists(manifest_file_path):
+        return None
+    with open(manifest_file_path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load_existing_vectors(index_dir: str) -> Dict[str, np.ndarray]:
+    # 既存のインデックスから、チャンクのハッシュごとにベクトルを取り出す
+    # manifest.jsonが無い古いインデックスでも、ドキュメントの内容からハッシュを計算して再利用できる
+    index_file_path = os.path.join(index_dir, 'index.faiss')
+    if not os.path.exists(index_file_path):
+        return {}
+    docstore, index_to_docstore_id = load_docstore(index_dir)
+    # 元のベクトルが保存されていればそれを使い、無ければ（Flatで作られた古いインデックスなど）インデックスから取り出す
+    vectors_file_path = os.path.join(index_dir, VECTORS_FILE_NAME)
+    if os.path.exists(vectors_file_path):
+        vectors = np.load(vectors_file_path)
+    else:
+        index = faiss.read_index(index_file_path)
+        vectors = index.reconstruct_n(0, index.ntotal)
+    existing = {}
+    for position, docstore_id in index_to_docstore_id.items():
+        document = docstore.search(docstore_id)
+        if isinstance(document, Document):
+            existing[make_chunk_hash(document)] = vectors[position]
+    return existing
+
+
+def load_checkpoint(index_dir: str) -> Dict[str, List[float]]:
+    checkpoint: Dict[str, List[float]] = {}
+    checkpoint_file_path = os.path.join(index_dir, CHECKPOINT_FILE_NAME)
+    if not os.path.exists(checkpoint_file_path):
+        return checkpoint
+    with open(checkpoint_file_path, encoding='utf-8') as f:
+        for line in f:
+            # 書き込み途中で落ちた最後の行は読み飛ばす
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            checkpoint[entry['hash']] = entry['embedding']
+    return checkpoint
+
+
+async def embed_with_retry(
+    embeddings: OpenAIEmbeddings,
+    texts: List[str],
+    max_retries: int,
+    backoff_base_seconds: float = 1,
+    backoff_max_seconds: float = 30,
+) -> List[List[float]]:
+    for attempt in range(max_retries + 1):
+        try:
+            return await embeddings.aembed_documents(texts)
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            # 同時にリトライが集中しない様に、待ち時間はランダムにばらつかせる（Full Jitter）
+            backoff_seconds = random.uniform(0, min(backoff_max_seconds, backoff_base_seconds * 2 ** attempt))
+            print(f'embeddingの取得をリトライ: attempt={attempt + 1}, error={e}, backoff_seconds={backoff_seconds:.2f}')
+            await asyncio.sleep(backoff_seconds)
+
+
+async def embed_chunks(
+    embeddings: OpenAIEmbeddings,
+    chunks: List[Tuple[str, Document]],
+    index_dir: str,
+    batch_size: int,
+    concurrency: int,
+    max_retries: int,
+) -> Dict[str, List[float]]:
+    # チェックポイントに残っている分（前回途中で落ちた実行で取得済みの分）は取得し直さない
+    embedded = load_checkpoint(index_dir)
+    pending = [(chunk_hash, chunk) for chunk_hash, chunk in chunks if chunk_hash not in embedded]
+    print(f'embedding: {len(chunks)} chunks, {len(chunks) - len(pending)} from checkpoint, {len(pending)} to embed')
+    if not pending:
+        return embedded
+
+    semaphore = asyncio.Semaphore(concurrency)
+    os.makedirs(index_dir, exist_ok=True)
+    with open(os.path.join(index_dir, CHECKPOINT_FILE_NAME), 'a', encoding='utf-8') as checkpoint_file:
+        async def embed_batch(batch: List[Tuple[str, Document]]):
+            async with semaphore:
+                vectors = await embed_with_retry(embeddings, [chunk.page_content for _, chunk in batch], max_retries)
+            # バッチごとにチェックポイントへ書き出しておく（イベントループ上からのみ書き込むので行が混ざることは無い）
+            for (chunk_hash, _), vector in zip(batch, vectors):
+                embedded[chunk_hash] = vector
+                checkpoint_file.write(json.dumps({'hash': chunk_hash, 'embedding': vector}) + '\n')
+            checkpoint_file.flush()
+            print(f'embedded {len(batch)} chunks')
+
+        await asyncio.gather(*[
+            embed_batch(pending[i:i + batch_size]) for i in range(0, len(pending), batch_size)
+        ])
+    return embedded
+
+
+def save_index(
+    index_dir: str,
+    chunks: List[Tuple[str, Document]],
+    vectors: Dict[str, np.ndarray],
+    index_config: FaissIndexConfig,
+):
+    # 残すチャンクのベクトルだけで作り直す（削除されたチャンクのベクトルはここで取り除かれる）
+    vector_array = np.array([vectors[chunk_hash] for chunk_hash, _ in chunks], dtype=np.float32)
+    index = index_config.build(vector_array)
+
+    # 書き込み途中で落ちても使用中のインデックスが壊れない様に、versions/以下の一時ディレクトリに全て書いてから
+    # バージョン名のディレクトリにrenameし、最後にCURRENTを置き換えて切り替える
+    versions_dir = os.path.join(index_dir, VERSIONS_DIR_NAME)
+    os.makedirs(versions_dir, exist_ok=True)
+    temp_dir = tempfile.mkdtemp(dir=versions_dir, prefix='.building-')
+    try:
+        faiss.write_index(index, os.path.join(temp_dir, 'index.faiss'))
+        # docstoreはmmapで必要な分だけ読み込める形式で保存する（FAISS上の位置がそのままIDになる）
+        MmapDocstore.write(temp_dir, [chunk for _, chunk in chunks])
+        np.save(os.path.join(temp_dir, VECTORS_FILE_NAME), vector_array)
+        with open(os.path.join(temp_dir, MANIFEST_FILE_NAME), 'w', encoding='utf-8') as f:
+            json.dump({
+                'index': index_config.dict(),
+                'chunks': [
+                    {'hash': chunk_hash, 'source': chunk.metadata.get('source', '')}
+                    for chunk_hash, chunk in chunks
+                ],
+            }, f, ensure_ascii=False, indent=2)
+        version = f'{time.strftime("%Y%m%d-%H%M%S")}-{os.path.basename(temp_dir).rsplit("-", 1)[-1]}'
+        os.rename(temp_dir, os.path.join(versions_dir, version))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    switch_index_version(index_dir, version)
+    remove_old_index_versions(index_dir, current_version=version)
+
+
+def remove_old_index_versions(index_dir: str, current_version: str):
+    # 切り替え前に読み込んだプロセスはファイルを開いたままなので、削除しても検索は続けられる
+    versions_dir = os.path.join(index_dir, VERSIONS_DIR_NAME)
+    versions = sorted(name for name in os.listdir(versions_dir) if not name.startswith('.') and name != current_version)
+    for version in versions[:max(len(versions) - (KEPT_INDEX_VERSIONS - 1), 0)]:
+        shutil.rmtree(os.path.join(versions_dir, version), ignore_errors=True)
+    # 以前の形式でindex_dir直下にあったファイルは、CURRENTを書いた後は読まれないので削除する
+    for file_name in LEGACY_INDEX_FILE_NAMES:
+        if os.path.exists(os.path.join(index_dir, file_name)):
+            os.remove(os.path.join(index_dir, file_name))
+
+
+async def ingest(
+    source_dir: str,
+    index_dir: str,
+    batch_size: int,
+    concurrency: int,
+    max_retries: int,
+    index_config: Optional[FaissIndexConfig] = None,
+    embeddings: Optional[OpenAIEmbeddings] = None,
+):
+    # リトライはembed_with_retry()で行うので、OpenAIEmbeddings自体のリトライ（既定で6回）は無効にして重ならない様にする
+    embeddings = embeddings or OpenAIEmbeddings(max_retries=0)
+    chunks = load_chunks(source_dir)
+    if not chunks:
+        print(f'{source_dir} にチャンクがありません')
+        return
+    current_index_dir = resolve_index_dir(index_dir)
+    existing = load_existing_vectors(current_index_dir)
+    manifest = load_manifest(current_index_dir)
+    previous_index_config = FaissIndexConfig.from_manifest(manifest)
+    index_config = index_config or previous_index_config
+
+    current_hashes = {chunk_hash for chunk_hash, _ in chunks}
+    new_chunks = [(chunk_hash, chunk) for chunk_hash, chunk in chunks if chunk_hash not in existing]
+    removed_count = len(set(existing) - current_hashes)
+    print(f'{source_dir} -> {index_dir}: {len(chunks)} chunks, '
+          f'{len(chunks) - len(new_chunks)} unchanged, {len(new_chunks)} new or changed, {removed_count} removed, index={index_config}')
+    if not new_chunks and removed_count == 0 and manifest is not None and index_config == previous_index_config:
+        print('変更が無いので、インデックスは更新しません')
+        return
+
+    new_vectors = await embed_chunks(embeddings, new_chunks, index_dir, batch_size, concurrency, max_retries)
+
+    vectors: Dict[str, np.ndarray] = {
+        chunk_hash: existing[chunk_hash] if chunk_hash in existing else np.asarray(new_vectors[chunk_hash], dtype=np.float32)
+        for chunk_hash, _ in chunks
+    }
+    save_index(index_dir, chunks, vectors, index_config)
+
+    # インデックスを保存できたらチェックポイントは不要になる
+    checkpoint_file_path = os.path.join(index_dir, CHECKPOINT_FILE_NAME)
+    if os.path.exists(checkpoint_file_path):
+        os.remove(checkpoint_file_path)
+    print(f'saved: {resolve_index_dir(index_dir)}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('source_dir')
+    parser.add_argument('index_dir', nargs='?')
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--max-retries', type=int, default=5)
+    parser.add_argument('--index-factory', help='faiss.index_factoryの文字列（例: Flat, HNSW32, IVF1024,Flat, IVF1024,PQ64, HNSW32,SQ8）')
+    parser.add_argument('--search-param', action='append', default=[], help='検索時のパラメータ（例: efSearch=64, nprobe=16）')
+    args = parser.parse_args()
+    if args.search_param and not args.index_factory:
+        parser.error('--search-param は --index-factory と一緒に指定してください')
+    index_config = None
+    if args.index_factory:
+        index_config = FaissIndexConfig(
+            factory=args.index_factory,
+            search_params={name: float(value) for name, value in (param.split('=', 1) for param in args.search_param)},
+        )
+    asyncio.run(ingest(
+        source_dir=args.source_dir,
+        index_dir=args.index_dir or os.path.join('./faiss_index', os.path.basename(os.path.normpath(args.source_dir))),
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+        max_retries=args.max_retries,
+        index_config=index_config,
+    ))
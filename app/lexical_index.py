@@ -0,0 +1,127 @@
+import math
+import unicodedata
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from langchain.vectorstores import FAISS
+
+
+def normalize_text(text: str) -> str:
+    # 全角・半角や大文字・小文字の違い、空白や改行の位置で一致しなくならない様に揃える
+    return ''.join(unicodedata.normalize('NFKC', text).lower().split())
+
+
+def make_ngrams(text: str, ngram_sizes: Sequence[int]) -> List[str]:
+    # 日本語は単語の区切りが無いので、形態素解析の代わりに文字単位のn-gramを語として扱う
+    ngrams = []
+    for n in ngram_sizes:
+        ngrams.extend(text[i:i + n] for i in range(len(text) - n + 1))
+    return ngrams
+
+
+# 文字bi-gram・tri-gramの転置インデックスで、BM25のスコア順にドキュメントを検索するクラス
+# 固有名詞・日付・地名など、embeddingでは拾いにくい語の完全一致に強い
+class CharNgramBM25Index:
+    def __init__(
+        self,
+        texts: Iterable[str],
+        # 完全一致の確認用に、位置からドキュメントの本文を取り出す関数（本文自体はこのクラスでは保持しない）
+        get_text: Callable[[int], str],
+        ngram_sizes: Tuple[int, ...] = (2, 3),
+        k1: float = 1.2,
+        b: float = 0.75,
+    ):
+        self.get_text = get_text
+        self.ngram_sizes = ngram_sizes
+        self.k1 = k1
+        self.b = b
+        # key: n-gram, value: [(ドキュメントの位置, 出現回数), ...]
+        self._postings: Dict[str, List[Tuple[int, int]]] = {}
+        self._lengths: List[int] = []
+        for position, text in enumerate(texts):
+            counts = Counter(make_ngrams(normalize_text(text), ngram_sizes))
+            self._lengths.append(sum(counts.values()))
+            for ngram, count in counts.items():
+                self._postings.setdefault(ngram, []).append((position, count))
+        self._average_length = sum(self._lengths) / len(self._lengths) if self._lengths else 0.0
+
+    @property
+    def term_count(self) -> int:
+        return len(self._postings)
+
+    def search(
+        self,
+        query: str,
+        k: int,
+    ) -> List[Tuple[int, float]]:
+        # (ドキュメントの位置, スコア)をスコアの高い順に返す
+        document_count = len(self._lengths)
+        scores: Dict[int, float] = {}
+        for ngram, query_count in Counter(make_ngrams(normalize_text(query), self.ngram_sizes)).items():
+            postings = self._postings.get(ngram)
+            if not postings:
+                continue
+            idf = math.log(1 + (document_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for position, count in postings:
+                length_ratio = self._lengths[position] / self._average_length if self._average_length else 1.0
+                tf = count * (self.k1 + 1) / (count + self.k1 * (1 - self.b + self.b * length_ratio))
+                scores[position] = scores.get(position, 0.0) + idf * tf * query_count
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+    def match_ratios(
+        self,
+        query: str,
+        positions: Iterable[int],
+    ) -> Dict[int, float]:
+        # クエリのn-gramのうち、各ドキュメントに含まれるものの割合をidfの重み付きで返す（0〜1）
+        # BM25のスコアはドキュメント数や長さで尺度が変わるので、関係あるかどうかのしきい値にはこちらを使う
+        # （どのドキュメントにも無いn-gramは、最も珍しいものとして重みを付ける）
+        document_count = len(self._lengths)
+        positions = set(positions)
+        matched_weights = dict.fromkeys(positions, 0.0)
+        total_weight = 0.0
+        for ngram in set(make_ngrams(normalize_text(query), self.ngram_sizes)):
+            postings = self._postings.get(ngram, [])
+            idf = math.log(1 + (document_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            total_weight += idf
+            for position, _ in postings:
+                if position in positions:
+                    matched_weights[position] += idf
+        return {position: weight / total_weight if total_weight else 0.0 for position, weight in matched_weights.items()}
+
+    def find_exact(
+        self,
+        query: str,
+        k: int,
+    ) -> List[int]:
+        # クエリ全体がそのまま含まれているドキュメントの位置を、BM25のスコア順に返す（見つからない場合は空）
+        normalized_query = normalize_text(query)
+        if len(normalized_query) < min(self.ngram_sizes):
+            return []
+        # クエリの全てのn-gramを含むドキュメントだけを、本文を取り出して完全一致するか確認する
+        candidates: Optional[set] = None
+        for ngram in set(make_ngrams(normalized_query, self.ngram_sizes)):
+            positions = {position for position, _ in self._postings.get(ngram, [])}
+            candidates = positions if candidates is None else candidates & positions
+            if not candidates:
+                return []
+        ranked = [position for position, _ in self.search(query, k=len(self._lengths)) if position in candidates]
+        matched = [position for position in ranked if normalized_query in normalize_text(self.get_text(position))]
+        return matched[:k]
+
+
+# FAISSのインデックスと同じ並び順で作った転置インデックスを一緒に持つベクトルストア
+class FAISSWithLexicalIndex(FAISS):
+    lexical_index: Optional[CharNgramBM25Index] = None
+
+
+def build_lexical_index(vector_store: FAISS) -> CharNgramBM25Index:
+    # 転置インデックス上の位置がFAISSのインデックス上の位置と一致する様に、同じ順番でドキュメントを並べる
+    def get_text(position: int) -> str:
+        document = vector_store.docstore.search(vector_store.index_to_docstore_id[position])
+        return getattr(document, 'page_content', '')
+    # 作成時には全ドキュメントを1件ずつ読むが、本文は保持しないのでmmapのdocstoreでも常駐するメモリは増えない
+    return CharNgramBM25Index(
+        (get_text(position) for position in range(vector_store.index.ntotal)),
+        get_text=get_text,
+    )
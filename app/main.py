@@ -1,17 +1,49 @@
-import json, threading
+import json, asyncio
 import system_prompts
 import vector_stores
+from answer_cache import AnswerCache
+from answer_stream_framing import CoalescingAnswerReader, answer_stream_framing_stats, encode_compact
+from assistant_function import http_fetcher, passage_extractor, serper_search_cache, web_contents_cache
 from fastapi import FastAPI, Request, HTTPException
 from starlette.middleware.cors import CORSMiddleware
 from sse_starlette import EventSourceResponse
 from callback_handler import CallbackHandler
+from cancellation import CancellationToken, cancellation_stats
 from chat_assistant import ChatAssistant
+from context_packer import token_usage_stats
+from env import Env
+from index_retriever import index_retrieval_stats
+from retrieval_fan_out import retrieval_fan_out_stats
+from session_store import SessionStore
+from speculative_index_search import speculative_index_search_stats
+from structured_logging import logging_stats, setup_logging, shutdown_logging
+from web_contents_scraper import deep_search_stats
 from data_models import AnswerResponseQueue, SendQuestionRequest, StreamAnswerResponseData, StreamErrorResponseData
 from chat_assistant import ChatAssistant
 from callback_handler import CallbackHandler
 
 app = FastAPI()
 
+# アプリのログは、キュー経由でバックグラウンドのスレッドから出力する
+setup_logging(level=Env.LOG_LEVEL or 'INFO')
+
+# 同じ様な質問に対して過去の回答をそのまま返すためのキャッシュ
+# 情報が古くなりやすいカテゴリは、環境変数でWeb検索を使わなかった回答の有効期限も短くできる（例: "0:3600,2:600"）
+answer_cache = AnswerCache(
+    ttl_seconds_by_category={
+        int(category_id): float(ttl_seconds)
+        for category_id, ttl_seconds in (
+            item.split(':') for item in (Env.ANSWER_CACHE_TTL_SECONDS_BY_CATEGORY or '').split(',') if item.strip()
+        )
+    },
+)
+# conversation_idごとに会話履歴をサーバー側で保持するストア
+session_store = SessionStore(db_path='./cache/sessions.sqlite3')
+# 組織内データ検索を投機的に始めるカテゴリ
+speculative_index_search_category_ids = {
+    int(category_id) for category_id in (Env.SPECULATIVE_INDEX_SEARCH_CATEGORY_IDS or '').split(',') if category_id.strip()
+}
+
 # CORSを回避するために追加
 app.add_middleware(
     CORSMiddleware,
@@ -22,11 +54,66 @@ app.add_middleware(
 )
 
 
+@app.on_event('startup')
+def warmup_vector_stores():
+    # 環境変数で指定されたカテゴリのインデックスだけ、最初のリクエストを待たずに起動時に読み込んでおく（例: "0,1"）
+    if Env.WARMUP_CATEGORY_IDS:
+        vector_stores.registry.warmup(int(category_id) for category_id in Env.WARMUP_CATEGORY_IDS.split(','))
+
+
+@app.on_event('shutdown')
+async def close_http_fetcher():
+    await http_fetcher.close()
+    await serper_search_cache.client.close()
+
+
+@app.on_event('shutdown')
+def close_session_store():
+    session_store.close()
+
+
+@app.on_event('shutdown')
+def close_embedding_cache():
+    vector_stores.embeddings.close()
+
+
+@app.on_event('shutdown')
+def close_web_contents_cache():
+    web_contents_cache.close()
+
+
+@app.on_event('shutdown')
+def flush_logs():
+    shutdown_logging()
+
+
 @app.get('/ping')
 def ping():
     return {'data': {'message': 'OK'}}
 
 
+@app.get('/stats')
+def stats():
+    return {'data': {
+        'cancellation': cancellation_stats.to_dict(),
+        'embedding_cache': vector_stores.embeddings.stats(),
+        'embedding_batcher': vector_stores.embedding_batcher.stats(),
+        'vector_stores': vector_stores.registry.stats(),
+        'answer_cache': answer_cache.stats(),
+        'serper_search_cache': serper_search_cache.stats(),
+        'web_contents_cache': web_contents_cache.stats(),
+        'passage_extractor': passage_extractor.stats(),
+        'deep_search': deep_search_stats.stats(),
+        'answer_stream_framing': answer_stream_framing_stats.stats(),
+        'logging': logging_stats.stats(),
+        'token_usage': token_usage_stats.stats(),
+        'session_store': session_store.stats(),
+        'speculative_index_search': speculative_index_search_stats.stats(),
+        'retrieval_fan_out': retrieval_fan_out_stats.stats(),
+        'index_retrieval': index_retrieval_stats.stats(),
+    }}
+
+
 @app.post('/chat')
 def get_answer(
         request: Request,
@@ -36,83 +123,148 @@ def get_answer(
 
     async def receive_answer_with_streamed_chat_completion_api():
         channel = AnswerResponseQueue()
-        task = threading.Thread(
-            target=handle_question,
-            args=(channel, body)
-        )
-        task.start()
+        cancellation_token = CancellationToken()
+        # リクエスト毎にスレッドを立てずに、同じイベントループ上のタスクとして回答処理を実行する
+        task = asyncio.create_task(handle_question(channel, body, cancellation_token))
+        cancellation_token.bind(task)
+        # コンパクト形式に対応したアプリの場合だけ、最終回答の断片をまとめて送る
+        if body.is_enabled_compact_stream:
+            reader = CoalescingAnswerReader(channel)
+            encode = encode_compact
+        else:
+            reader = channel
+            encode = lambda data: json.dumps(data.dict())
 
         answer_texts = []
-        while True:
-            if await request.is_disconnected():
-                # print("client disconnected")
-                return
+        try:
+            while True:
+                if await request.is_disconnected():
+                    # print("client disconnected")
+                    return
+
+                # chatbotから回答が送られてくるまで待機
+                # print("waiting for chatbot answer")
+                data = await reader.get()
+                # print("chatbot answer received")
+
+                # 送られてきたデータがStopIterationなら終了
+                if isinstance(data, StopIteration):
+                    # print("chatbot stream closed")
+                    # conversation_idがある場合は、今回のやり取りをサーバー側の会話履歴に追加する
+                    if body.conversation_id:
+                        await session_store.aappend_turn(
+                            conversation_id=body.conversation_id,
+                            question=body.text,
+                            answer=''.join(answer_texts),
+                        )
+                    break
+
+                # 送られてきたデータがException系ならraiseして脱出
+                if isinstance(data, StreamErrorResponseData):
+                    error_response = StreamAnswerResponseData(
+                        answer_type_id=2,  # 2: part_of_final_answer_text
+                        part_of_final_answer_text=data.message,
+                        status_code=data.status_code
+                    )
+                    # print("chatbot stream closed with error")
+                    yield encode(error_response)
+                    raise data
 
-            # chatbotから回答が送られてくるまで待機
-            # print("waiting for chatbot answer")
-            data = channel.get()
-            # print("chatbot answer received")
-
-            # 送られてきたデータがStopIterationなら終了
-            if isinstance(data, StopIteration):
-                # print("chatbot stream closed")
-                break
-
-            # 送られてきたデータがException系ならraiseして脱出
-            if isinstance(data, StreamErrorResponseData):
-                error_response = StreamAnswerResponseData(
-                    answer_type_id=2,  # 2: part_of_final_answer_text
-                    part_of_final_answer_text=data.message,
-                    status_code=data.status_code
-                )
-                # print("chatbot stream closed with error")
-                yield json.dumps(error_response.dict())
-                raise data
-
-            # 会話ログに保存するために追加
-            if isinstance(data, StreamAnswerResponseData) \
-                    and data.part_of_final_answer_text is not None:
-                answer_texts.append(data.part_of_final_answer_text)
-
-            # 普通のAIからの返答なら、ユーザー側に返す
-            yield json.dumps(data.dict())
-            # print(f"chatbot stream data sent: {data.dict()}")
+                # 会話ログに保存するために追加
+                if isinstance(data, StreamAnswerResponseData) \
+                        and data.part_of_final_answer_text is not None:
+                    answer_texts.append(data.part_of_final_answer_text)
+
+                # 普通のAIからの返答なら、ユーザー側に返す
+                yield encode(data)
+                # print(f"chatbot stream data sent: {data.dict()}")
+        finally:
+            # クライアントが切断した場合（このジェネレーターが途中で閉じられた場合も含む）は、
+            # 誰も読まない回答の生成やWeb検索を続けない様に、回答処理全体を中断させる
+            if not task.done():
+                # print("client disconnected")
+                cancellation_token.cancel()
 
     return EventSourceResponse(receive_answer_with_streamed_chat_completion_api())
 
 
-def handle_question(
+async def handle_question(
         sender: AnswerResponseQueue,
         body: SendQuestionRequest,
+        cancellation_token: CancellationToken,
 ):
     # print("handle_question started")
     match body.category_id:
         case 0:
             system_role_prompt_text = system_prompts.CATEGORY_0_SYSTEM_PROMPT
-            vector_store = vector_stores.vector_store_2025
         case 1:
             system_role_prompt_text = system_prompts.CATEGORY_1_SYSTEM_PROMPT
-            vector_store = vector_stores.vector_store_2022
         case 2:
             system_role_prompt_text = system_prompts.CATEGORY_2_SYSTEM_PROMPT                            
-            vector_store = vector_stores.vector_store_2019
     
     try:
+        # conversation_idがある場合は、サーバー側で保持している会話履歴を使う
+        history_messages = None
+        previous_messages = body.previous_messages
+        if body.conversation_id:
+            session = await session_store.aget(body.conversation_id)
+            history_messages = session.to_history_messages()
+            previous_messages = session.to_previous_messages()
+
+        # カテゴリに対応するインデックスは初めて使われた時に読み込まれる
+        # 回答キャッシュの確認用のembeddingの取得と同時に読み込みを始めて、キャッシュに無かった場合に待つ時間を減らす
+        vector_store_task = asyncio.ensure_future(vector_stores.registry.aget(body.category_id))
+        # キャッシュにあって使わなかった場合も、読み込みの失敗の例外はここで受け取って捨てる（次のリクエストで改めて読み込む）
+        vector_store_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+        # 会話履歴が短い場合は、過去にほぼ同じ質問がされていればその回答をそのまま返す
+        # （質問のembeddingはembeddingのキャッシュに入るので、同じ質問での投機的な組織内データ検索では再取得しない）
+        question_embedding = None
+        if answer_cache.is_cacheable(previous_messages):
+            question_embedding = await vector_stores.embeddings.aembed_query(body.text)
+            if (cached_events := answer_cache.lookup(
+                category_id=body.category_id,
+                previous_messages=previous_messages,
+                question_embedding=question_embedding,
+            )) is not None:
+                for data in cached_events:
+                    sender.send(data)
+                sender.close()
+                return
+
+        vector_store = await vector_store_task
         assistant = ChatAssistant(
             callback_handler=CallbackHandler(queue=sender),
+            cancellation_token=cancellation_token,
             sendQuestionRequest=body,
             vector_store=vector_store,
             model_name='gpt-4o-mini',
             temperature=0.7,
             use_latest_information=True,
             is_enabled_web_and_index_data_integrated_mode=False,
-            system_role_prompt_text=system_role_prompt_text
+            system_role_prompt_text=system_role_prompt_text,
+            history_messages=history_messages,
+            is_enabled_speculative_index_search=body.category_id in speculative_index_search_category_ids,
+            retrieval_settings=vector_stores.registry.get_retrieval_settings(body.category_id),
         )
-        assistant.get_answer()
+        await assistant.get_answer()
+
+        if question_embedding is not None:
+            answer_cache.store(
+                category_id=body.category_id,
+                previous_messages=previous_messages,
+                question_embedding=question_embedding,
+                events=sender.sent_data,
+            )
     
         sender.close()
         # print("handle_question finished")
 
+    except asyncio.CancelledError:
+        # クライアント切断による中断なので、エラーとしては扱わずにそのまま終了させる
+        # print("handle_question cancelled")
+        raise
+
     except HTTPException as e:
         sender.send_error(e)
         raise e   
@@ -0,0 +1,108 @@
+import json
+import mmap
+import os
+import pickle
+from typing import Iterator, Sequence, Tuple, Union
+
+import numpy as np
+from langchain.docstore.base import Docstore
+from langchain.docstore.document import Document
+
+# 全ドキュメントの本文とメタデータ（JSON）を順に連結したファイル
+DOCSTORE_BLOB_FILE_NAME = 'docstore.bin'
+# ドキュメントごとの (本文の開始位置, 本文のバイト数, メタデータのバイト数)
+DOCSTORE_OFFSETS_FILE_NAME = 'docstore_offsets.npy'
+
+
+# FAISSのインデックス上の位置をそのままdocstoreのIDとして使う対応表
+# （件数分のdictを持たずに済む様に、FAISSが使う操作だけを実装している）
+class PositionalIdMap:
+    def __init__(self, size: int):
+        self._size = size
+
+    def __getitem__(self, position: int) -> int:
+        if not 0 <= position < self._size:
+            raise KeyError(position)
+        return position
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(range(self._size))
+
+    def keys(self) -> Iterator[int]:
+        return iter(range(self._size))
+
+    def values(self) -> Iterator[int]:
+        return iter(range(self._size))
+
+    def items(self) -> Iterator[Tuple[int, int]]:
+        return ((position, position) for position in range(self._size))
+
+
+# ファイルをmmapして、検索で取り出されたドキュメントだけをその都度Documentにするdocstore
+# index.pklの様に起動時に全ドキュメントをunpickleしないので、読み込みが速く、メモリも使った分しか増えない
+# （ページキャッシュはOSが管理するので、複数workerで同じインデックスを読んでも共有される）
+class MmapDocstore(Docstore):
+    def __init__(self, directory: str):
+        self._offsets = np.load(os.path.join(directory, DOCSTORE_OFFSETS_FILE_NAME), mmap_mode='r')
+        self._mmap = None
+        with open(os.path.join(directory, DOCSTORE_BLOB_FILE_NAME), 'rb') as f:
+            # 空のファイルはmmapできないので、ドキュメントが無い場合はmmapしない
+            if os.fstat(f.fileno()).st_size > 0:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def search(self, search: Union[int, str]) -> Union[str, Document]:
+        # 見つからない場合は、LangChainのInMemoryDocstoreと同じくメッセージの文字列を返す
+        try:
+            position = int(search)
+        except ValueError:
+            return f'ID {search} not found.'
+        if not 0 <= position < len(self._offsets):
+            return f'ID {search} not found.'
+        text_offset, text_length, metadata_length = (int(value) for value in self._offsets[position])
+        metadata_offset = text_offset + text_length
+        return Document(
+            page_content=self._mmap[text_offset:metadata_offset].decode('utf-8'),
+            metadata=json.loads(self._mmap[metadata_offset:metadata_offset + metadata_length]),
+        )
+
+    @staticmethod
+    def write(directory: str, documents: Sequence[Document]):
+        # FAISSのインデックス上の位置の順にドキュメントを渡すこと
+        offsets = np.zeros((len(documents), 3), dtype=np.int64)
+        position = 0
+        with open(os.path.join(directory, DOCSTORE_BLOB_FILE_NAME), 'wb') as f:
+            for i, document in enumerate(documents):
+                text = document.page_content.encode('utf-8')
+                metadata = json.dumps(document.metadata, ensure_ascii=False).encode('utf-8')
+                f.write(text)
+                f.write(metadata)
+                offsets[i] = (position, len(text), len(metadata))
+                position += len(text) + len(metadata)
+        np.save(os.path.join(directory, DOCSTORE_OFFSETS_FILE_NAME), offsets)
+
+
+def load_docstore(directory: str) -> Tuple[Docstore, Union[dict, PositionalIdMap]]:
+    # mmap形式に変換済みであればそちらを使い、無ければ従来のindex.pklを読み込む
+    if os.path.exists(os.path.join(directory, DOCSTORE_OFFSETS_FILE_NAME)):
+        docstore = MmapDocstore(directory)
+        return docstore, PositionalIdMap(len(docstore))
+    with open(os.path.join(directory, 'index.pkl'), 'rb') as f:
+        return pickle.load(f)
+
+
+def get_docstore_file_bytes(directory: str) -> int:
+    # load_docstore()で実際に読み込む方のファイルサイズを返す
+    if os.path.exists(os.path.join(directory, DOCSTORE_OFFSETS_FILE_NAME)):
+        file_names = [DOCSTORE_BLOB_FILE_NAME, DOCSTORE_OFFSETS_FILE_NAME]
+    else:
+        file_names = ['index.pkl']
+    return sum(
+        os.path.getsize(os.path.join(directory, file_name)) for file_name in file_names
+        if os.path.exists(os.path.join(directory, file_name))
+    )
@@ -0,0 +1,98 @@
+import re
+import time
+from typing import List, Optional
+
+from context_packer import count_tokens
+from lexical_index import CharNgramBM25Index
+
+
+# 文の区切り（日本語の句点・感嘆符・疑問符の直後と、英文のピリオドの後の空白）
+SENTENCE_BOUNDARY_PATTERN = re.compile(r'(?<=[。！？!?])\s*|(?<=\.)\s+')
+
+
+def split_into_passages(content: str, max_chars: int = 300) -> List[str]:
+    # 文の区切りで分けた上で、max_charsを超えない範囲で前後の文をまとめて1つのパッセージにする
+    # （1文だけでmax_charsを超える場合は、その文をmax_charsごとに区切る）
+    passages = []
+    current = ''
+    for sentence in SENTENCE_BOUNDARY_PATTERN.split(content):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        if current and len(current) + 1 + len(sentence) > max_chars:
+            passages.append(current)
+            current = ''
+        while len(sentence) > max_chars:
+            passages.append(sentence[:max_chars])
+            sentence = sentence[max_chars:]
+        current = f'{current} {sentence}' if current else sentence
+    if current:
+        passages.append(current)
+    return passages
+
+
+# スクレイピングしたページの中から質問に関連する部分を、LLMを呼ばずにCPU上で抽出するクラス
+# ページをパッセージに分けて文字n-gramのBM25で質問との関連度を計算し、上位のパッセージをトークン数の上限まで元の順番で並べて返す
+# （16kモデルでの要約に比べて文章の言い換えはできないが、1ページあたり数ミリ秒で終わり、トークンの料金もかからない）
+class LocalPassageExtractor:
+    def __init__(
+        self,
+        max_tokens: int = 500,
+        model_name: str = 'gpt-3.5-turbo-16k',
+        passage_max_chars: int = 300,
+        # 質問のn-gramのうちパッセージに含まれる割合（idfの重み付き、0〜1）がこの値未満のパッセージは使わず、
+        # 1つも残らない場合はLLMでの要約に任せる（BM25のスコアはページのパッセージ数で尺度が変わるので、しきい値には使わない）
+        # 既定値は benchmark_passage_extractor.py --sweep で、関係のない質問が全てLLMに任され、関連する質問の情報が全て残る範囲から選んだ
+        min_match_ratio: float = 0.1,
+    ):
+        self.max_tokens = max_tokens
+        self.model_name = model_name
+        self.passage_max_chars = passage_max_chars
+        self.min_match_ratio = min_match_ratio
+
+        self.extractions = 0
+        self.fallbacks = 0
+        self.total_extract_ms = 0.0
+        self.total_output_tokens = 0
+
+    def extract(
+        self,
+        content: str,
+        query: str,
+    ) -> Optional[str]:
+        # 関連するパッセージが1つも無かった場合はNoneを返す
+        started_at = time.perf_counter()
+        passages = split_into_passages(content, max_chars=self.passage_max_chars)
+        index = CharNgramBM25Index(passages, get_text=passages.__getitem__)
+        ranked = index.search(query, k=len(passages))
+        match_ratios = index.match_ratios(query, (position for position, _ in ranked))
+        ranked = [(position, score) for position, score in ranked if match_ratios[position] >= self.min_match_ratio]
+
+        selected_positions = []
+        token_count = 0
+        for position, _ in ranked:
+            passage_tokens = count_tokens(passages[position], self.model_name)
+            if token_count + passage_tokens > self.max_tokens:
+                # 上限に収まらないパッセージは飛ばし、より短い下位のパッセージで残りを埋める
+                continue
+            selected_positions.append(position)
+            token_count += passage_tokens
+
+        self.total_extract_ms += (time.perf_counter() - started_at) * 1000
+        if not selected_positions:
+            self.fallbacks += 1
+            return None
+        self.extractions += 1
+        self.total_output_tokens += token_count
+        # ページ内での元の順番に並べ直して、文脈が読み取れる様にする
+        return '\n'.join(passages[position] for position in sorted(selected_positions))
+
+    def stats(self) -> dict:
+        total = self.extractions + self.fallbacks
+        return {
+            'extractions': self.extractions,
+            'fallbacks': self.fallbacks,
+            'fallback_rate': self.fallbacks / total if total else 0.0,
+            'avg_extract_ms': self.total_extract_ms / total if total else 0.0,
+            'avg_output_tokens': self.total_output_tokens / self.extractions if self.extractions else 0.0,
+        }
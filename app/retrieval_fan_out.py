@@ -0,0 +1,121 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+
+# 各検索（ブランチ）の結果
+class RetrievalBranchResult:
+    name: str
+    # 成功した場合の戻り値（タイムアウト・失敗した場合はNone）
+    value: Any
+    # ok（成功） / timeout（期限内に終わらなかった） / error（例外が発生した）
+    status: str
+    elapsed_ms: float
+
+    def __init__(
+        self,
+        name: str,
+        value: Any,
+        status: str,
+        elapsed_ms: float,
+    ):
+        self.name = name
+        self.value = value
+        self.status = status
+        self.elapsed_ms = elapsed_ms
+
+    @property
+    def is_ok(self) -> bool:
+        return self.status == 'ok'
+
+
+# ブランチごとの所要時間とタイムアウト・失敗の件数を集計するクラス（期限の調整用）
+class RetrievalFanOutStats:
+    def __init__(self):
+        self.branches: Dict[str, dict] = {}
+
+    def record(self, result: RetrievalBranchResult):
+        branch = self.branches.setdefault(result.name, {
+            'runs': 0,
+            'ok': 0,
+            'timeout': 0,
+            'error': 0,
+            'total_ms': 0.0,
+            'max_ms': 0.0,
+        })
+        branch['runs'] += 1
+        branch[result.status] += 1
+        branch['total_ms'] += result.elapsed_ms
+        branch['max_ms'] = max(branch['max_ms'], result.elapsed_ms)
+
+    def stats(self) -> dict:
+        return {
+            name: {
+                'runs': branch['runs'],
+                'ok': branch['ok'],
+                'timeout': branch['timeout'],
+                'error': branch['error'],
+                'avg_ms': branch['total_ms'] / branch['runs'] if branch['runs'] else 0.0,
+                'max_ms': branch['max_ms'],
+            }
+            for name, branch in self.branches.items()
+        }
+
+
+# プロセス全体で共有する集計値
+retrieval_fan_out_stats = RetrievalFanOutStats()
+
+
+# 複数の検索を同時に実行し、それぞれの期限までに返ってきた結果だけを集めるクラス
+# 期限を過ぎたブランチは中断し、他のブランチの結果だけで回答を続けられる様にする
+class RetrievalFanOut:
+    def __init__(self):
+        self._branches: List[tuple] = []
+
+    def add_branch(
+        self,
+        name: str,
+        run: Callable[[], Awaitable[Any]],
+        deadline_seconds: float,
+    ):
+        # run: 検索を行うコルーチンを返す関数（イベントループを止める処理はrun側でexecutorに逃がしておくこと）
+        self._branches.append((name, run, deadline_seconds))
+
+    async def run(self) -> Dict[str, RetrievalBranchResult]:
+        # 呼び出し元（回答処理）が中断された場合は、gatherによって全ブランチも一緒に中断される
+        results = await asyncio.gather(*[
+            self._run_branch(name=name, run=run, deadline_seconds=deadline_seconds)
+            for name, run, deadline_seconds in self._branches
+        ])
+        return {result.name: result for result in results}
+
+    async def _run_branch(
+        self,
+        name: str,
+        run: Callable[[], Awaitable[Any]],
+        deadline_seconds: float,
+    ) -> RetrievalBranchResult:
+        started_at = time.perf_counter()
+        value: Optional[Any] = None
+        try:
+            value = await asyncio.wait_for(run(), timeout=deadline_seconds)
+            status = 'ok'
+        except asyncio.TimeoutError:
+            logger.warning('検索が期限内に終わらなかった', branch=name, deadline_seconds=deadline_seconds)
+            status = 'timeout'
+        except Exception as e:
+            # 1つのブランチの失敗で回答全体を失敗させない
+            logger.warning('検索に失敗', branch=name, error=repr(e))
+            status = 'error'
+        result = RetrievalBranchResult(
+            name=name,
+            value=value,
+            status=status,
+            elapsed_ms=(time.perf_counter() - started_at) * 1000,
+        )
+        retrieval_fan_out_stats.record(result)
+        return result
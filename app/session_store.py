@@ -0,0 +1,247 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional, Set, Tuple
+
+import openai
+from pydantic import BaseModel
+
+from env import Env
+from structured_logging import get_logger
+
+
+# pythonのOpenAIラッパーライブラリに環境変数からAPIキーをセットする
+openai.api_key = Env.OPENAI_API_KEY
+
+logger = get_logger(__name__)
+
+
+# サーバー側で保持する1つの会話
+class ConversationSession(BaseModel):
+    conversation_id: str
+    # 古いやり取りをまとめた要約（まだ無い場合は空文字）
+    summary: str = ''
+    # 要約に含まれていない新しいやり取り（ChatCompletionのmessage形式）
+    messages: List[dict] = []
+    updated_at: float = 0
+
+    def to_history_messages(self) -> List[dict]:
+        # 要約があれば、それを会話履歴の先頭に入れる
+        history = []
+        if self.summary:
+            history.append({
+                "role": "system",
+                "content": f"これまでの会話の要約: {self.summary}"
+            })
+        history.extend(self.messages)
+        return history
+
+    def to_previous_messages(self) -> List[str]:
+        # クライアントから送られてくるprevious_messagesと同じ「Human:/AI:」形式に戻す（回答キャッシュの判定用）
+        previous_messages = [f'Summary: {self.summary}'] if self.summary else []
+        for message in self.messages:
+            prefix = 'Human:' if message['role'] == 'user' else 'AI:'
+            previous_messages.append(f'{prefix} {message["content"]}')
+        return previous_messages
+
+
+# 会話IDごとに会話履歴をサーバー側で保持するクラス
+# クライアントは毎回全履歴を送らずに、会話IDと新しい質問だけを送ればよくなる
+# 古いやり取りは要約にまとめていくので、会話が長くなってもプロンプトのサイズは一定以下に保たれる
+class SessionStore:
+    def __init__(
+        self,
+        # 要約せずにそのまま保持するmessageの数（これを超えた古いものは要約にまとめる）
+        max_recent_messages: int = 6,
+        max_sessions: int = 10000,
+        ttl_seconds: float = 60 * 60 * 24 * 7,
+        db_path: Optional[str] = None,
+        # SQLiteに保持する会話の数の上限（期限切れのものとは別に、古いものから削除する）
+        max_disk_sessions: int = 100000,
+        summary_model_name: str = 'gpt-4o-mini',
+    ):
+        self.max_recent_messages = max_recent_messages
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_sessions = max_disk_sessions
+        self.summary_model_name = summary_model_name
+
+        self._sessions: 'OrderedDict[str, ConversationSession]' = OrderedDict()
+        # 要約処理中の会話ID（同じ会話を同時に要約しない様に）
+        self._summarizing: Set[str] = set()
+        # 実行中の要約タスク（途中でGCされない様に参照を持っておく）
+        self._tasks: Set[asyncio.Task] = set()
+
+        self._db: Optional[sqlite3.Connection] = None
+        self._disk_writes = 0
+        # SQLiteの読み書きは、イベントループを止めない様に専用の1スレッドで順番に行う（書き込みの順番が入れ替わらない様に1スレッドにしている）
+        self._db_executor: Optional[ThreadPoolExecutor] = None
+        if db_path:
+            os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+            # 作成したスレッドと読み書きするスレッドが異なるので、スレッドの確認は無効にしている（作成後のアクセスは専用のスレッドからのみ）
+            self._db = sqlite3.connect(db_path, timeout=5, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS sessions ('
+                'conversation_id TEXT PRIMARY KEY, summary TEXT NOT NULL, messages TEXT NOT NULL, updated_at REAL NOT NULL)'
+            )
+            # 期限切れや上限を超えた古いものを削除する際に、全件を並べ替えない様にする
+            self._db.execute('CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)')
+            self._db.commit()
+            self._db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='session-store-db')
+
+    def get(self, conversation_id: str) -> ConversationSession:
+        # メモリに無い場合はSQLiteから読み込むまで待つので、イベントループ上からはaget()を使う
+        session = self._sessions.get(conversation_id)
+        if session is None and self._db_executor is not None:
+            session = self._make_session(conversation_id, self._db_executor.submit(self._load_row, conversation_id).result())
+        return self._get_or_create(conversation_id, session)
+
+    async def aget(self, conversation_id: str) -> ConversationSession:
+        session = self._sessions.get(conversation_id)
+        if session is None and self._db_executor is not None:
+            row = await asyncio.wrap_future(self._db_executor.submit(self._load_row, conversation_id))
+            # 読み込みを待つ間に、同じ会話IDのやり取りがメモリに追加されていればそちらを優先する
+            session = self._sessions.get(conversation_id) or self._make_session(conversation_id, row)
+        return self._get_or_create(conversation_id, session)
+
+    async def aappend_turn(
+        self,
+        conversation_id: str,
+        question: str,
+        answer: str,
+    ):
+        # 回答中にメモリから追い出されていた場合も、SQLiteからの読み込みでイベントループを止めない
+        session = await self.aget(conversation_id)
+        session.messages.extend([
+            {"role": "user", "content": question},
+            {"role": "assistant", "content": answer},
+        ])
+        self._save(session)
+
+        # 保持するmessageが多くなってきたら、古いものを要約にまとめる（回答の返却を待たせない様にバックグラウンドで行う）
+        if len(session.messages) > self.max_recent_messages and conversation_id not in self._summarizing:
+            task = asyncio.create_task(self._summarize_old_messages(session))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def stats(self) -> dict:
+        return {
+            'sessions': len(self._sessions),
+            'summarizing': len(self._summarizing),
+        }
+
+    def close(self):
+        # 書き込み待ちの分を書き終えてから閉じる
+        if self._db_executor is not None:
+            self._db_executor.shutdown(wait=True)
+            self._db_executor = None
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    async def _summarize_old_messages(self, session: ConversationSession):
+        conversation_id = session.conversation_id
+        self._summarizing.add(conversation_id)
+        try:
+            old_message_count = len(session.messages) - self.max_recent_messages
+            if old_message_count <= 0:
+                return
+            old_messages = session.messages[:old_message_count]
+            transcript = '\n'.join(
+                f'{"ユーザー" if message["role"] == "user" else "AI"}: {message["content"]}' for message in old_messages
+            )
+            response = await openai.ChatCompletion.acreate(
+                model=self.summary_model_name,
+                temperature=0,
+                max_tokens=500,
+                messages=[{
+                    "role": "user",
+                    "content": f"## 命令文:これまでの会話の要約と新しいやり取りを統合し、今後の会話の文脈として必要な情報を残した要約を作成してください。\n\n## これまでの会話の要約:{session.summary}\n\n## 新しいやり取り:\n{transcript}"
+                }],
+            )
+            # 要約中に会話が期限切れやメモリからの追い出しで別のオブジェクトに置き換わっていたり、
+            # 先頭のやり取りが要約したものと変わっていたりする場合は、要約を反映しない（次回のやり取りの後に改めて要約する）
+            if self._sessions.get(conversation_id) is not session or session.messages[:old_message_count] != old_messages:
+                logger.info('要約中に会話が変わったので要約を反映しない', conversation_id=conversation_id)
+                return
+            # 要約中に新しいやり取りが追加されている可能性があるので、要約した分だけを先頭から取り除く
+            session.summary = response["choices"][0]["message"]["content"]
+            del session.messages[:old_message_count]
+            self._save(session)
+        except Exception as e:
+            # 要約に失敗しても会話自体は続けられるので、次回のやり取りの後に再度試す
+            logger.warning('会話の要約に失敗', conversation_id=conversation_id, error=repr(e))
+        finally:
+            self._summarizing.discard(conversation_id)
+
+    def _get_or_create(self, conversation_id: str, session: Optional[ConversationSession]) -> ConversationSession:
+        # 保持していない（もしくは期限切れの）会話IDの場合は、新しい会話として扱う
+        if session is None or time.time() - session.updated_at > self.ttl_seconds:
+            session = ConversationSession(conversation_id=conversation_id)
+        self._remember(session)
+        return session
+
+    @staticmethod
+    def _make_session(conversation_id: str, row: Optional[Tuple[str, str, float]]) -> Optional[ConversationSession]:
+        if row is None:
+            return None
+        return ConversationSession(
+            conversation_id=conversation_id,
+            summary=row[0],
+            messages=json.loads(row[1]),
+            updated_at=row[2],
+        )
+
+    def _load_row(self, conversation_id: str) -> Optional[Tuple[str, str, float]]:
+        # 専用のスレッドで実行される
+        return self._db.execute(
+            'SELECT summary, messages, updated_at FROM sessions WHERE conversation_id = ?', (conversation_id,)
+        ).fetchone()
+
+    def _remember(self, session: ConversationSession):
+        self._sessions[session.conversation_id] = session
+        self._sessions.move_to_end(session.conversation_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    def _save(self, session: ConversationSession):
+        session.updated_at = time.time()
+        self._remember(session)
+        if self._db_executor is not None:
+            # この時点の内容をJSONにしてから渡し、書き込みとcommitは専用のスレッドで行う（回答の返却はディスクへの書き込みを待たない）
+            row = (session.conversation_id, session.summary, json.dumps(session.messages, ensure_ascii=False), session.updated_at)
+            self._db_executor.submit(self._write_row, row).add_done_callback(self._on_write_done)
+
+    def _write_row(self, row: Tuple[str, str, str, float]):
+        # 専用のスレッドで実行される
+        self._db.execute(
+            'INSERT OR REPLACE INTO sessions (conversation_id, summary, messages, updated_at) VALUES (?, ?, ?, ?)', row
+        )
+        self._db.commit()
+        self._trim_disk()
+
+    def _trim_disk(self):
+        # 書き込みの度に削除すると重いので、一定回数ごとに期限切れのものと、上限を超えた古いものを削除する
+        # 専用のスレッドで実行される
+        self._disk_writes += 1
+        if self._disk_writes % 100 != 0:
+            return
+        self._db.execute('DELETE FROM sessions WHERE updated_at < ?', (time.time() - self.ttl_seconds,))
+        self._db.execute(
+            'DELETE FROM sessions WHERE rowid IN ('
+            'SELECT rowid FROM sessions ORDER BY updated_at DESC LIMIT -1 OFFSET ?)',
+            (self.max_disk_sessions,)
+        )
+        self._db.commit()
+
+    @staticmethod
+    def _on_write_done(future: Future):
+        # 書き込みに失敗してもメモリ上の会話は続けられるので、ログに残すだけにする
+        if (error := future.exception()) is not None:
+            logger.warning('会話履歴の保存に失敗', error=repr(error))
@@ -0,0 +1,126 @@
+import asyncio
+import unicodedata
+from typing import Dict, Optional, Set
+
+from langchain.vectorstores import VectorStore
+
+from assistant_function import AssistantFunctionType
+from cancellation import CancellationToken
+from index_retriever import RetrievalSettings
+from structured_logging import get_logger
+
+
+logger = get_logger(__name__)
+
+
+# 投機的な組織内データ検索の結果をカテゴリごとに集計するクラス（しきい値や有効にするカテゴリの調整用）
+class SpeculativeIndexSearchStats:
+    def __init__(self):
+        self.categories: Dict[int, Dict[str, int]] = {}
+
+    def on_event(self, category_id: int, event: str):
+        # event: started（開始） / hit（結果を使った） / miss（クエリが離れていたので捨てた） / failed（投機的な検索自体が失敗した）
+        #        unused（index検索が選ばれなかったので捨てた）
+        counts = self.categories.setdefault(category_id, {'started': 0, 'hit': 0, 'miss': 0, 'failed': 0, 'unused': 0})
+        counts[event] += 1
+
+    def stats(self) -> dict:
+        result = {}
+        for category_id, counts in self.categories.items():
+            finished = counts['hit'] + counts['miss'] + counts['failed'] + counts['unused']
+            result[str(category_id)] = {
+                **counts,
+                'hit_rate': counts['hit'] / finished if finished else 0.0,
+                'waste_rate': (counts['miss'] + counts['failed'] + counts['unused']) / finished if finished else 0.0,
+            }
+        return result
+
+
+# プロセス全体で共有する集計値
+speculative_index_search_stats = SpeculativeIndexSearchStats()
+
+
+def _make_bigrams(text: str) -> Set[str]:
+    # GPTが決めるクエリはキーワードを空白で区切ったものが多いので、区切りを跨いだbigramは作らない
+    bigrams = set()
+    for word in unicodedata.normalize('NFKC', text).lower().split():
+        if len(word) < 2:
+            bigrams.add(word)
+        else:
+            bigrams.update(word[i:i + 2] for i in range(len(word) - 1))
+    return bigrams
+
+
+# 1回目のChatCompletionと同時に、ユーザーの質問そのものをクエリにして組織内データ検索を始めておくクラス
+# GPTがsearch_on_index_dataを選び、そのクエリが元の質問と十分近ければ、先に始めておいた検索結果をそのまま使う
+class SpeculativeIndexSearch:
+    def __init__(
+        self,
+        vector_store: VectorStore,
+        retrieval_settings: RetrievalSettings,
+        question: str,
+        category_id: int,
+        # GPTが決めたクエリの文字bigramのうち、元の質問にも含まれる割合がこれ以上なら「近い」とみなす
+        # （クエリに元の質問に無い語が足されている場合は、投機的な検索では拾えない結果があり得るので使わない）
+        similarity_threshold: float = 0.8,
+    ):
+        self.vector_store = vector_store
+        self.retrieval_settings = retrieval_settings
+        self.question = question
+        self.category_id = category_id
+        self.similarity_threshold = similarity_threshold
+        self._task: Optional[asyncio.Task] = None
+        self._is_finished = False
+
+    def start(self, cancellation_token: CancellationToken):
+        self._task = asyncio.create_task(
+            AssistantFunctionType.Search_On_Index_Data(
+                query=self.question,
+                vector_store=self.vector_store,
+                retrieval_settings=self.retrieval_settings,
+            )
+        )
+        # クライアントが切断した場合は、投機的な検索も一緒に中断させる
+        cancellation_token.track(self._task)
+        self._task.add_done_callback(self._on_task_done)
+        speculative_index_search_stats.on_event(self.category_id, 'started')
+
+    async def take(self, query: str) -> Optional[str]:
+        # GPTが決めたクエリが元の質問と近ければ、投機的に検索した結果を返す（離れていればNoneを返すので、通常通り検索する）
+        if self._task is None or self._is_finished:
+            return None
+        self._is_finished = True
+        if self._similarity(query) < self.similarity_threshold:
+            self._task.cancel()
+            speculative_index_search_stats.on_event(self.category_id, 'miss')
+            return None
+        try:
+            result = await self._task
+        except Exception as e:
+            # 投機的な検索が失敗していた場合は、通常通り検索させる
+            logger.warning('投機的な組織内データ検索に失敗', category_id=self.category_id, error=repr(e))
+            speculative_index_search_stats.on_event(self.category_id, 'failed')
+            return None
+        speculative_index_search_stats.on_event(self.category_id, 'hit')
+        return result
+
+    def discard(self):
+        # index検索が選ばれなかった場合（もしくは途中で中断された場合）は、投機的な検索を止める
+        if self._task is None or self._is_finished:
+            return
+        self._is_finished = True
+        self._task.cancel()
+        speculative_index_search_stats.on_event(self.category_id, 'unused')
+
+    def _similarity(self, query: str) -> float:
+        question_bigrams = _make_bigrams(self.question)
+        query_bigrams = _make_bigrams(query)
+        if not question_bigrams or not query_bigrams:
+            return 0.0
+        return len(question_bigrams & query_bigrams) / len(query_bigrams)
+
+    @staticmethod
+    def _on_task_done(task: asyncio.Task):
+        # 結果を使わずに捨てた検索が失敗していても、"Task exception was never retrieved"にならない様に例外を取り出しておく
+        if not task.cancelled() and (error := task.exception()) is not None:
+            logger.debug('投機的な組織内データ検索が終了（失敗）', error=repr(error))
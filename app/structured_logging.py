@@ -0,0 +1,198 @@
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+from typing import Any, Dict, Optional
+
+
+# アプリのロガーは全てこの名前の下に作る（uvicornやライブラリのログの出力方法は変えない）
+APP_LOGGER_NAME = 'app'
+# 文字列のフィールドをこの文字数で切り詰める（Serperの結果や会話履歴などを丸ごと出力しない様に）
+DEFAULT_MAX_FIELD_CHARS = 1000
+# 出力待ちのログの上限（出力が追いつかない場合は、回答処理を待たせずに捨てる）
+DEFAULT_MAX_QUEUE_SIZE = 10000
+
+# LogRecordに元から存在する引数（これ以外のキーワード引数は構造化ログのフィールドとして扱う）
+_LOGGING_KWARGS = ('exc_info', 'stack_info', 'stacklevel', 'extra')
+
+
+# キューに積んだ件数、キューが一杯で捨てた件数、間引いた件数を集計するクラス
+class LoggingStats:
+    def __init__(self):
+        self.enqueued = 0
+        self.dropped = 0
+        self.sampled_out = 0
+
+    def stats(self) -> dict:
+        return {
+            'enqueued': self.enqueued,
+            'dropped': self.dropped,
+            'sampled_out': self.sampled_out,
+        }
+
+
+# プロセス全体で共有する集計値
+logging_stats = LoggingStats()
+
+
+# キーワード引数をフィールドとして受け取れるロガー
+# 例: logger.info('vector store loaded', category_id=0, load_ms=12.3)
+# トークンごとなど頻度の高いログは sample_every=N を指定すると、N回に1回だけ出力する
+class StructuredLogger(logging.LoggerAdapter):
+    def __init__(self, logger: logging.Logger):
+        super().__init__(logger, {})
+        # key: メッセージ, value: これまでに呼ばれた回数（sample_everyを指定したログだけ数える）
+        self._sample_counts: Dict[str, int] = {}
+
+    def log(self, level: int, msg: Any, *args, sample_every: Optional[int] = None, **kwargs):
+        # 出力しないレベルの場合は、フィールドの組み立ても行わない
+        if not self.isEnabledFor(level):
+            return
+        if sample_every is not None and sample_every > 1:
+            count = self._sample_counts.get(msg, 0)
+            self._sample_counts[msg] = count + 1
+            if count % sample_every != 0:
+                logging_stats.sampled_out += 1
+                return
+            kwargs['sample_every'] = sample_every
+        msg, kwargs = self.process(msg, kwargs)
+        # 呼び出し元のファイルや行番号はJSONに出力しないので、Logger.log()の様にスタックを辿って探さずにLogRecordを作る
+        # （logging._srcfileを書き換えるとアプリ以外のロガーにも影響するので、アプリのロガーだけで省く）
+        exc_info = kwargs.get('exc_info')
+        if exc_info:
+            if isinstance(exc_info, BaseException):
+                exc_info = (type(exc_info), exc_info, exc_info.__traceback__)
+            elif not isinstance(exc_info, tuple):
+                exc_info = sys.exc_info()
+        record = self.logger.makeRecord(
+            self.logger.name, level, '(unknown file)', 0, msg, args, exc_info or None, extra=kwargs['extra'],
+        )
+        self.logger.handle(record)
+
+    def debug(self, msg: Any, *args, **kwargs):
+        self.log(logging.DEBUG, msg, *args, **kwargs)
+
+    def info(self, msg: Any, *args, **kwargs):
+        self.log(logging.INFO, msg, *args, **kwargs)
+
+    def warning(self, msg: Any, *args, **kwargs):
+        self.log(logging.WARNING, msg, *args, **kwargs)
+
+    def error(self, msg: Any, *args, **kwargs):
+        self.log(logging.ERROR, msg, *args, **kwargs)
+
+    def exception(self, msg: Any, *args, exc_info=True, **kwargs):
+        self.log(logging.ERROR, msg, *args, exc_info=exc_info, **kwargs)
+
+    def process(self, msg: Any, kwargs: dict):
+        fields = {key: kwargs.pop(key) for key in list(kwargs) if key not in _LOGGING_KWARGS}
+        kwargs['extra'] = {**kwargs.get('extra', {}), 'fields': fields}
+        return msg, kwargs
+
+
+# 1件のログを1行のJSONにするフォーマッタ（バックグラウンドのスレッドで呼ばれる）
+# メッセージとフィールドは、キューに積む時点で_NonBlockingQueueHandlerが切り詰め済み
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            **getattr(record, 'fields', {}),
+        }
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc_info'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def _truncate_field(value: Any, max_field_chars: int) -> Any:
+    # 呼び出し元が後から書き換えても変わらない値（数値・文字列か、JSONにして読み直したコピー）を返す
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if not isinstance(value, str):
+        # リストやdictなどは、長さを確認するために文字列にする
+        text = json.dumps(value, ensure_ascii=False, default=str)
+        if len(text) <= max_field_chars:
+            return json.loads(text)
+        value = text
+    if len(value) <= max_field_chars:
+        return value
+    return f'{value[:max_field_chars]}...(+{len(value) - max_field_chars} chars)'
+
+
+# キューが一杯の場合は待たずにログを捨てるQueueHandler
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue: queue.Queue, max_field_chars: int = DEFAULT_MAX_FIELD_CHARS):
+        super().__init__(log_queue)
+        self.max_field_chars = max_field_chars
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+            logging_stats.enqueued += 1
+        except queue.Full:
+            logging_stats.dropped += 1
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 会話履歴のリストなどは呼び出し元でこの後も書き換えられるので、メッセージとフィールドはキューに積む時点の内容で確定させる
+        # （切り詰めた後の値を積むので、出力待ちのログが持つメモリも上限の文字数分で済む）
+        record.msg = _truncate_field(record.getMessage(), self.max_field_chars)
+        record.args = None
+        record.fields = {
+            key: _truncate_field(value, self.max_field_chars)
+            for key, value in getattr(record, 'fields', {}).items()
+        }
+        # 例外のトレースバックもこのスレッドで文字列にしておく（JSONの組み立てと出力はバックグラウンドのスレッドで行う）
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+# 終了時に、キューが一杯でも書き出しが追いつくのを待って終了の合図を積むQueueListener
+class _QueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def get_logger(name: str) -> StructuredLogger:
+    return StructuredLogger(logging.getLogger(f'{APP_LOGGER_NAME}.{name}'))
+
+
+def setup_logging(
+    level: str = 'INFO',
+    max_field_chars: int = DEFAULT_MAX_FIELD_CHARS,
+    max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE,
+):
+    # アプリのロガーの出力を、キュー経由でバックグラウンドのスレッドから標準出力にJSONで書き出す様にする
+    # （回答のストリーミング中のイベントループでは、キューに積むだけで標準出力への書き込みを待たない）
+    global _listener
+    if _listener is not None:
+        return
+    log_queue = queue.Queue(maxsize=max_queue_size)
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+    _listener = _QueueListener(log_queue, stream_handler)
+    _listener.start()
+
+    app_logger = logging.getLogger(APP_LOGGER_NAME)
+    app_logger.setLevel(level.upper())
+    app_logger.addHandler(_NonBlockingQueueHandler(log_queue, max_field_chars=max_field_chars))
+    app_logger.propagate = False
+
+
+def shutdown_logging():
+    # キューに残っているログを書き出してからスレッドを止める
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    _listener = None
@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+
+# app/ のモジュールはフラットに import しているので、テストからも同じ様に import できる様にする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# vector_storesなどはimport時にOpenAIのクライアントを作るので、APIキーが無い環境でもimportできる様にする（テストではAPIを呼ばない）
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+import context_packer  # noqa: E402
+import html_text_extractor  # noqa: E402
+
+
+# tiktokenのエンコーディングはネットワークからダウンロードされるので、テストでは1文字を1トークンとして数える
+class CharEncoding:
+    def encode(self, text: str):
+        return [ord(char) for char in text]
+
+    def decode(self, tokens):
+        return ''.join(chr(token) for token in tokens)
+
+
+@pytest.fixture(autouse=True)
+def char_encoding(monkeypatch):
+    monkeypatch.setattr(context_packer, 'get_encoding', lambda model_name: CharEncoding())
+    monkeypatch.setattr(html_text_extractor, 'get_encoding', lambda model_name: CharEncoding())
+    context_packer._count_serialized_function_tokens.cache_clear()
+    yield
+    context_packer._count_serialized_function_tokens.cache_clear()
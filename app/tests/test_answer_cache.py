@@ -0,0 +1,77 @@
+import time
+
+from answer_cache import AnswerCache
+from data_models import StreamAnswerResponseData
+
+
+def make_events(*texts: str, source_url_list=None):
+    events = []
+    if source_url_list is not None:
+        events.append(StreamAnswerResponseData(answer_type_id=1, source_url_list=source_url_list))
+    events.append(StreamAnswerResponseData(answer_type_id=5, web_contents_scraping_progress=100))
+    events.extend(StreamAnswerResponseData(answer_type_id=2, part_of_final_answer_text=text) for text in texts)
+    return events
+
+
+def test_lookup_hits_only_above_similarity_threshold():
+    cache = AnswerCache(similarity_threshold=0.97)
+    cache.store(0, [], [1.0, 0.0], make_events('回答'))
+    assert cache.lookup(0, [], [0.99, 0.01]) is not None
+    assert cache.lookup(0, [], [0.7, 0.7]) is None
+    # カテゴリや会話履歴が違う場合はヒットしない
+    assert cache.lookup(1, [], [1.0, 0.0]) is None
+    assert cache.lookup(0, ['前の質問'], [1.0, 0.0]) is None
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 3
+
+
+def test_store_merges_answer_text_and_drops_progress_events():
+    cache = AnswerCache()
+    cache.store(0, [], [1.0, 0.0], make_events('有給', '休暇は', '20日です。', source_url_list=['https://example.com']))
+    events = cache.lookup(0, [], [1.0, 0.0])
+    assert [data.answer_type_id for data in events] == [1, 2]
+    assert events[1].part_of_final_answer_text == '有給休暇は20日です。'
+
+
+def test_store_skips_events_without_final_answer():
+    cache = AnswerCache()
+    cache.store(0, [], [1.0, 0.0], make_events())
+    assert cache.stats()['entries'] == 0
+
+
+def test_web_search_answers_use_shorter_ttl(monkeypatch):
+    cache = AnswerCache(ttl_seconds=3600, web_search_ttl_seconds=60)
+    cache.store(0, [], [1.0, 0.0], make_events('社内の回答'))
+    cache.store(0, [], [0.0, 1.0], make_events('Webの回答', source_url_list=['https://example.com']))
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 120)
+    assert cache.lookup(0, [], [1.0, 0.0]) is not None
+    assert cache.lookup(0, [], [0.0, 1.0]) is None
+    assert cache.stats()['entries'] == 1
+
+
+def test_store_evicts_oldest_entry_over_max_entries():
+    cache = AnswerCache(max_entries=2)
+    for i, embedding in enumerate([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]):
+        cache.store(0, [], embedding, make_events(f'回答{i}'))
+    assert cache.stats()['evictions'] == 1
+    assert cache.lookup(0, [], [1.0, 0.0, 0.0]) is None
+    assert cache.lookup(0, [], [0.0, 0.0, 1.0])[0].part_of_final_answer_text == '回答2'
+
+
+def test_is_cacheable_limits_history_length():
+    cache = AnswerCache(max_history_messages=2)
+    assert cache.is_cacheable(['a', 'b'])
+    assert not cache.is_cacheable(['a', 'b', 'c'])
+
+
+def test_ttl_can_be_shortened_per_category(monkeypatch):
+    cache = AnswerCache(ttl_seconds=3600, web_search_ttl_seconds=600, ttl_seconds_by_category={1: 60})
+    cache.store(0, [], [1.0, 0.0], make_events('回答'))
+    cache.store(1, [], [1.0, 0.0], make_events('回答'))
+    cache.store(2, [], [1.0, 0.0], make_events('回答', source_url_list=['https://example.com']))
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 120)
+    assert cache.lookup(0, [], [1.0, 0.0]) is not None
+    assert cache.lookup(1, [], [1.0, 0.0]) is None
+    assert cache.lookup(2, [], [1.0, 0.0]) is not None
@@ -0,0 +1,66 @@
+import asyncio
+import json
+
+from answer_stream_framing import CoalescingAnswerReader, encode_compact
+from data_models import AnswerResponseQueue, StreamAnswerResponseData
+
+
+def answer_text(text: str) -> StreamAnswerResponseData:
+    return StreamAnswerResponseData(answer_type_id=2, part_of_final_answer_text=text)
+
+
+def test_encode_compact_answer_text():
+    frame = encode_compact(answer_text('こんにちは"'))
+    assert frame == '{"answer_type_id":2,"part_of_final_answer_text":"こんにちは\\""}'
+    assert json.loads(frame) == {'answer_type_id': 2, 'part_of_final_answer_text': 'こんにちは"'}
+
+
+def test_encode_compact_drops_none_fields():
+    frame = encode_compact(StreamAnswerResponseData(answer_type_id=1, source_url_list=['https://example.com/あ']))
+    assert frame == '{"answer_type_id":1,"source_url_list":["https://example.com/あ"]}'
+    # 最終回答の断片でも、ステータスコード付きのものは通常の形式にする
+    frame = encode_compact(StreamAnswerResponseData(answer_type_id=2, part_of_final_answer_text='エラー', status_code=500))
+    assert json.loads(frame) == {'answer_type_id': 2, 'part_of_final_answer_text': 'エラー', 'status_code': 500}
+
+
+def test_reader_coalesces_answer_text_and_keeps_other_data_in_order():
+    async def run():
+        channel = AnswerResponseQueue()
+        progress = StreamAnswerResponseData(answer_type_id=5, web_contents_scraping_progress=100)
+        for data in [progress, answer_text('有給'), answer_text('休暇は')]:
+            channel.send(data)
+        channel.close()
+        channel.send(answer_text('続き'))
+        reader = CoalescingAnswerReader(channel, max_wait_seconds=0.01)
+        return [await reader.get() for _ in range(4)]
+
+    results = asyncio.run(run())
+    assert results[0].answer_type_id == 5
+    assert results[1].part_of_final_answer_text == '有給休暇は'
+    # まとめている途中で届いたデータは、次のget()で返す
+    assert isinstance(results[2], StopIteration)
+    assert results[3].part_of_final_answer_text == '続き'
+
+
+def test_reader_returns_after_max_bytes():
+    async def run():
+        channel = AnswerResponseQueue()
+        for text in ['あ', 'い', 'う']:
+            channel.send(answer_text(text))
+        reader = CoalescingAnswerReader(channel, max_wait_seconds=1.0, max_bytes=6)
+        return [await reader.get(), await reader.get()]
+
+    first, second = asyncio.run(run())
+    assert first.part_of_final_answer_text == 'あい'
+    assert second.part_of_final_answer_text == 'う'
+
+
+def test_reader_waits_for_chunks_until_deadline():
+    async def run():
+        channel = AnswerResponseQueue()
+        reader = CoalescingAnswerReader(channel, max_wait_seconds=0.2)
+        channel.send(answer_text('前半'))
+        asyncio.get_running_loop().call_later(0.02, channel.send, answer_text('後半'))
+        return await reader.get()
+
+    assert asyncio.run(run()).part_of_final_answer_text == '前半後半'
@@ -0,0 +1,31 @@
+import copy
+import json
+
+import pytest
+
+from assistant_function import AssistantFunctionType, get_function_infos
+
+
+def test_function_infos_cannot_be_modified():
+    function_info = get_function_infos(use_latest_information=True, is_enabled_web_and_index_data_integrated_mode=False)[0]
+    with pytest.raises(TypeError):
+        function_info['description'] = '書き換え'
+    with pytest.raises(TypeError):
+        function_info['parameters']['properties'].pop('query')
+    with pytest.raises(AttributeError):
+        function_info['parameters']['required'].append('other')
+
+
+def test_function_infos_serialize_like_plain_dicts():
+    function_info = get_function_infos(use_latest_information=False, is_enabled_web_and_index_data_integrated_mode=False)[0]
+    plain_info = AssistantFunctionType.Search_On_Index_Data.get_function_info()
+    assert json.loads(json.dumps(function_info)) == plain_info
+    assert json.dumps(function_info, ensure_ascii=False) == json.dumps(plain_info, ensure_ascii=False)
+
+
+def test_deep_copy_is_modifiable():
+    function_info = get_function_infos(use_latest_information=False, is_enabled_web_and_index_data_integrated_mode=False)[0]
+    copied_info = copy.deepcopy(function_info)
+    copied_info['parameters']['required'].append('other')
+    assert copied_info['parameters']['required'] == ['query', 'other']
+    assert function_info['parameters']['required'] == ('query',)
@@ -0,0 +1,49 @@
+from context_packer import ContextPacker, count_message_tokens
+from conversation_state import ConversationState
+
+
+MODEL_NAME = 'gpt-4o-mini'
+
+
+def make_state(history_count: int, function_result: str = '') -> ConversationState:
+    state = ConversationState(functions=(), system_role_prompt_text='あなたは社内ヘルプデスクです。')
+    state.extend_history([
+        {'role': 'user' if i % 2 == 0 else 'assistant', 'content': f'履歴{i}' * 10}
+        for i in range(history_count)
+    ])
+    state.append({'role': 'user', 'content': '今回の質問'})
+    if function_result:
+        state.append({'role': 'function', 'name': 'search', 'content': function_result})
+    return state
+
+
+def test_pack_keeps_everything_within_budget():
+    state = make_state(history_count=4)
+    packed = ContextPacker(MODEL_NAME, reserved_completion_tokens=0, max_context_tokens=10000).pack(state)
+    assert packed.messages == state.messages
+    assert packed.dropped_history_messages == 0
+    assert packed.truncated_messages == 0
+
+
+def test_pack_drops_oldest_history_first():
+    state = make_state(history_count=4)
+    # 会話履歴を2件だけ入れられる上限にする
+    budget = count_message_tokens(state.leading_messages + state.history_messages[2:] + state.current_turn_messages, MODEL_NAME)
+    packed = ContextPacker(MODEL_NAME, reserved_completion_tokens=0, max_context_tokens=budget).pack(state)
+    assert packed.dropped_history_messages == 2
+    assert packed.messages == state.leading_messages + state.history_messages[2:] + state.current_turn_messages
+    assert packed.prompt_tokens <= packed.budget_tokens
+
+
+def test_pack_truncates_function_result_before_dropping_system_or_question():
+    state = make_state(history_count=2, function_result='検索結果' * 500)
+    budget = count_message_tokens(state.leading_messages + state.current_turn_messages, MODEL_NAME) - 100
+    packed = ContextPacker(MODEL_NAME, reserved_completion_tokens=0, max_context_tokens=budget).pack(state)
+    assert packed.truncated_messages == 1
+    assert packed.dropped_history_messages == 2
+    assert packed.prompt_tokens <= packed.budget_tokens
+    # systemと今回の質問は削らず、functionの結果は先頭から残す
+    assert packed.messages[0] == state.messages[0]
+    assert packed.messages[1] == {'role': 'user', 'content': '今回の質問'}
+    assert state.messages[-1]['content'].startswith(packed.messages[-1]['content'])
+    assert len(packed.messages[-1]['content']) == 2000 - 100
@@ -0,0 +1,54 @@
+import asyncio
+import sqlite3
+from typing import List
+
+from langchain.embeddings.base import Embeddings
+
+from embedding_cache import CachedQueryEmbeddings
+
+
+class CountingEmbeddings(Embeddings):
+    def __init__(self):
+        self.calls = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        self.calls += 1
+        return [float(len(text)), 1.0]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return self.embed_query(text)
+
+
+def test_memory_cache_normalizes_width_and_spaces():
+    embeddings = CountingEmbeddings()
+    cache = CachedQueryEmbeddings(embeddings, model_name='test')
+    assert cache.embed_query('深瀬 の経歴') == cache.embed_query('  深瀬　の経歴 ')
+    assert embeddings.calls == 1
+    assert cache.stats()['memory_hits'] == 1
+
+
+def test_disk_cache_is_shared_across_instances(tmp_path):
+    db_path = str(tmp_path / 'query_embeddings.sqlite3')
+    embeddings = CountingEmbeddings()
+    cache = CachedQueryEmbeddings(embeddings, model_name='test', db_path=db_path)
+    expected = asyncio.run(cache.aembed_query('深瀬の経歴'))
+    # 書き込みは専用のスレッドで行われるので、閉じる時に書き終えるのを待つ
+    cache.close()
+
+    other_cache = CachedQueryEmbeddings(embeddings, model_name='test', db_path=db_path)
+    assert asyncio.run(other_cache.aembed_query('深瀬の経歴')) == expected
+    assert embeddings.calls == 1
+    assert other_cache.stats()['disk_hits'] == 1
+    other_cache.close()
+
+
+def test_disk_cache_has_created_at_index(tmp_path):
+    db_path = str(tmp_path / 'query_embeddings.sqlite3')
+    CachedQueryEmbeddings(CountingEmbeddings(), model_name='test', db_path=db_path).close()
+    plan = sqlite3.connect(db_path).execute(
+        'EXPLAIN QUERY PLAN SELECT key FROM query_embeddings ORDER BY created_at DESC LIMIT -1 OFFSET 10'
+    ).fetchall()
+    assert 'query_embeddings_created_at' in str(plan)
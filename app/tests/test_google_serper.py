@@ -0,0 +1,53 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+from fake_serper_server import start_fake_serper_server
+from google_serper import AsyncSerperClient, CustomGoogleSerper, parse_serper_results
+
+
+def test_parse_serper_results_prefers_answer_box_and_limits_links():
+    results = {
+        'answerBox': {'snippet': '東京\n千代田区'},
+        'organic': [{'link': f'https://example.com/{i}', 'snippet': f'結果{i}'} for i in range(5)],
+    }
+    parsed = parse_serper_results(results=results, k=3)
+    assert parsed.answer_box == '東京 千代田区'
+    assert parsed.links == ['https://example.com/0', 'https://example.com/1', 'https://example.com/2']
+    # 同期版の整形結果と同じになる
+    assert CustomGoogleSerper(serper_api_key='test', k=3)._parse_results(results=results) == parsed
+
+
+def test_search_through_fake_server():
+    async def run():
+        runner, base_url = await start_fake_serper_server(latency_ms=0)
+        client = AsyncSerperClient(api_key='test', base_url=base_url)
+        try:
+            return await client.search('有給休暇', k=2), client.stats()
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    result, stats = asyncio.run(run())
+    assert len(result.links) == 2
+    assert stats['requests'] == 1
+
+
+def test_client_error_is_counted_without_retry():
+    async def run():
+        runner, base_url = await start_fake_serper_server(latency_ms=0)
+        # 存在しないパスに向けて404を返させる
+        client = AsyncSerperClient(api_key='test', base_url=f'{base_url}/missing')
+        try:
+            with pytest.raises(aiohttp.ClientResponseError):
+                await client.search('有給休暇')
+            return client.stats()
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    stats = asyncio.run(run())
+    assert stats['requests'] == 1
+    assert stats['retries'] == 0
+    assert stats['client_errors'] == 1
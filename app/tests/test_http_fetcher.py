@@ -0,0 +1,74 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+from fake_web_server import PAGE_ETAG, PAGE_HTML, start_fake_web_server
+from http_fetcher import HttpFetcher, UnsupportedContentTypeError
+
+
+def run_with_server(scenario, **fetcher_kwargs):
+    # 偽サーバーを起動し、scenario(fetcher, base_url)を実行してから両方を閉じる
+    async def run():
+        runner, base_url = await start_fake_web_server()
+        fetcher = HttpFetcher(**fetcher_kwargs)
+        try:
+            return await scenario(fetcher, base_url)
+        finally:
+            await fetcher.close()
+            await runner.cleanup()
+    return asyncio.run(run())
+
+
+def test_fetch_returns_page_with_validators():
+    response = run_with_server(lambda fetcher, base_url: fetcher.fetch(f'{base_url}/page'))
+    assert response.status_code == 200
+    assert response.text == PAGE_HTML
+    assert response.headers['etag'] == PAGE_ETAG
+    assert not response.is_truncated
+
+
+def test_fetch_returns_304_when_etag_matches():
+    response = run_with_server(
+        lambda fetcher, base_url: fetcher.fetch(f'{base_url}/page', headers={'If-None-Match': PAGE_ETAG})
+    )
+    assert response.status_code == 304
+    assert response.text == ''
+
+
+def test_fetch_follows_redirect():
+    response = run_with_server(lambda fetcher, base_url: fetcher.fetch(f'{base_url}/redirect'))
+    assert response.status_code == 200
+    assert response.text == PAGE_HTML
+
+
+def test_fetch_truncates_body_over_limit():
+    response = run_with_server(
+        lambda fetcher, base_url: fetcher.fetch(f'{base_url}/large?bytes={1024 * 1024}'),
+        max_body_bytes=100 * 1024,
+    )
+    assert response.is_truncated
+    assert len(response.text) == 100 * 1024
+
+
+def test_fetch_decodes_with_meta_charset():
+    response = run_with_server(lambda fetcher, base_url: fetcher.fetch(f'{base_url}/shift_jis'))
+    assert '日本語のページです。' in response.text
+
+
+def test_fetch_times_out_on_slow_response():
+    with pytest.raises(asyncio.TimeoutError):
+        run_with_server(
+            lambda fetcher, base_url: fetcher.fetch(f'{base_url}/slow?seconds=1'),
+            read_timeout=0.2,
+        )
+
+
+def test_fetch_rejects_unsupported_content_type():
+    with pytest.raises(UnsupportedContentTypeError):
+        run_with_server(lambda fetcher, base_url: fetcher.fetch(f'{base_url}/image'))
+
+
+def test_fetch_raises_on_error_status():
+    with pytest.raises(aiohttp.ClientResponseError):
+        run_with_server(lambda fetcher, base_url: fetcher.fetch(f'{base_url}/error'))
@@ -0,0 +1,72 @@
+from typing import List
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+from index_retriever import RetrievalSettings, fuse_by_rrf, retrieve_documents, select_by_mmr
+from lexical_index import FAISSWithLexicalIndex, build_lexical_index
+
+
+# キーワードごとに1つの次元を持つ、決まったベクトルを返すembedding（どのキーワードも含まない文章は最後の次元になる）
+class KeywordEmbeddings(Embeddings):
+    keywords = ['有給休暇', '交通費', '健康診断']
+
+    def _embed(self, text: str) -> List[float]:
+        vector = [1.0 if keyword in text else 0.0 for keyword in self.keywords]
+        return vector + [0.0 if any(vector) else 1.0]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+def make_vector_store() -> FAISSWithLexicalIndex:
+    vector_store = FAISSWithLexicalIndex.from_texts(
+        [
+            '有給休暇の申請は勤怠システムから行います。',
+            '交通費の精算は毎月末までに申請してください。',
+            '健康診断は毎年春に実施します。',
+        ],
+        KeywordEmbeddings(),
+    )
+    vector_store.lexical_index = build_lexical_index(vector_store)
+    return vector_store
+
+
+def test_fuse_by_rrf_prefers_positions_ranked_high_in_both():
+    fused = fuse_by_rrf([[1, 2, 3], [3, 1]], rrf_k=60)
+    assert list(fused) == [1, 3, 2]
+
+
+def test_select_by_mmr_skips_near_duplicates():
+    candidate_vectors = np.array([[1.0, 0.0], [0.99, 0.01], [0.7, 0.7]], dtype=np.float32)
+    selected = select_by_mmr(np.array([1.0, 0.0], dtype=np.float32), candidate_vectors, k=2, lambda_mult=0.3)
+    assert selected == [0, 2]
+
+
+def test_hybrid_search_returns_relevant_document():
+    settings = RetrievalSettings(k=1, max_distance=0.5, lexical_fast_path_max_chars=0)
+    documents = retrieve_documents('交通費の精算方法を教えて', make_vector_store(), settings)
+    assert [document.page_content for document in documents] == ['交通費の精算は毎月末までに申請してください。']
+
+
+def test_hybrid_search_drops_lexical_only_hits_beyond_max_distance():
+    # 「申請」のbi-gramだけが一致する関係ない質問は、BM25の候補に入ってもベクトルの距離で除かれる
+    settings = RetrievalSettings(max_distance=0.5, lexical_fast_path_max_chars=0)
+    assert retrieve_documents('ビザの申請について', make_vector_store(), settings) == []
+
+
+def test_select_by_mmr_keeps_fused_ranking_effective():
+    # 0位と少し似ているが統合スコアが2位の候補と、0位と似ていないが統合スコアが最下位の候補
+    fused_scores = fuse_by_rrf([[0, 1, 2, 3], [0, 1, 3, 2]], rrf_k=60)
+    candidates = list(fused_scores)
+    relevance_scores = np.array([fused_scores[position] for position in candidates], dtype=np.float32)
+    vectors = {0: [1.0, 0.0], 1: [0.3, 0.954], 2: [0.0, 1.0], 3: [0.0, 1.0]}
+    candidate_vectors = np.array([vectors[position] for position in candidates], dtype=np.float32)
+    selected = select_by_mmr(
+        np.zeros(2, dtype=np.float32), candidate_vectors, k=2, lambda_mult=0.5, relevance_scores=relevance_scores,
+    )
+    # RRFのスコアを最大値で割るだけだと、どれも1付近になり似ていないだけの最下位の候補が選ばれてしまう
+    assert [candidates[i] for i in selected] == [0, 1]
@@ -0,0 +1,38 @@
+import os
+
+import numpy as np
+from langchain.docstore.document import Document
+
+from faiss_index_config import FaissIndexConfig, resolve_index_dir
+from ingest_documents import KEPT_INDEX_VERSIONS, load_manifest, make_chunk_hash, save_index
+from mmap_docstore import load_docstore
+
+
+def make_chunks(texts):
+    documents = [Document(page_content=text, metadata={'source': f'{i}.txt'}) for i, text in enumerate(texts)]
+    return [(make_chunk_hash(document), document) for document in documents]
+
+
+def save(index_dir, texts):
+    chunks = make_chunks(texts)
+    vectors = {chunk_hash: np.random.rand(4).astype(np.float32) for chunk_hash, _ in chunks}
+    save_index(index_dir, chunks, vectors, FaissIndexConfig())
+
+
+def test_resolve_index_dir_uses_legacy_layout_without_current(tmp_path):
+    assert resolve_index_dir(str(tmp_path)) == str(tmp_path)
+
+
+def test_save_index_switches_to_new_version_and_keeps_previous(tmp_path):
+    index_dir = str(tmp_path)
+    # 以前の形式でindex_dir直下に置かれていたファイルは、切り替え後に削除される
+    (tmp_path / 'index.faiss').write_bytes(b'legacy')
+    for i in range(KEPT_INDEX_VERSIONS + 1):
+        save(index_dir, [f'ドキュメント{j}' for j in range(i + 1)])
+
+    current_dir = resolve_index_dir(index_dir)
+    docstore, index_to_docstore_id = load_docstore(current_dir)
+    assert len(index_to_docstore_id) == KEPT_INDEX_VERSIONS + 1
+    assert len(load_manifest(current_dir)['chunks']) == KEPT_INDEX_VERSIONS + 1
+    assert len(os.listdir(os.path.join(index_dir, 'versions'))) == KEPT_INDEX_VERSIONS
+    assert sorted(os.listdir(index_dir)) == ['CURRENT', 'versions']
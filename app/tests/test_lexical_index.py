@@ -0,0 +1,39 @@
+from lexical_index import CharNgramBM25Index, normalize_text
+
+
+TEXTS = [
+    '有給休暇の申請は勤怠システムから行います。',
+    '交通費の精算は毎月末までに申請してください。',
+    '東京本社の所在地は千代田区丸の内です。',
+]
+
+
+def make_index() -> CharNgramBM25Index:
+    return CharNgramBM25Index(TEXTS, get_text=TEXTS.__getitem__)
+
+
+def test_normalize_text_ignores_width_case_and_spaces():
+    assert normalize_text('ＡＢＣ　d e\nf') == 'abcdef'
+
+
+def test_search_ranks_document_with_query_terms_first():
+    results = make_index().search('交通費の精算', k=3)
+    assert results[0][0] == 1
+    # 一致するn-gramが無いドキュメントは返さない
+    assert 2 not in [position for position, _ in results]
+
+
+def test_find_exact_requires_whole_query_in_document():
+    index = make_index()
+    assert index.find_exact('千代田区', k=3) == [2]
+    # n-gramは全て含まれていても、並びが違う場合は一致しない
+    assert index.find_exact('申請の精算', k=3) == []
+    # n-gramより短いクエリは探さない
+    assert index.find_exact('東', k=3) == []
+
+
+def test_match_ratios_are_between_zero_and_one():
+    ratios = make_index().match_ratios('有給休暇の申請', positions=[0, 1, 2])
+    assert ratios[0] == 1.0
+    assert 0.0 < ratios[1] < ratios[0]
+    assert ratios[2] == 0.0
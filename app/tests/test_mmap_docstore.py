@@ -0,0 +1,36 @@
+import pickle
+
+from langchain.docstore.document import Document
+
+from mmap_docstore import MmapDocstore, get_docstore_file_bytes, load_docstore
+
+
+def test_write_and_load_round_trip(tmp_path):
+    documents = [
+        Document(page_content='有給休暇の申請について', metadata={'source': '就業規則.pdf', 'page': 3}),
+        Document(page_content='', metadata={}),
+        Document(page_content='交通費の精算', metadata={'source': '経費規程.pdf'}),
+    ]
+    MmapDocstore.write(str(tmp_path), documents)
+    docstore, index_to_docstore_id = load_docstore(str(tmp_path))
+
+    assert len(docstore) == 3
+    for position, document in enumerate(documents):
+        assert docstore.search(index_to_docstore_id[position]) == document
+    # 範囲外やIDでない値は、InMemoryDocstoreと同じくメッセージの文字列を返す
+    assert docstore.search(3) == 'ID 3 not found.'
+    assert docstore.search('abc') == 'ID abc not found.'
+    assert get_docstore_file_bytes(str(tmp_path)) > 0
+
+
+def test_write_empty_documents(tmp_path):
+    MmapDocstore.write(str(tmp_path), [])
+    docstore, _ = load_docstore(str(tmp_path))
+    assert len(docstore) == 0
+    assert docstore.search(0) == 'ID 0 not found.'
+
+
+def test_load_falls_back_to_index_pkl(tmp_path):
+    with open(tmp_path / 'index.pkl', 'wb') as f:
+        pickle.dump(({'0': 'docstore'}, {0: '0'}), f)
+    assert load_docstore(str(tmp_path)) == ({'0': 'docstore'}, {0: '0'})
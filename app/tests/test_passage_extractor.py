@@ -0,0 +1,27 @@
+from passage_extractor import LocalPassageExtractor, split_into_passages
+
+
+PAGE = ' '.join([
+    'このサイトではiOSアプリ開発に関する記事を掲載しています。',
+    '深瀬のブログへようこそ。',
+    '深瀬の趣味はサウナとキャンプです。',
+    '最新の記事は毎週月曜日に更新されます。',
+    '本日の東京は晴れの予報です。',
+] * 3)
+
+
+def test_split_into_passages_keeps_sentences_within_max_chars():
+    passages = split_into_passages('一文目です。二文目です。三文目です。', max_chars=13)
+    assert passages == ['一文目です。 二文目です。', '三文目です。']
+
+
+def test_extract_returns_related_passages():
+    extracted = LocalPassageExtractor().extract(PAGE, '深瀬の趣味')
+    assert '深瀬の趣味はサウナとキャンプです。' in extracted
+
+
+def test_extract_falls_back_for_unrelated_query():
+    # 「の天」などのbi-gramが1つ一致するだけのページでは抽出せず、LLMでの要約に任せる
+    extractor = LocalPassageExtractor()
+    assert extractor.extract(PAGE, '明日の天気') is None
+    assert extractor.stats()['fallbacks'] == 1
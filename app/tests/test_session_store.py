@@ -0,0 +1,85 @@
+import asyncio
+import sqlite3
+import time
+
+import openai
+
+from session_store import ConversationSession, SessionStore
+
+
+def make_summary_response(content: str) -> dict:
+    return {'choices': [{'message': {'content': content}}]}
+
+
+def test_summary_is_applied_only_to_old_messages(monkeypatch):
+    store = SessionStore(max_recent_messages=2)
+
+    async def acreate(**kwargs):
+        # 要約中に新しいやり取りが追加された場合
+        await store.aappend_turn('c1', question='質問3', answer='回答3')
+        return make_summary_response('要約')
+    monkeypatch.setattr(openai.ChatCompletion, 'acreate', acreate)
+
+    async def run():
+        await store.aappend_turn('c1', question='質問1', answer='回答1')
+        await store.aappend_turn('c1', question='質問2', answer='回答2')
+        await asyncio.gather(*store._tasks)
+    asyncio.run(run())
+
+    session = store.get('c1')
+    assert session.summary == '要約'
+    assert [message['content'] for message in session.messages] == ['質問2', '回答2', '質問3', '回答3']
+
+
+def test_summary_is_discarded_when_session_was_replaced(monkeypatch):
+    store = SessionStore(max_recent_messages=2)
+
+    async def acreate(**kwargs):
+        # 要約中に会話が期限切れなどで新しい会話に置き換わった場合
+        store._remember(ConversationSession(conversation_id='c1'))
+        return make_summary_response('要約')
+    monkeypatch.setattr(openai.ChatCompletion, 'acreate', acreate)
+
+    async def run():
+        await store.aappend_turn('c1', question='質問1', answer='回答1')
+        await store.aappend_turn('c1', question='質問2', answer='回答2')
+        await asyncio.gather(*store._tasks)
+    asyncio.run(run())
+
+    session = store.get('c1')
+    assert session.summary == ''
+    assert session.messages == []
+
+
+def test_sessions_are_persisted_to_sqlite(tmp_path):
+    db_path = str(tmp_path / 'sessions.sqlite3')
+    store = SessionStore(db_path=db_path)
+    asyncio.run(store.aappend_turn('c1', question='質問', answer='回答'))
+    # 書き込みは専用のスレッドで行われるので、閉じる時に書き終えるのを待つ
+    store.close()
+
+    session = asyncio.run(SessionStore(db_path=db_path).aget('c1'))
+    assert session.messages == [{'role': 'user', 'content': '質問'}, {'role': 'assistant', 'content': '回答'}]
+
+
+def test_expired_and_over_limit_sessions_are_deleted_from_sqlite(tmp_path, monkeypatch):
+    db_path = str(tmp_path / 'sessions.sqlite3')
+    store = SessionStore(db_path=db_path, ttl_seconds=60, max_disk_sessions=50)
+    now = time.time()
+
+    async def run():
+        # 最初の10件は期限切れになる時刻に保存する
+        monkeypatch.setattr(time, 'time', lambda: now - 120)
+        for i in range(10):
+            await store.aappend_turn(f'old{i}', question='質問', answer='回答')
+        monkeypatch.setattr(time, 'time', lambda: now)
+        for i in range(90):
+            await store.aappend_turn(f'c{i}', question='質問', answer='回答')
+    asyncio.run(run())
+    store.close()
+
+    db = sqlite3.connect(db_path)
+    conversation_ids = [row[0] for row in db.execute('SELECT conversation_id FROM sessions')]
+    db.close()
+    assert len(conversation_ids) == 50
+    assert not any(conversation_id.startswith('old') for conversation_id in conversation_ids)
@@ -0,0 +1,55 @@
+import asyncio
+import gc
+
+from assistant_function import AssistantFunctionType
+from cancellation import CancellationToken
+from index_retriever import RetrievalSettings
+from speculative_index_search import SpeculativeIndexSearch, speculative_index_search_stats
+
+
+def make_search(question: str, category_id: int) -> SpeculativeIndexSearch:
+    return SpeculativeIndexSearch(
+        vector_store=None,
+        retrieval_settings=RetrievalSettings(),
+        question=question,
+        category_id=category_id,
+    )
+
+
+def test_similarity_is_measured_over_query_bigrams():
+    search = make_search('深瀬さんの経歴を教えてください', category_id=100)
+    assert search._similarity('深瀬 経歴') == 1.0
+    # 元の質問に無い語が足されたクエリは近いとみなさない
+    assert search._similarity('深瀬 経歴 大学 専攻') < search.similarity_threshold
+
+
+def test_failed_speculative_search_is_counted_separately(monkeypatch):
+    async def search_on_index_data(**kwargs):
+        raise RuntimeError('index unavailable')
+    monkeypatch.setitem(AssistantFunctionType.table, AssistantFunctionType.Search_On_Index_Data, search_on_index_data)
+
+    async def run():
+        search = make_search('深瀬の経歴', category_id=101)
+        search.start(CancellationToken())
+        return await search.take('深瀬の経歴')
+    assert asyncio.run(run()) is None
+    counts = speculative_index_search_stats.stats()['101']
+    assert counts['failed'] == 1 and counts['miss'] == 0
+
+
+def test_abandoned_failed_search_does_not_leave_unretrieved_exception(monkeypatch):
+    async def search_on_index_data(**kwargs):
+        raise RuntimeError('index unavailable')
+    monkeypatch.setitem(AssistantFunctionType.table, AssistantFunctionType.Search_On_Index_Data, search_on_index_data)
+    unhandled = []
+
+    async def run():
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: unhandled.append(context))
+        search = make_search('深瀬の経歴', category_id=102)
+        search.start(CancellationToken())
+        await asyncio.sleep(0.01)
+        # 結果をtake()で受け取らず、discard()も呼ばれないまま捨てられた場合
+        del search
+        gc.collect()
+    asyncio.run(run())
+    assert unhandled == []
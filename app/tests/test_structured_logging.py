@@ -0,0 +1,34 @@
+import json
+import logging
+import queue
+
+from structured_logging import JsonFormatter, StructuredLogger, _NonBlockingQueueHandler
+
+
+def make_logger(log_queue: queue.Queue, name: str, max_field_chars: int = 100) -> StructuredLogger:
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.handlers = [_NonBlockingQueueHandler(log_queue, max_field_chars=max_field_chars)]
+    return StructuredLogger(logger)
+
+
+def test_fields_are_snapshotted_when_enqueued():
+    log_queue = queue.Queue()
+    messages = [{'role': 'user', 'content': 'hi'}]
+    make_logger(log_queue, 'app.test_snapshot').debug('messages', messages=messages, text='x' * 130)
+    # キューに積んだ後に呼び出し元がリストを書き換えても、出力される内容は変わらない
+    messages.append({'role': 'assistant', 'content': 'hello'})
+
+    entry = json.loads(JsonFormatter().format(log_queue.get_nowait()))
+    assert entry['messages'] == [{'role': 'user', 'content': 'hi'}]
+    assert entry['text'] == 'x' * 100 + '...(+30 chars)'
+
+
+def test_does_not_change_global_logging_settings():
+    source_file = logging._srcfile
+    log_queue = queue.Queue()
+    make_logger(log_queue, 'app.test_globals').info('hello', value=1)
+    record = log_queue.get_nowait()
+    assert record.lineno == 0
+    assert logging._srcfile == source_file and logging.logThreads
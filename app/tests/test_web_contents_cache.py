@@ -0,0 +1,78 @@
+import asyncio
+import sqlite3
+
+import numpy as np
+
+from web_contents_cache import WebContentsCache
+
+
+def unit(*values: float) -> np.ndarray:
+    vector = np.array(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def test_memory_bytes_are_counted_in_utf8():
+    cache = WebContentsCache(embeddings=None)
+    page = cache.on_page_fetched(url='https://example.com', content='日本語', etag=None, last_modified=None)
+    cache.put_summary(page, unit(1.0, 0.0), summary='要約')
+    # 要約と一緒に、質問のembedding（float32の2次元）も保持する
+    assert cache.stats()['memory_bytes'] == len('日本語要約'.encode('utf-8')) + 8
+
+
+def test_memory_is_evicted_by_utf8_bytes():
+    cache = WebContentsCache(embeddings=None, max_memory_bytes=20)
+    cache.on_page_fetched(url='https://example.com/1', content='あ' * 5, etag=None, last_modified=None)
+    # 文字数では上限に収まるが、UTF-8では15 + 15バイトになるので古い方が破棄される
+    cache.on_page_fetched(url='https://example.com/2', content='い' * 5, etag=None, last_modified=None)
+    assert asyncio.run(cache.get_page('https://example.com/1')) is None
+    assert cache.stats()['memory_bytes'] == 15
+
+
+def test_pages_and_summaries_are_persisted_to_sqlite(tmp_path):
+    db_path = str(tmp_path / 'web_contents.sqlite3')
+    cache = WebContentsCache(embeddings=None, db_path=db_path)
+    page = cache.on_page_fetched(url='https://example.com', content='本文', etag='"v1"', last_modified=None)
+    cache.put_summary(page, unit(1.0, 0.0), summary='要約')
+    # 書き込みは専用のスレッドで行われるので、閉じる時に書き終えるのを待つ
+    cache.close()
+
+    other_cache = WebContentsCache(embeddings=None, db_path=db_path)
+
+    async def load():
+        loaded_page = await other_cache.get_page('https://example.com')
+        return loaded_page, await other_cache.get_summary(loaded_page, unit(0.99, 0.05))
+    loaded_page, summary = asyncio.run(load())
+    other_cache.close()
+    assert loaded_page.etag == '"v1"'
+    assert summary == '要約'
+
+
+def test_summary_is_reused_only_for_similar_questions():
+    cache = WebContentsCache(embeddings=None, similarity_threshold=0.95)
+    page = cache.on_page_fetched(url='https://example.com', content='本文', etag=None, last_modified=None)
+    cache.put_summary(page, unit(1.0, 0.0, 0.0), summary='有給休暇の要約')
+    cache.put_summary(page, unit(0.0, 1.0, 0.0), summary='交通費の要約')
+
+    async def lookup(query_embedding, kind='summary'):
+        return await cache.get_summary(page, query_embedding, kind=kind)
+    # 言い回しが違うだけの質問（類似度0.97程度）は、同じ質問の要約を使う
+    assert asyncio.run(lookup(unit(1.0, 0.25, 0.0))) == '有給休暇の要約'
+    assert asyncio.run(lookup(unit(0.1, 1.0, 0.0))) == '交通費の要約'
+    # 関係はあるが別の質問には、他の質問の要約を返さない
+    assert asyncio.run(lookup(unit(1.0, 0.0, 0.5))) is None
+    # ローカルで抽出した結果とは別に扱う
+    assert asyncio.run(lookup(unit(1.0, 0.0, 0.0), kind='extractive')) is None
+
+
+def test_disk_is_trimmed_per_table_with_interleaved_writes(tmp_path):
+    db_path = str(tmp_path / 'web_contents.sqlite3')
+    cache = WebContentsCache(embeddings=None, db_path=db_path, max_disk_entries=10)
+    for i in range(200):
+        page = cache.on_page_fetched(url=f'https://example.com/{i}', content='本文', etag=None, last_modified=None)
+        cache.put_summary(page, unit(1.0, 0.0), summary='要約')
+    cache.close()
+
+    db = sqlite3.connect(db_path)
+    assert db.execute('SELECT COUNT(*) FROM pages').fetchone()[0] == 10
+    assert db.execute('SELECT COUNT(*) FROM query_summaries').fetchone()[0] == 10
+    db.close()
@@ -0,0 +1,73 @@
+import asyncio
+import time
+
+from cancellation import CancellationToken
+from web_contents_scraper import DeepSearchPolicy, WebContentsScraper
+
+
+def make_scraper(policy: DeepSearchPolicy) -> WebContentsScraper:
+    # 打ち切りの判定だけを確認するので、通信を行う依存先は渡さない
+    return WebContentsScraper(
+        links=['https://example.com/1', 'https://example.com/2', 'https://example.com/3'],
+        query='有給休暇',
+        callback_handler=None,
+        cancellation_token=CancellationToken(),
+        cache=None,
+        fetcher=None,
+        policy=policy,
+    )
+
+
+async def summarize(seconds: float, summary: str) -> str:
+    await asyncio.sleep(seconds)
+    return summary
+
+
+async def fail(seconds: float) -> str:
+    await asyncio.sleep(seconds)
+    raise RuntimeError('fetch failed')
+
+
+def test_is_progressive_only_when_cutoff_is_configured():
+    assert not DeepSearchPolicy().is_progressive
+    assert DeepSearchPolicy(min_summaries=2).is_progressive
+    assert DeepSearchPolicy(max_wait_seconds=1.0).is_progressive
+
+
+def test_wait_stops_when_min_summaries_succeeded():
+    async def run():
+        scraper = make_scraper(DeepSearchPolicy(min_summaries=2))
+        # 失敗したものは件数に含めず、結果は検索結果の順位の順で返す
+        tasks = [
+            asyncio.ensure_future(summarize(0.02, '1件目')),
+            asyncio.ensure_future(fail(0.0)),
+            asyncio.ensure_future(summarize(0.01, '3件目')),
+            asyncio.ensure_future(summarize(10, '4件目')),
+        ]
+        summaries = await scraper._wait_for_summaries_progressively(tasks, time.perf_counter())
+        await asyncio.sleep(0)
+        return summaries, tasks[3].cancelled()
+
+    summaries, straggler_cancelled = asyncio.run(run())
+    assert summaries == ['1件目', '3件目']
+    assert straggler_cancelled
+
+
+def test_wait_stops_at_deadline_and_keeps_stragglers_running():
+    async def run():
+        scraper = make_scraper(DeepSearchPolicy(max_wait_seconds=0.05, cancel_stragglers=False))
+        tasks = [
+            asyncio.ensure_future(summarize(0.2, '1件目')),
+            asyncio.ensure_future(summarize(0.0, '2件目')),
+        ]
+        summaries = await scraper._wait_for_summaries_progressively(tasks, time.perf_counter())
+        is_running = not tasks[0].done()
+        # 裏で続けさせた処理は、クライアントの切断時に中断できる様に登録されている
+        scraper.cancellation_token.cancel()
+        await asyncio.sleep(0)
+        return summaries, is_running, tasks[0].cancelled()
+
+    summaries, is_running, cancelled_on_disconnect = asyncio.run(run())
+    assert summaries == ['2件目']
+    assert is_running
+    assert cancelled_on_disconnect
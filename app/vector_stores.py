@@ -1,12 +1,154 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from typing import Dict, Iterable, Optional
+
+import faiss
 from langchain.vectorstores import FAISS
 from langchain.embeddings.openai import OpenAIEmbeddings
+from embedding_batcher import EmbeddingBatcher
+from embedding_cache import CachedQueryEmbeddings
+from faiss_index_config import FaissIndexConfig, resolve_index_dir
+from index_retriever import RetrievalSettings
+from lexical_index import FAISSWithLexicalIndex, build_lexical_index
+from mmap_docstore import get_docstore_file_bytes, load_docstore
+from structured_logging import get_logger
 import dotenv
 
 # .envを読み込む
 dotenv.load_dotenv(dotenv.find_dotenv())
 
-embeddings = OpenAIEmbeddings()
+logger = get_logger(__name__)
+
+openai_embeddings = OpenAIEmbeddings()
+# 同時に来た検索クエリのembedding取得は、短い時間だけ待ってまとめて1回のAPI呼び出しで取得する
+embedding_batcher = EmbeddingBatcher(embeddings=openai_embeddings)
+# 同じ質問で毎回embeddingのAPIを呼ばない様に、検索クエリのembeddingはキャッシュを通す（キャッシュに無いものだけがまとめられる）
+embeddings = CachedQueryEmbeddings(
+    embeddings=embedding_batcher,
+    model_name=openai_embeddings.model,
+    db_path='./cache/query_embeddings.sqlite3',
+)
+
+
+# カテゴリIDごとのインデックスを、初めて使われた時（もしくはwarmup()が呼ばれた時）に読み込んで保持するクラス
+# import時に全インデックスを読み込むと、あまり使われないカテゴリの分まで全workerが読み込み時間とメモリを払うことになるため
+class VectorStoreRegistry:
+    def __init__(
+        self,
+        embeddings: CachedQueryEmbeddings,
+        index_paths: Dict[int, str],
+        retrieval_settings: Optional[Dict[int, RetrievalSettings]] = None,
+    ):
+        self.embeddings = embeddings
+        self.index_paths = index_paths
+        self.retrieval_settings = retrieval_settings or {}
+        self._vector_stores: Dict[int, FAISS] = {}
+        self._load_stats: Dict[int, dict] = {}
+        self._lock = threading.Lock()
+
+    def get(self, category_id: int) -> FAISS:
+        if (vector_store := self._vector_stores.get(category_id)) is not None:
+            return vector_store
+        with self._lock:
+            # ロック待ちの間に他のスレッドが読み込んでいる可能性があるので再度確認する
+            if (vector_store := self._vector_stores.get(category_id)) is None:
+                vector_store = self._load(category_id)
+                self._vector_stores[category_id] = vector_store
+        return vector_store
+
+    async def aget(self, category_id: int) -> FAISS:
+        # 読み込み済みならそのまま返し、未読み込みの場合だけイベントループを止めない様にexecutorで読み込む
+        if (vector_store := self._vector_stores.get(category_id)) is not None:
+            return vector_store
+        return await asyncio.get_running_loop().run_in_executor(None, self.get, category_id)
+
+    def get_retrieval_settings(self, category_id: int) -> RetrievalSettings:
+        return self.retrieval_settings.get(category_id) or RetrievalSettings()
+
+    def warmup(self, category_ids: Optional[Iterable[int]] = None):
+        for category_id in (category_ids if category_ids is not None else self.index_paths.keys()):
+            self.get(category_id)
+
+    def stats(self) -> dict:
+        return {
+            str(category_id): {
+                'index_path': index_path,
+                'loaded': category_id in self._vector_stores,
+                **self._load_stats.get(category_id, {}),
+            } for category_id, index_path in self.index_paths.items()
+        }
+
+    def _load(self, category_id: int) -> FAISSWithLexicalIndex:
+        # ingest_documents.pyで作成したインデックスは、CURRENTが指すバージョンのディレクトリから読み込む
+        index_path = resolve_index_dir(self.index_paths[category_id])
+        rss_before = _get_rss_bytes()
+        started_at = time.perf_counter()
+
+        # 読み取り専用＆mmapで開くことで、対応しているインデックス形式ではOSのページキャッシュを複数workerで共有できる
+        index = faiss.read_index(
+            os.path.join(index_path, 'index.faiss'),
+            faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY,
+        )
+        # インデックスの種類ごとの検索時のパラメータ（HNSWのefSearch、IVFのnprobeなど）を、作成時の設定に合わせる
+        index_config = FaissIndexConfig.from_manifest(_load_manifest(index_path))
+        index_config.apply_search_params(index)
+        # 変換済みのインデックスでは、docstoreはmmapして検索で取り出された分だけを読み込む
+        docstore, index_to_docstore_id = load_docstore(index_path)
+        vector_store = FAISSWithLexicalIndex(self.embeddings.embed_query, index, docstore, index_to_docstore_id)
+        load_ms = (time.perf_counter() - started_at) * 1000
+        # 固有名詞や日付での検索用に、同じドキュメントから文字n-gramの転置インデックスを作っておく
+        vector_store.lexical_index = build_lexical_index(vector_store)
+
+        self._load_stats[category_id] = {
+            'resolved_index_path': index_path,
+            'load_ms': load_ms,
+            'lexical_index_build_ms': (time.perf_counter() - started_at) * 1000 - load_ms,
+            'lexical_index_terms': vector_store.lexical_index.term_count,
+            'ntotal': index.ntotal,
+            'index_factory': index_config.factory,
+            'search_params': index_config.search_params,
+            'index_file_bytes': os.path.getsize(os.path.join(index_path, 'index.faiss')),
+            'docstore_type': type(docstore).__name__,
+            'docstore_file_bytes': get_docstore_file_bytes(index_path),
+            'rss_delta_bytes': _get_rss_bytes() - rss_before if rss_before is not None else None,
+        }
+        logger.info('vector store loaded', category_id=category_id, **self._load_stats[category_id])
+        return vector_store
+
+
+def _load_manifest(index_path: str) -> Optional[dict]:
+    # ingest_documents.pyで作成したインデックスには、インデックスの種類などを記録したmanifest.jsonがある
+    manifest_path = os.path.join(index_path, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _get_rss_bytes() -> Optional[int]:
+    # Linux以外では取得できないのでNoneを返す
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
 # spain_fukase_vector_store = FAISS.load_local("./faiss_index/fukase_spain/", embeddings)
-vector_store_2019 = FAISS.load_local("./faiss_index/2019/", embeddings)
-vector_store_2022 = FAISS.load_local("./faiss_index/2022/", embeddings)
-vector_store_2025 = FAISS.load_local("./faiss_index/2025_2/", embeddings)
\ No newline at end of file
+registry = VectorStoreRegistry(
+    embeddings=embeddings,
+    index_paths={
+        0: './faiss_index/2025_2/',
+        1: './faiss_index/2022/',
+        2: './faiss_index/2019/',
+    },
+    # 職務経歴書のチャンクはどれも似た内容なので、多様性を重視しつつ、距離が離れすぎたもの（cos類似度0.7未満相当）は除く
+    retrieval_settings={
+        0: RetrievalSettings(k=3, fetch_k=20, lambda_mult=0.5, max_distance=0.6),
+        1: RetrievalSettings(k=3, fetch_k=20, lambda_mult=0.5, max_distance=0.6),
+        2: RetrievalSettings(k=3, fetch_k=20, lambda_mult=0.5, max_distance=0.6),
+    },
+)
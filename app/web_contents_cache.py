@@ -0,0 +1,342 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from pydantic import BaseModel
+from langchain.embeddings.base import Embeddings
+
+from structured_logging import get_logger
+
+
+logger = get_logger(__name__)
+
+
+# 1つのURLについて、クリーン済みのコンテンツと再検証用のヘッダーの値を保持する
+class CachedPage(BaseModel):
+    url: str
+    content: str
+    content_hash: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    fetched_at: float
+
+
+# 1つのページに対する、ある質問での要約（質問のembeddingは正規化済み）
+class _CachedSummary:
+    __slots__ = ('query_embedding', 'summary')
+
+    def __init__(self, query_embedding: np.ndarray, summary: str):
+        self.query_embedding = query_embedding
+        self.summary = summary
+
+
+# WebContentsScraperのためのキャッシュ
+# 1段目: URLごとのクリーン済みコンテンツ（ETag / Last-Modifiedで条件付きGETによる再検証を行う）
+# 2段目: (URL, コンテンツ)ごとの、質問のembeddingを添えた要約結果（16kモデルの呼び出しを省略する）
+#        質問ごとに内容が変わる要約なので、質問のembeddingのコサイン類似度がしきい値以上のものだけを使う
+class WebContentsCache:
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        # この時間内に取得したページは再検証せずにそのまま使う
+        fresh_seconds: float = 60 * 10,
+        max_memory_bytes: int = 64 * 1024 * 1024,
+        db_path: Optional[str] = None,
+        max_disk_entries: int = 10000,
+        # 要約を使い回す質問のembeddingのコサイン類似度の下限（言い回しが違うだけの質問は超え、別の質問は超えない値にする）
+        similarity_threshold: float = 0.95,
+        # 1つのページについて保持する、質問ごとの要約の数
+        max_summaries_per_page: int = 8,
+    ):
+        self.embeddings = embeddings
+        self.fresh_seconds = fresh_seconds
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_entries = max_disk_entries
+        self.similarity_threshold = similarity_threshold
+        self.max_summaries_per_page = max_summaries_per_page
+
+        self._pages: 'OrderedDict[str, CachedPage]' = OrderedDict()
+        # key: (URL, コンテンツ, 要約の種類), value: 新しい順の要約
+        self._summaries: 'OrderedDict[str, List[_CachedSummary]]' = OrderedDict()
+        self._memory_bytes = 0
+        # 上限を超えた古いものを削除するまでの書き込み回数（テーブルごとに数える）
+        self._disk_writes: Dict[str, int] = {}
+
+        self.page_fresh_hits = 0
+        self.page_revalidated = 0
+        self.page_misses = 0
+        self.summary_hits = 0
+        self.summary_misses = 0
+
+        self._db: Optional[sqlite3.Connection] = None
+        # SQLiteの読み書きは、イベントループを止めない様に専用の1スレッドで順番に行う
+        # （書き込みは結果を待たずに積むだけにして、要約の返却をディスクへの書き込みで待たせない）
+        self._db_executor: Optional[ThreadPoolExecutor] = None
+        if db_path:
+            os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+            # 作成したスレッドと読み書きするスレッドが異なるので、スレッドの確認は無効にしている（作成後のアクセスは専用のスレッドからのみ）
+            self._db = sqlite3.connect(db_path, timeout=5, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS pages ('
+                'url TEXT PRIMARY KEY, content TEXT NOT NULL, content_hash TEXT NOT NULL, '
+                'etag TEXT, last_modified TEXT, fetched_at REAL NOT NULL)'
+            )
+            # 以前の質問のバケットをキーにした要約は、質問の類似度を確認できないので使わない
+            self._db.execute('DROP TABLE IF EXISTS summaries')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS query_summaries ('
+                'page_key TEXT NOT NULL, query_embedding BLOB NOT NULL, summary TEXT NOT NULL, created_at REAL NOT NULL)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS query_summaries_page_key ON query_summaries (page_key)')
+            # 上限を超えた古いものを削除する際に、全件を並べ替えない様にする
+            self._db.execute('CREATE INDEX IF NOT EXISTS pages_fetched_at ON pages (fetched_at)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS query_summaries_created_at ON query_summaries (created_at)')
+            self._db.commit()
+            self._db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='web-contents-cache-db')
+
+    async def embed_query(self, query: str) -> np.ndarray:
+        # 要約を使い回せるかを確認するための、質問の正規化済みのembedding
+        return _normalize(await self.embeddings.aembed_query(query))
+
+    async def get_page(self, url: str) -> Optional[CachedPage]:
+        if (page := self._pages.get(url)) is not None:
+            self._pages.move_to_end(url)
+            return page
+        if self._db_executor is not None:
+            rows = await self._run_on_db_thread(
+                'SELECT url, content, content_hash, etag, last_modified, fetched_at FROM pages WHERE url = ?', (url,)
+            )
+            if rows:
+                row = rows[0]
+                page = CachedPage(
+                    url=row[0], content=row[1], content_hash=row[2],
+                    etag=row[3], last_modified=row[4], fetched_at=row[5],
+                )
+                self._remember_page(page)
+                return page
+        return None
+
+    def is_fresh(self, page: CachedPage) -> bool:
+        return time.time() - page.fetched_at < self.fresh_seconds
+
+    def make_conditional_headers(self, page: Optional[CachedPage]) -> dict:
+        headers = {}
+        if page is None:
+            return headers
+        if page.etag:
+            headers['If-None-Match'] = page.etag
+        if page.last_modified:
+            headers['If-Modified-Since'] = page.last_modified
+        return headers
+
+    def on_page_fresh_hit(self):
+        self.page_fresh_hits += 1
+
+    def on_page_revalidated(self, page: CachedPage) -> CachedPage:
+        # 304 Not Modifiedだった場合は、取得日時だけ更新してそのまま使う
+        self.page_revalidated += 1
+        page = page.copy(update={'fetched_at': time.time()})
+        self.put_page(page)
+        return page
+
+    def on_page_fetched(
+        self,
+        url: str,
+        content: str,
+        etag: Optional[str],
+        last_modified: Optional[str],
+    ) -> CachedPage:
+        self.page_misses += 1
+        page = CachedPage(
+            url=url,
+            content=content,
+            content_hash=hashlib.sha256(content.encode('utf-8')).hexdigest(),
+            etag=etag,
+            last_modified=last_modified,
+            fetched_at=time.time(),
+        )
+        self.put_page(page)
+        return page
+
+    def put_page(self, page: CachedPage):
+        self._remember_page(page)
+        if self._db_executor is not None:
+            self._write_behind(
+                'pages',
+                'fetched_at',
+                'INSERT OR REPLACE INTO pages (url, content, content_hash, etag, last_modified, fetched_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (page.url, page.content, page.content_hash, page.etag, page.last_modified, page.fetched_at),
+            )
+
+    async def get_summary(
+        self,
+        page: CachedPage,
+        query_embedding: np.ndarray,
+        # 'summary': 16kモデルでの要約 / 'extractive': ローカルで抽出したパッセージ（同じ質問でも別のものとして扱う）
+        kind: str = 'summary',
+    ) -> Optional[str]:
+        key = self._make_summary_key(page, kind)
+        if (cached_summaries := self._summaries.get(key)) is not None:
+            self._summaries.move_to_end(key)
+            if (summary := self._find_similar(cached_summaries, query_embedding)) is not None:
+                self.summary_hits += 1
+                return summary.summary
+        # メモリに無いか、メモリ上の要約が別の質問のものだった場合は、ディスクに保存された他の質問の分も確認する
+        if self._db_executor is not None:
+            rows = await self._run_on_db_thread(
+                'SELECT query_embedding, summary FROM query_summaries WHERE page_key = ? ORDER BY created_at DESC LIMIT ?',
+                (key, self.max_summaries_per_page),
+                fetch_all=True,
+            )
+            disk_summaries = [
+                _CachedSummary(np.frombuffer(row[0], dtype=np.float32), row[1]) for row in rows
+            ]
+            if (summary := self._find_similar(disk_summaries, query_embedding)) is not None:
+                self._remember_summary(key, summary)
+                self.summary_hits += 1
+                return summary.summary
+        self.summary_misses += 1
+        return None
+
+    def put_summary(self, page: CachedPage, query_embedding: np.ndarray, summary: str, kind: str = 'summary'):
+        key = self._make_summary_key(page, kind)
+        query_embedding = np.asarray(query_embedding, dtype=np.float32)
+        self._remember_summary(key, _CachedSummary(query_embedding, summary))
+        if self._db_executor is not None:
+            self._write_behind(
+                'query_summaries',
+                'created_at',
+                'INSERT INTO query_summaries (page_key, query_embedding, summary, created_at) VALUES (?, ?, ?, ?)',
+                (key, query_embedding.tobytes(), summary, time.time()),
+            )
+
+    def close(self):
+        # 書き込み待ちの分を書き終えてから閉じる
+        if self._db_executor is not None:
+            self._db_executor.shutdown(wait=True)
+            self._db_executor = None
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def stats(self) -> dict:
+        page_total = self.page_fresh_hits + self.page_revalidated + self.page_misses
+        summary_total = self.summary_hits + self.summary_misses
+        return {
+            'memory_bytes': self._memory_bytes,
+            'pages': len(self._pages),
+            'summaries': sum(len(summaries) for summaries in self._summaries.values()),
+            'page_fresh_hits': self.page_fresh_hits,
+            'page_revalidated': self.page_revalidated,
+            'page_misses': self.page_misses,
+            'page_hit_rate': (self.page_fresh_hits + self.page_revalidated) / page_total if page_total else 0.0,
+            'summary_hits': self.summary_hits,
+            'summary_misses': self.summary_misses,
+            'summary_hit_rate': self.summary_hits / summary_total if summary_total else 0.0,
+        }
+
+    @staticmethod
+    def _make_summary_key(page: CachedPage, kind: str) -> str:
+        # ページの内容が変わった場合は、同じURLでも別の要約として扱う
+        return f'{page.url}\n{page.content_hash}\n{kind}'
+
+    def _find_similar(self, summaries: List[_CachedSummary], query_embedding: np.ndarray) -> Optional[_CachedSummary]:
+        # 質問のembeddingのコサイン類似度が最も高いものを、しきい値以上の場合だけ返す
+        if not summaries:
+            return None
+        similarities = np.stack([summary.query_embedding for summary in summaries]) @ query_embedding
+        best_index = int(np.argmax(similarities))
+        if similarities[best_index] < self.similarity_threshold:
+            return None
+        return summaries[best_index]
+
+    def _remember_page(self, page: CachedPage):
+        if (old := self._pages.pop(page.url, None)) is not None:
+            self._memory_bytes -= _count_bytes(old.content)
+        self._pages[page.url] = page
+        self._memory_bytes += _count_bytes(page.content)
+        self._evict_memory()
+
+    def _remember_summary(self, key: str, summary: _CachedSummary):
+        summaries = self._summaries.pop(key, [])
+        if summary in summaries:
+            summaries.remove(summary)
+            self._memory_bytes -= _count_summary_bytes(summary)
+        summaries.insert(0, summary)
+        self._memory_bytes += _count_summary_bytes(summary)
+        # 1つのページの要約は、古い質問のものから破棄する
+        while len(summaries) > self.max_summaries_per_page:
+            self._memory_bytes -= _count_summary_bytes(summaries.pop())
+        self._summaries[key] = summaries
+        self._evict_memory()
+
+    def _evict_memory(self):
+        # 上限を超えた場合は、サイズの大きいページの方から先に古いものを破棄する
+        while self._memory_bytes > self.max_memory_bytes and self._pages:
+            _, page = self._pages.popitem(last=False)
+            self._memory_bytes -= _count_bytes(page.content)
+        while self._memory_bytes > self.max_memory_bytes and self._summaries:
+            _, summaries = self._summaries.popitem(last=False)
+            self._memory_bytes -= sum(_count_summary_bytes(summary) for summary in summaries)
+
+    async def _run_on_db_thread(self, sql: str, parameters: tuple, fetch_all: bool = False) -> List[tuple]:
+        # fetch_all=Falseの場合は、1行目だけを返す（無い場合は空）
+        def run() -> List[tuple]:
+            cursor = self._db.execute(sql, parameters)
+            if fetch_all:
+                return cursor.fetchall()
+            row = cursor.fetchone()
+            return [] if row is None else [row]
+        return await asyncio.wrap_future(self._db_executor.submit(run))
+
+    def _write_behind(self, table: str, order_column: str, sql: str, parameters: Tuple):
+        self._db_executor.submit(self._write, table, order_column, sql, parameters).add_done_callback(self._on_write_done)
+
+    def _write(self, table: str, order_column: str, sql: str, parameters: Tuple):
+        # 専用のスレッドで実行される
+        self._db.execute(sql, parameters)
+        self._db.commit()
+        self._trim_disk(table, order_column)
+
+    @staticmethod
+    def _on_write_done(future: Future):
+        # 書き込みに失敗してもメモリ上のキャッシュは使えるので、ログに残すだけにする
+        if (error := future.exception()) is not None:
+            logger.warning('Webコンテンツのキャッシュの保存に失敗', error=repr(error))
+
+    def _trim_disk(self, table: str, order_column: str):
+        # 書き込みの度に件数を数えると重いので、テーブルごとに一定回数ごとに上限を超えた古いものを削除する
+        # （テーブル間で回数を共有すると、書き込みが交互の場合に片方のテーブルが削除されないままになる）
+        self._disk_writes[table] = self._disk_writes.get(table, 0) + 1
+        if self._disk_writes[table] % 100 != 0:
+            return
+        self._db.execute(
+            f'DELETE FROM {table} WHERE rowid IN ('
+            f'SELECT rowid FROM {table} ORDER BY {order_column} DESC LIMIT -1 OFFSET ?)',
+            (self.max_disk_entries,)
+        )
+        self._db.commit()
+
+
+def _count_bytes(text: str) -> int:
+    # 日本語のページは1文字が3バイトになるので、文字数ではなくUTF-8でのバイト数でメモリの上限と比べる
+    return len(text.encode('utf-8'))
+
+
+def _count_summary_bytes(summary: _CachedSummary) -> int:
+    return _count_bytes(summary.summary) + summary.query_embedding.nbytes
+
+
+def _normalize(embedding) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
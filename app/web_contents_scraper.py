@@ -1,19 +1,89 @@
 import openai
-import tiktoken
-import requests
 import asyncio
 import math
-from typing import Callable
-from langchain.document_transformers import BeautifulSoupTransformer
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.docstore.document import Document
+import time
+import numpy as np
+from typing import Callable, List, Optional
+from pydantic import BaseModel
 from env import Env
 from callback_handler import CallbackHandler
+from context_packer import count_tokens, token_usage_stats
+from html_text_extractor import extract_text_within_token_budget, iter_html_chunks
+from http_fetcher import FetchedResponse, HttpFetcher
+from cancellation import CancellationToken, cancellation_stats
+from passage_extractor import LocalPassageExtractor
+from web_contents_cache import CachedPage, WebContentsCache
+from structured_logging import get_logger
 
 
 # pythonのOpenAIラッパーライブラリに環境変数からAPIキーをセットする
 openai.api_key = Env.OPENAI_API_KEY
 
+logger = get_logger(__name__)
+
+
+# ディープサーチで、全リンクの要約を待たずに回答を始めるための条件
+# 「min_summaries件の要約が揃う」か「max_wait_seconds秒が経つ」かの早い方で打ち切る（両方Noneの場合は全リンクを待つ）
+class DeepSearchPolicy(BaseModel):
+    min_summaries: Optional[int] = None
+    max_wait_seconds: Optional[float] = None
+    # True: 打ち切った時点で残りのリンクの処理を中断する
+    # False: 残りのリンクの処理は裏で続けさせ、結果はキャッシュにだけ保存する（次に同じページが使われた時に速くなる）
+    cancel_stragglers: bool = True
+
+    @property
+    def is_progressive(self) -> bool:
+        return self.min_summaries is not None or self.max_wait_seconds is not None
+
+
+# ディープサーチの待ち時間と、打ち切りがどれくらい発生しているかを集計するクラス（ポリシーの調整用）
+class DeepSearchStats:
+    def __init__(self):
+        self.runs = 0
+        self.cutoffs_by_count = 0
+        self.cutoffs_by_deadline = 0
+        self.stragglers_cancelled = 0
+        self.stragglers_ignored = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+
+    def record(
+        self,
+        wait_ms: float,
+        # None（全リンクを待った） / count（件数が揃った） / deadline（時間切れ）
+        cutoff: Optional[str],
+        straggler_count: int,
+        cancel_stragglers: bool,
+    ):
+        self.runs += 1
+        self.total_wait_ms += wait_ms
+        self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+        if cutoff == 'count':
+            self.cutoffs_by_count += 1
+        elif cutoff == 'deadline':
+            self.cutoffs_by_deadline += 1
+        if cancel_stragglers:
+            self.stragglers_cancelled += straggler_count
+        else:
+            self.stragglers_ignored += straggler_count
+
+    def stats(self) -> dict:
+        cutoffs = self.cutoffs_by_count + self.cutoffs_by_deadline
+        return {
+            'runs': self.runs,
+            'cutoffs_by_count': self.cutoffs_by_count,
+            'cutoffs_by_deadline': self.cutoffs_by_deadline,
+            'cutoff_rate': cutoffs / self.runs if self.runs else 0.0,
+            'stragglers_cancelled': self.stragglers_cancelled,
+            'stragglers_ignored': self.stragglers_ignored,
+            'avg_wait_ms': self.total_wait_ms / self.runs if self.runs else 0.0,
+            'max_wait_ms': self.max_wait_ms,
+        }
+
+
+# プロセス全体で共有する集計値
+deep_search_stats = DeepSearchStats()
+
 
 class WebContentsScraper():
     # 0~100で全体の進捗を表す値（ここに加算していく）
@@ -25,12 +95,26 @@ class WebContentsScraper():
     links: [str]
     query: str
     callback_handler: CallbackHandler
+    cancellation_token: CancellationToken
+    cache: WebContentsCache
+    fetcher: HttpFetcher
+    extractor: Optional[LocalPassageExtractor]
+    policy: DeepSearchPolicy
+    # 要約を打ち切った後は、裏で続いている処理から進捗を通知しない様にするためのフラグ
+    is_finished: bool
 
     def __init__(
         self,
         links: [str],
         query: str,
         callback_handler: CallbackHandler,
+        cancellation_token: CancellationToken,
+        cache: WebContentsCache,
+        fetcher: HttpFetcher,
+        # 指定した場合は、16kモデルでの要約の代わりにローカルでの関連パッセージの抽出を行う（抽出できなかった場合だけ16kモデルで要約する）
+        extractor: Optional[LocalPassageExtractor] = None,
+        # 未指定の場合は、従来通り全リンクの要約を待つ
+        policy: Optional[DeepSearchPolicy] = None,
     ):
         # 計算式：(100 ÷ (_create_summary()内の主な処理の数「3」✖️ linkの数)）を少数切り捨てした整数（linkが3件なら11）
         # 表示を簡素化する為に整数に丸めている関係でそれぞれの処理が全て終わっても100にはならないが、
@@ -39,31 +123,57 @@ class WebContentsScraper():
         self.links = links
         self.query = query
         self.callback_handler = callback_handler
+        self.cancellation_token = cancellation_token
+        self.cache = cache
+        self.fetcher = fetcher
+        self.extractor = extractor
+        self.policy = policy or DeepSearchPolicy()
+        self.is_finished = False
 
 
     # 外部データ検索で取得した各リンク（上位3件）に対して行いたい処理を並列実行させる為の関数
     async def create_summary_from_links(self) -> str:
+        self.cancellation_token.enter_stage('web_scraping')
+
         # 各処理の完了時に行いたい処理
         def on_update_progress():
+            # 打ち切り後（progress=100を通知した後）は、残りのリンクの処理が進んでも通知しない
+            if self.is_finished:
+                return
             # クラスの初期化時に計算した、各処理ごとに割り当てられた進捗の値を加算する
             self.progress += self.each_process_value
             # 加算された値（更新後の値）でアプリに進捗を通知するために、コールバックを呼ぶ
             self.callback_handler.on_web_contents_scraping_progress_updated(progress=self.progress)
 
+        # 似た質問に対する要約をキャッシュから探せる様に、質問のembeddingを取得しておく
+        query_embedding = await self.cache.embed_query(self.query)
+
         # リンクの数だけ非同期処理のタスクを生成する
         tasks = [
-            self._create_summary(
+            asyncio.ensure_future(self._create_summary(
                 link, 
                 self.query, 
+                query_embedding,
                 on_update_progress, # 上記で定義した「各処理の完了時に行いたい処理」を注入する
-            ) for link in self.links
+            )) for link in self.links
         ]
         # 非同期処理を開始するので、progress=0としてアプリに通知し、進捗表示用の吹き出しを表示させる
         self.callback_handler.on_web_contents_scraping_progress_updated(progress=0)
         # 非同期処理を並列実行する
-        # （return_exceptions=Trueについて：一部の処理で例外が発生した場合でも他の処理を続行させ、最終的なすべての結果の中で一緒に例外も受け取れる様にしている）
-        summaries = await asyncio.gather(*tasks, return_exceptions=True)
-        # 上記の非同期処理が完了したので、progress=100で明示的にアプリに完了を通知する
+        started_at = time.perf_counter()
+        if self.policy.is_progressive:
+            summaries = await self._wait_for_summaries_progressively(tasks, started_at)
+        else:
+            # （return_exceptions=Trueについて：一部の処理で例外が発生した場合でも他の処理を続行させ、最終的なすべての結果の中で一緒に例外も受け取れる様にしている）
+            summaries = await asyncio.gather(*tasks, return_exceptions=True)
+            deep_search_stats.record(
+                wait_ms=(time.perf_counter() - started_at) * 1000,
+                cutoff=None,
+                straggler_count=0,
+                cancel_stragglers=self.policy.cancel_stragglers,
+            )
+        # 上記の非同期処理が完了（または打ち切り）したので、progress=100で明示的にアプリに完了を通知する
+        self.is_finished = True
         self.callback_handler.on_web_contents_scraping_progress_updated(progress=100)
 
         # 例外が含まれている可能性があるので、strだけにフィルターする
@@ -72,44 +182,136 @@ class WebContentsScraper():
 
         # 各サイトの結果の文字列を結合して1つの文字列にする
         result = '\n'.join(filtered_summaries)
-        print(f'⭐️⭐️⭐️create_summary_from_linksの最終結果:\n{result}')
+        logger.info('create_summary_from_linksの最終結果', summary_count=len(filtered_summaries), result_chars=len(result))
+        logger.debug('create_summary_from_linksの最終結果の本文', result=result)
         return result
 
 
+    # ポリシーの件数が揃うか、待ち時間の上限に達するまでの間に完了したリンクの要約だけを返す
+    async def _wait_for_summaries_progressively(
+        self,
+        tasks: List[asyncio.Task],
+        started_at: float,
+    ) -> List[str]:
+        deadline = None
+        if self.policy.max_wait_seconds is not None:
+            deadline = started_at + self.policy.max_wait_seconds
+        pending = set(tasks)
+        succeeded_count = 0
+        cutoff = None
+        try:
+            while pending:
+                if self.policy.min_summaries is not None and succeeded_count >= self.policy.min_summaries:
+                    cutoff = 'count'
+                    break
+                timeout = None if deadline is None else deadline - time.perf_counter()
+                if timeout is not None and timeout <= 0:
+                    cutoff = 'deadline'
+                    break
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                succeeded_count += sum(1 for task in done if _is_succeeded(task))
+        except asyncio.CancelledError:
+            # asyncio.wait()は待っているタスクを中断しないので、回答処理自体が中断された場合は全て中断させる
+            for task in tasks:
+                task.cancel()
+            raise
+
+        if cutoff is not None:
+            logger.info('ディープサーチを打ち切り', cutoff=cutoff, succeeded_count=succeeded_count, link_count=len(tasks))
+        for task in pending:
+            if self.policy.cancel_stragglers:
+                task.cancel()
+            else:
+                # クライアントが切断した場合は裏で続いている処理も中断させる
+                self.cancellation_token.track(task)
+                # 裏で失敗した場合の例外は、ここで受け取って捨てる
+                task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        deep_search_stats.record(
+            wait_ms=(time.perf_counter() - started_at) * 1000,
+            cutoff=cutoff,
+            straggler_count=len(pending),
+            cancel_stragglers=self.policy.cancel_stragglers,
+        )
+        # 完了したものだけを、検索結果の順位の順で返す
+        return [task.result() for task in tasks if _is_succeeded(task)]
+
+
     # 1つのリンクに対して行わせたい処理をまとめた関数
     async def _create_summary(
         self,
         link: str, 
         query: str,
+        query_embedding: np.ndarray,
         on_update_progress: Callable[..., None],
     ):
-        print(f'⭐️{link}に対する_create_summary()処理を開始')
+        logger.debug('_create_summary()処理を開始', link=link)
 
-        content = await self._get_content_from_link(link)
-        print(f' - {link}のコンテンツ抽出完了')
-        on_update_progress()
+        try:
+            page = await self._get_cleaned_page(link, on_update_progress)
 
-        cleaned_content = self._clean_content(content)
-        print(f' - {link}から抽出したコンテンツのクリーン完了')
-        on_update_progress()
+            # クライアントが切断していた場合は、要約（16kモデルの呼び出し）を行わない
+            self.cancellation_token.raise_if_cancelled()
+            # 同じページ・似た質問に対する要約が既にあれば、16kモデルの呼び出しを省略する
+            # ローカルで抽出した結果と16kモデルでの要約結果は、キャッシュ上で別のものとして扱う
+            summary_kind = 'summary' if self.extractor is None else 'extractive'
+            if (summary := await self.cache.get_summary(page, query_embedding, kind=summary_kind)) is None:
+                summary = await self._summarize_content(page.content, query)
+                self.cache.put_summary(page, query_embedding, summary, kind=summary_kind)
+            logger.debug('クリーン済みコンテンツの要約完了', link=link)
+            on_update_progress()
 
-        summary = await self._summarize_content(cleaned_content, query)
-        print(f' - {link}のクリーン済みコンテンツの要約完了')
-        on_update_progress()
+        except asyncio.CancelledError:
+            cancellation_stats.on_page_summary_skipped()
+            raise
 
         return f'## ({link})から抽出したコンテンツの要約文章: {summary}'
 
 
-    # リンク先のHTMLコンテンツを全て抽出
+    # クリーン済みのページのコンテンツを取得する（キャッシュが新しければ取得もクリーンも行わない）
+    async def _get_cleaned_page(
+        self,
+        link: str,
+        on_update_progress: Callable[..., None],
+    ) -> CachedPage:
+        cached_page = await self.cache.get_page(link)
+        if cached_page is not None and self.cache.is_fresh(cached_page):
+            self.cache.on_page_fresh_hit()
+            # 取得とクリーンの2つの処理が完了した扱いで進捗を進める
+            on_update_progress()
+            on_update_progress()
+            return cached_page
+
+        # キャッシュがある場合は、ETag / Last-Modifiedを付けた条件付きGETで変更が無いかを確認する
+        response = await self._get_content_from_link(
+            link,
+            headers=self.cache.make_conditional_headers(cached_page),
+        )
+        logger.debug('コンテンツ抽出完了', link=link, status_code=response.status_code)
+        on_update_progress()
+
+        if response.status_code == 304 and cached_page is not None:
+            page = self.cache.on_page_revalidated(cached_page)
+        else:
+            # クライアントが切断していた場合は、重いクリーン処理を行わない
+            self.cancellation_token.raise_if_cancelled()
+            page = self.cache.on_page_fetched(
+                url=link,
+                content=self._clean_content(response.text),
+                etag=response.headers.get('ETag'),
+                last_modified=response.headers.get('Last-Modified'),
+            )
+        logger.debug('コンテンツのクリーン完了', link=link)
+        on_update_progress()
+        return page
+
+
+    # リンク先のHTMLコンテンツを抽出（共有のHTTPクライアントを使い、タイムアウトと本文サイズの上限を設けている）
     async def _get_content_from_link(
         self, 
-        link: str
-    ) -> str:
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(None, requests.get, link)
-        # エラーレスポンスの場合は例外を発生させる
-        response.raise_for_status()
-        return response.text
+        link: str,
+        headers: dict,
+    ) -> FetchedResponse:
+        return await self.fetcher.fetch(link, headers=headers)
 
 
     # 抽出したHTMLコンテンツの中から欲しい情報だけにフィルタリングする
@@ -117,20 +319,17 @@ class WebContentsScraper():
         self,
         content: str
     ) -> str:
-        bs_transformer = BeautifulSoupTransformer()
-        transformed_docs = bs_transformer.transform_documents(
-            documents=[Document(page_content=content)],
+        # 最初の10000トークン分だけを取り出す（トークン制限の問題もあって無限にコンテンツを取得しても結局使えないので）
+        # かといって、ここで十分な量を確保しないと深い回答に繋がる参考情報は取れないので、暫定で10000にしている。ここはあまりケチるべきでは無いと思っています。
+        # 巨大なページでもドキュメント全体は解析せず、10000トークンに達した時点で打ち切る
+        return extract_text_within_token_budget(
+            html_chunks=iter_html_chunks(content),
+            max_tokens=10000,
             # 除外したいHTMLタグを指定
             unwanted_tags=["nav", "header", "footer", "script", "style"],
             # 抽出したいHTMLタグを指定（汎用的に指定する必要がある。暫定でこの設定値にしている。改善の余地あり）
-            tags_to_extract=["div", "span"]
+            tags_to_extract=["div", "span"],
         )
-        # 最初の10000トークン分だけを取り出す（トークン制限の問題もあって無限にコンテンツを取得しても結局使えないので）
-        # かといって、ここで十分な量を確保しないと深い回答に繋がる参考情報は取れないので、暫定で10000にしている。ここはあまりケチるべきでは無いと思っています。
-        splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(chunk_size=10000,
-                                                                        chunk_overlap=0)
-        splits = splitter.split_documents(documents=transformed_docs)
-        return splits[0].page_content   
 
 
     # クリーニングしたコンテンツの中から元の質問分に関連する部分を抽出させつつ、500文字以内に要約させる
@@ -139,10 +338,14 @@ class WebContentsScraper():
         content: str,
         query: str,
     ) -> str:
-        token_count = len(tiktoken.encoding_for_model('gpt-3.5-turbo-16k').encode(content))
+        # tokenizerはプロセス全体で使い回しているものを使う
+        token_count = count_tokens(content, 'gpt-3.5-turbo-16k')
         # 元から500token以下の場合は要約せずにそのまま返す
         if token_count <= 500:
             return content
+        # ローカルでの抽出が有効な場合は先に試し、関連する部分が見つからなかった場合だけ16kモデルで要約する
+        elif self.extractor is not None and (extracted := await self._extract_passages(content, query)) is not None:
+            return extracted
         else:
             # 非同期処理を行える様にacreate()（async createのこと）の方のメソッドを使用している
             response = await openai.ChatCompletion.acreate(
@@ -154,4 +357,26 @@ class WebContentsScraper():
                     "content": f"## 命令文:対象の文章に関して、{query}という質問に関連する文章を抽出してください。\n\n## 対象の文章:{content}"
                 }],
             )
-            return response["choices"][0]["message"]["content"]
\ No newline at end of file
+            # 要約の呼び出しもトークン数を集計する（非ストリームなのでレスポンスのusageの値を使う）
+            usage = response.get("usage", {})
+            token_usage_stats.record(
+                model_name='gpt-3.5-turbo-16k',
+                prompt_tokens=usage.get("prompt_tokens", 0),
+                completion_tokens=usage.get("completion_tokens", 0),
+            )
+            return response["choices"][0]["message"]["content"]
+
+    # ローカルで質問に関連するパッセージを抽出する（関連する部分が無ければNone）
+    async def _extract_passages(
+        self,
+        content: str,
+        query: str,
+    ) -> Optional[str]:
+        # CPUでの処理なので、イベントループを止めない様にexecutorのスレッドで行う
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.extractor.extract, content, query,
+        )
+
+
+def _is_succeeded(task: asyncio.Task) -> bool:
+    return task.done() and not task.cancelled() and task.exception() is None